@@ -9,6 +9,7 @@ from quart import (
     websocket,
     jsonify,
     request,
+    Response,
     send_from_directory,
     render_template
 )
@@ -18,9 +19,9 @@ if LOCAL_DEV == 'True':
     load_dotenv(override=True)
 
 from backend.auth.auth_utils import get_authenticated_user_details
-from backend.conversation import clear_messages, conversation_internal, delete_all_conversations, delete_conversation, get_conversation, list_conversations, rename_conversation, update_conversation, update_message, add_conversation
+from backend.conversation import clear_messages, conversation_internal, delete_all_conversations, delete_conversation, get_conversation, get_history_job, list_conversations, rename_conversation, update_conversation, update_message, update_messages, add_conversation
 from backend.document import delete_documents, documentsummary, get_documents, handle_document_refinement, handle_new_document, ingest_all_docs_from_storage, upload_documents
-from backend.setup import UI_FAVICON, UI_TITLE, ensure_cosmos, frontend_settings
+from backend.setup import METRICS_ENABLED, UI_FAVICON, UI_TITLE, client_registry, cosmos_telemetry, ensure_cosmos, frontend_settings, metrics_registry
 
 
 
@@ -29,6 +30,22 @@ def create_app():
     app.register_blueprint(bp)
     app.config["TEMPLATES_AUTO_RELOAD"] = True
 
+    @app.before_serving
+    async def start_clients():
+        await client_registry.start()
+
+    @app.after_serving
+    async def close_clients():
+        await client_registry.close()
+
+    @app.before_request
+    async def start_request_telemetry():
+        rule = request.url_rule.rule if request.url_rule else request.path
+        cosmos_telemetry.start_request(f"{request.method} {rule}")
+
+    @app.teardown_request
+    async def end_request_telemetry(exception):
+        cosmos_telemetry.end_request()
 
     @app.after_request
     def add_security_headers(response):
@@ -72,6 +89,12 @@ async def conversation():
     request_json = await request.get_json()
     return await conversation_internal(request_json)
 
+@bp.route("/metrics", methods=["GET"])
+async def get_metrics():
+    if not METRICS_ENABLED:
+        return jsonify({"error": "Metrics are not enabled"}), 404
+    return Response(metrics_registry.render(), mimetype="text/plain; version=0.0.4")
+
 @bp.route("/frontend_settings", methods=["GET"])
 def get_frontend_settings():
     try:
@@ -92,6 +115,10 @@ async def history_update():
 async def history_message_feedback():
     return await update_message()
 
+@bp.route("/history/message_feedback/batch", methods=["POST"])
+async def history_message_feedback_batch():
+    return await update_messages()
+
 @bp.route("/history/delete", methods=["DELETE"])
 async def history_delete():
     return await delete_conversation()
@@ -116,6 +143,10 @@ async def history_delete_all():
 async def history_clear():
     return await clear_messages()
 
+@bp.route("/history/jobs/<job_id>", methods=["GET"])
+async def history_job(job_id):
+    return await get_history_job(job_id)
+
 @bp.route("/history/ensure", methods=["GET"])
 async def history_ensure():
     return await ensure_cosmos()
@@ -143,7 +174,7 @@ async def process_documents():
         await handle_new_document(websocket, data)
     except Exception as e:
         print(f"Error processing documents: {e}")
-        await websocket.send(f"error: {e}")
+        await websocket.send(json.dumps({"type": "error", "error": str(e)}))
     finally:
         await websocket.close()
 
@@ -0,0 +1,105 @@
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Model args that change the answer; anything else (e.g. stream) does not belong in the key
+CACHE_KEY_ARGS = ["messages", "model", "temperature", "max_tokens", "top_p", "stop"]
+
+
+class CompletionCache():
+    """
+    Caches chat completion answers for requests that are not grounded on a data source.
+
+    Entries live in an in-memory LRU and, when sqlite_path is set, in a SQLite table that
+    survives restarts and is shared by the workers on one machine. Both tiers expire
+    entries after ttl seconds; a ttl of 0 disables the cache.
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 1000, sqlite_path: str = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sqlite_path = sqlite_path
+        self._entries = OrderedDict()
+        self._connection = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def make_key(self, model_args):
+        """Returns the cache key for the model args, or None if the request should not be cached."""
+        if not self.enabled or model_args.get("extra_body"):
+            return None
+        key_args = {arg: model_args.get(arg) for arg in CACHE_KEY_ARGS}
+        normalized = json.dumps(key_args, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+    def _get_connection(self):
+        if not self._connection:
+            self._connection = sqlite3.connect(self.sqlite_path, check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._connection.commit()
+        return self._connection
+
+    def _sqlite_get(self, key):
+        with self._lock:
+            row = self._get_connection().execute("SELECT value, expires_at FROM completions WHERE key = ? AND expires_at > ?", (key, time.time())).fetchone()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def _sqlite_set(self, key, value, expires_at):
+        with self._lock:
+            connection = self._get_connection()
+            connection.execute("INSERT OR REPLACE INTO completions (key, value, expires_at) VALUES (?, ?, ?)", (key, json.dumps(value), expires_at))
+            connection.execute("DELETE FROM completions WHERE expires_at <= ?", (time.time(),))
+            connection.commit()
+
+    def _remember(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def get(self, key):
+        if not key:
+            return None
+        entry = self._entries.get(key)
+        if entry:
+            value, expires_at = entry
+            if expires_at > time.time():
+                self._entries.move_to_end(key)
+                return value
+            del self._entries[key]
+
+        if self.sqlite_path:
+            try:
+                entry = await asyncio.to_thread(self._sqlite_get, key)
+            except sqlite3.Error as e:
+                logging.warning(f"Completion cache read failed: {e}")
+                return None
+            if entry:
+                self._remember(key, *entry)
+                return entry[0]
+        return None
+
+    async def set(self, key, value):
+        if not key:
+            return
+        expires_at = time.time() + self.ttl
+        self._remember(key, value, expires_at)
+        if self.sqlite_path:
+            try:
+                await asyncio.to_thread(self._sqlite_set, key, value, expires_at)
+            except sqlite3.Error as e:
+                logging.warning(f"Completion cache write failed: {e}")
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
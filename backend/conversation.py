@@ -1,5 +1,9 @@
+import asyncio
 import logging
+import random
+import time
 import uuid
+from contextlib import aclosing
 
 
 from quart import (
@@ -8,20 +12,23 @@ from quart import (
     request,
 )
 
+from openai.types.chat import ChatCompletion, ChatCompletionChunk, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from openai.types.chat.chat_completion_chunk import Choice as ChunkChoice, ChoiceDelta
+
 from backend.auth.auth_utils import get_authenticated_user_details
+from backend.history.historyservice import PreconditionFailedError
 from azure.monitor.events.extension import track_event
 from azure.search.documents.indexes.models import *
 
-from backend.setup import MONITORING_ENABLED, SHOULD_STREAM, generate_title, init_cosmosdb_client, init_cosmosdb_logs_client, init_openai_client, prepare_model_args
-from backend.utils import format_as_ndjson, format_stream_response, format_non_streaming_response
+from backend.setup import AZURE_OPENAI_STREAM_FLUSH_INTERVAL_MS, AZURE_OPENAI_STREAM_FLUSH_SIZE, AZURE_OPENAI_STREAM_HEDGE_AFTER_MS, AZURE_OPENAI_STREAM_RETRIES, AZURE_OPENAI_STREAM_RETRY_BACKOFF_MS, AZURE_COSMOSDB_DELETE_BY_PARTITION_KEY, AZURE_COSMOSDB_DELETE_CONCURRENCY, COMPACT_STREAM_PROTOCOL, HISTORY_FEEDBACK_BATCH_SIZE, HISTORY_JOB_WAIT_SECONDS, HISTORY_PAGE_SIZE, HISTORY_READ_PAGE_SIZE, MONITORING_ENABLED, SHOULD_STREAM, client_registry, completion_cache, history_jobs, generate_title, get_openai_client, get_provisional_title, get_cosmos_conversation_client, get_cosmos_logs_client, prepare_model_args
+from backend.utils import decode_cursor, encode_cursor, format_as_compact_ndjson, format_as_ndjson, format_stream_response, format_non_streaming_response, get_stream_messages
 
 
 
-async def send_chat_request(request):
-    model_args = prepare_model_args(request)
-    print(f"MODEL ARGS: {model_args}")
+async def send_chat_request(model_args):
     try:
-        azure_openai_client = init_openai_client()
+        azure_openai_client = get_openai_client()
         response = await azure_openai_client.chat.completions.create(**model_args)
     except Exception as e:
         print(f"Exception in send_chat_request {e}")
@@ -30,29 +37,196 @@ async def send_chat_request(request):
 
     return response
 
+def cached_completion(cached):
+    # Every replay gets a fresh id, the frontend stores the answer under it
+    return ChatCompletion(
+        id=f"chatcmpl-cache-{uuid.uuid4()}",
+        model=cached["model"],
+        created=int(time.time()),
+        object="chat.completion",
+        choices=[Choice(index=0, finish_reason="stop", message=ChatCompletionMessage(role="assistant", content=cached["content"]))]
+    )
+
+async def cached_completion_stream(cached):
+    yield ChatCompletionChunk(
+        id=f"chatcmpl-cache-{uuid.uuid4()}",
+        model=cached["model"],
+        created=int(time.time()),
+        object="chat.completion.chunk",
+        choices=[ChunkChoice(index=0, finish_reason="stop", delta=ChoiceDelta(role="assistant", content=cached["content"]))]
+    )
+
+async def cache_completion_stream(chunks, cache_key):
+    """Passes the stream through and caches the answer once it has been streamed in full."""
+    contents = []
+    model = None
+    async with aclosing(chunks):
+        async for chunk in chunks:
+            messages = get_stream_messages(chunk)
+            if messages == 'retry':
+                cache_key = None
+            else:
+                contents.extend(message["content"] for message in messages if message["role"] == "assistant")
+            model = chunk.model or model
+            yield chunk
+
+    if cache_key and contents:
+        await completion_cache.set(cache_key, {"content": "".join(contents), "model": model})
+
 async def complete_chat_request(request_body):
-    response = await send_chat_request(request_body)
+    model_args = await prepare_model_args(request_body)
     history_metadata = request_body.get("history_metadata", {})
 
+    cache_key = completion_cache.make_key(model_args)
+    cached = await completion_cache.get(cache_key)
+    if cached:
+        return format_non_streaming_response(cached_completion(cached), history_metadata)
+
+    response = await send_chat_request(model_args)
+    if cache_key and response.choices and response.choices[0].message.content:
+        await completion_cache.set(cache_key, {"content": response.choices[0].message.content, "model": response.model})
+
     return format_non_streaming_response(response, history_metadata)
 
+async def read_first_chunks(response):
+    """
+    Reads a chat stream up to its first chunk with content.
+    Returns the chunks read and whether the data source came back without citations.
+    """
+    chunks = []
+    while True:
+        try:
+            chunk = await response.__anext__()
+        except StopAsyncIteration:
+            return chunks, False
+        chunks.append(chunk)
+        messages = get_stream_messages(chunk)
+        if messages == 'retry':
+            return chunks, True
+        if messages:
+            return chunks, False
+
+async def start_chat_stream(model_args, accept_retry=False):
+    azure_openai_client = get_openai_client()
+    response = await azure_openai_client.chat.completions.create(**model_args)
+    try:
+        chunks, no_citations = await read_first_chunks(response)
+    except BaseException:
+        await response.close()
+        raise
+
+    if no_citations and not accept_retry:
+        await response.close()
+        return None
+    return response, chunks
+
+async def start_hedged_chat_stream(model_args, accept_retry=False):
+    """
+    Starts a chat stream and, when AZURE_OPENAI_STREAM_HEDGE_AFTER_MS is set and no content has
+    arrived by then, a second identical one. The first stream to yield usable content wins.
+    """
+    attempts = [asyncio.ensure_future(start_chat_stream(model_args, accept_retry))]
+    winner = None
+    error = None
+    try:
+        if AZURE_OPENAI_STREAM_HEDGE_AFTER_MS:
+            done, _ = await asyncio.wait(attempts, timeout=float(AZURE_OPENAI_STREAM_HEDGE_AFTER_MS) / 1000)
+            if not done:
+                logging.debug("No content from the chat stream yet, sending a hedged request")
+                attempts.append(asyncio.ensure_future(start_chat_stream(model_args, accept_retry)))
+
+        pending = set(attempts)
+        while pending and not winner:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for attempt in done:
+                if attempt.exception():
+                    error = attempt.exception()
+                elif attempt.result() and not winner:
+                    winner = attempt.result()
+    finally:
+        for attempt in attempts:
+            if not attempt.done():
+                attempt.cancel()
+        await asyncio.gather(*attempts, return_exceptions=True)
+        for attempt in attempts:
+            if not attempt.cancelled() and not attempt.exception() and attempt.result() and attempt.result() is not winner:
+                await attempt.result()[0].close()
+
+    if not winner and error:
+        raise error
+    return winner
+
+async def send_chat_stream_request(request_body):
+    """
+    Sends a streaming chat request and returns its chunks.
+
+    When the data source returns no citations the request is retried on the server, with
+    exponential backoff, up to AZURE_OPENAI_STREAM_RETRIES times. The last attempt is
+    streamed as it is, so the client still sees the 'retry' response if every attempt fails.
+    """
+    model_args = await prepare_model_args(request_body)
+    cache_key = completion_cache.make_key(model_args)
+    cached = await completion_cache.get(cache_key)
+    if cached:
+        return cached_completion_stream(cached)
+
+    retries = int(AZURE_OPENAI_STREAM_RETRIES)
+    try:
+        for attempt in range(retries + 1):
+            result = await start_hedged_chat_stream(model_args, accept_retry=attempt == retries)
+            if result:
+                break
+            backoff = float(AZURE_OPENAI_STREAM_RETRY_BACKOFF_MS) / 1000 * 2 ** attempt
+            logging.warning(f"No citations returned by the data source, retrying chat request in {backoff:.2f}s ({attempt + 1} of {retries})")
+            await asyncio.sleep(backoff * random.uniform(0.5, 1))
+    except Exception as e:
+        logging.exception("Exception in send_chat_stream_request")
+        raise e
+
+    response, first_chunks = result
+    async def generate():
+        try:
+            for chunk in first_chunks:
+                yield chunk
+            async for chunk in response:
+                yield chunk
+        finally:
+            ## also runs when the client goes away mid-stream, which frees the deployment
+            await response.close()
+
+    return cache_completion_stream(generate(), cache_key)
+
 async def stream_chat_request(request_body):
-    response = await send_chat_request(request_body)
+    response = await send_chat_stream_request(request_body)
     
     history_metadata = request_body.get("history_metadata", {})
     async def generate():
-        async for completionChunk in response:
-            formattedChunk = format_stream_response(completionChunk, history_metadata)
-            # TO DO - RETRY INSTEAD OF PASSING ERROR
-            yield formattedChunk
+        async with aclosing(response):
+            async for completionChunk in response:
+                formattedChunk = format_stream_response(completionChunk, history_metadata)
+                yield formattedChunk
 
     return generate()
 
+async def stream_compact_chat_request(request_body):
+    response = await send_chat_stream_request(request_body)
+
+    history_metadata = request_body.get("history_metadata", {})
+    return format_as_compact_ndjson(
+        response,
+        history_metadata,
+        flush_interval=float(AZURE_OPENAI_STREAM_FLUSH_INTERVAL_MS) / 1000,
+        flush_size=int(AZURE_OPENAI_STREAM_FLUSH_SIZE)
+    )
+
 async def conversation_internal(request_body):
     try:
         if SHOULD_STREAM:
-            result = await stream_chat_request(request_body)
-            response = await make_response(format_as_ndjson(result))
+            if request_body.get("stream_protocol") == COMPACT_STREAM_PROTOCOL:
+                result = await stream_compact_chat_request(request_body)
+            else:
+                result = format_as_ndjson(await stream_chat_request(request_body))
+            response = await make_response(result)
             response.timeout = None
             response.mimetype = "application/json-lines"
             return response
@@ -72,6 +246,32 @@ async def conversation_internal(request_body):
 
 
 
+async def write_history(history_clients, user_id, conversation_id, messages, conversation=None):
+    """Writes the messages, and the new conversation if given, to every history container concurrently."""
+    results = await asyncio.gather(*[
+        client.create_messages(user_id, conversation_id, messages, conversation=conversation)
+        for client in history_clients
+    ])
+    for client, result in zip(history_clients, results):
+        if result == "Conversation not found":
+            raise Exception(f"Conversation not found in {client.container_name} for the given conversation ID: {conversation_id}.")
+
+async def update_generated_title(user_id, conversation_id, conversation_messages, history_metadata):
+    """Generates the title of a new conversation and patches it over the provisional one."""
+    title = await generate_title(conversation_messages)
+    # Chunks streamed from now on carry the generated title
+    history_metadata['title'] = title
+
+    cosmos_conversation_client = get_cosmos_conversation_client()
+    cosmos_logs_client = get_cosmos_logs_client()
+    try:
+        await asyncio.gather(*[
+            client.update_conversation_title(user_id, conversation_id, title)
+            for client in (cosmos_conversation_client, cosmos_logs_client) if client
+        ])
+    except Exception:
+        logging.exception("Exception updating the conversation title")
+
 async def add_conversation():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user['user_principal_id']
@@ -82,55 +282,42 @@ async def add_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
         
-        cosmos_logs_client = init_cosmosdb_logs_client()
+        cosmos_logs_client = get_cosmos_logs_client()
         if not cosmos_logs_client:
             raise Exception("CosmosDB logs is not configured or not working")
 
         # check for the conversation_id, if the conversation is not set, we will create a new one
         history_metadata = {}
+        new_conversation = None
         if not conversation_id:
-            title = await generate_title(request_json["messages"])
-            conversation_dict = await cosmos_conversation_client.create_conversation(user_id=user_id, title=title)
-            conversation_id = conversation_dict['id']
-            logs_dict = await cosmos_logs_client.create_log_conversation(user_id=user_id, conversation_id=conversation_id, title=title)
+            # The real title is generated alongside the chat request rather than before it
+            title = get_provisional_title(request_json["messages"])
+            new_conversation = cosmos_conversation_client.build_conversation(user_id=user_id, title=title)
+            conversation_id = new_conversation['id']
             history_metadata['title'] = title
-            history_metadata['date'] = conversation_dict['createdAt']
-
-
+            history_metadata['date'] = new_conversation['createdAt']
 
         ## Format the incoming message object in the "chat/completions" messages format
-        ## then write it to the conversation history in cosmos and logs
-        messageUuid = str(uuid.uuid4())
+        ## then write it, and the new conversation if there is one, to the conversation history in cosmos and logs
         messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]['role'] == "user":
-            createdMessageValue = await cosmos_conversation_client.create_message(
-                uuid=messageUuid,
+            message = cosmos_conversation_client.build_message(
+                uuid=str(uuid.uuid4()),
                 conversation_id=conversation_id,
                 user_id=user_id,
                 input_message=messages[-1],
                 hidden=messages[-1]['hidden']
             )
-            if createdMessageValue == "Conversation not found":
-                raise Exception("Conversation not found for the given conversation ID: " + conversation_id + ".")
-            
-            createdLogMessageValue = await cosmos_logs_client.create_message(
-                uuid=messageUuid,
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=messages[-1],
-                hidden=messages[-1]['hidden']
-            )
-            if createdLogMessageValue == "Conversation not found":
-                raise Exception("Conversation log not found for the given conversation ID: " + conversation_id + ".")
-
+            await write_history([cosmos_conversation_client, cosmos_logs_client], user_id, conversation_id, [message], conversation=new_conversation)
         else:
             raise Exception("No user message found")
-        await cosmos_conversation_client.cosmosdb_client.close()
-        await cosmos_logs_client.cosmosdb_client.close()
+
+        if new_conversation:
+            client_registry.run_in_background(update_generated_title(user_id, conversation_id, messages, history_metadata))
         
         # Submit request to Chat Completions for response
         request_body = await request.get_json()
@@ -155,11 +342,11 @@ async def update_conversation():
 
     try:
         # make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
         
-        cosmos_log_client = init_cosmosdb_logs_client()
+        cosmos_log_client = get_cosmos_logs_client()
         if not cosmos_log_client:
             raise Exception("CosmosDB logs is not configured or not working")
 
@@ -171,42 +358,29 @@ async def update_conversation():
         ## then write it to the conversation history in cosmos
         messages = request_json["messages"]
         if len(messages) > 0 and messages[-1]['role'] == "assistant":
+            history_messages = []
             if len(messages) > 1 and messages[-2].get('role', None) == "tool":
                 # write the tool message first
-                toolMessageUuid = str(uuid.uuid4())
-                await cosmos_conversation_client.create_message(
-                    uuid=toolMessageUuid,
+                history_messages.append(cosmos_conversation_client.build_message(
+                    uuid=str(uuid.uuid4()),
                     conversation_id=conversation_id,
                     user_id=user_id,
                     input_message=messages[-2]
-                )
-                await cosmos_log_client.create_message(
-                    uuid=toolMessageUuid,
-                    conversation_id=conversation_id,
-                    user_id=user_id,
-                    input_message=messages[-2]
-                )
+                ))
             # write the assistant message
-            await cosmos_conversation_client.create_message(
-                uuid=messages[-1]['id'],
-                conversation_id=conversation_id,
-                user_id=user_id,
-                input_message=messages[-1]
-            )
-            await cosmos_log_client.create_message(
+            history_messages.append(cosmos_conversation_client.build_message(
                 uuid=messages[-1]['id'],
                 conversation_id=conversation_id,
                 user_id=user_id,
                 input_message=messages[-1]
-            )
+            ))
+            await write_history([cosmos_conversation_client, cosmos_log_client], user_id, conversation_id, history_messages)
 
         else:
             print(f"no assistant message found ")
             raise Exception("No bot messages found")
         
         # Submit request to Chat Completions for response
-        await cosmos_conversation_client.cosmosdb_client.close()
-        await cosmos_log_client.cosmosdb_client.close()
         response = {'success': True}
         return jsonify(response), 200
        
@@ -219,7 +393,7 @@ async def update_conversation():
 async def update_message():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user['user_principal_id']
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmos_conversation_client()
 
     ## check request for message_id
     request_json = await request.get_json()
@@ -232,8 +406,11 @@ async def update_message():
         if not message_feedback:
             return jsonify({"error": "message_feedback is required"}), 400
         
-        ## update the message in cosmos
-        updated_message = await cosmos_conversation_client.update_message_feedback(user_id, message_id, message_feedback)
+        ## update the message in cosmos, only if it is unchanged when the client sends the ETag it read
+        try:
+            updated_message = await cosmos_conversation_client.update_message_feedback(user_id, message_id, message_feedback, etag=request_json.get('etag'))
+        except PreconditionFailedError as e:
+            return jsonify({"error": str(e)}), 412
         if updated_message:
             return jsonify({"message": f"Successfully updated message with feedback {message_feedback}", "message_id": message_id}), 200
         else:
@@ -244,6 +421,55 @@ async def update_message():
         return jsonify({"error": str(e)}), 500
 
 
+async def update_messages():
+    """Sets the feedback of several messages in one request, answering with the status of each."""
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user['user_principal_id']
+    cosmos_conversation_client = get_cosmos_conversation_client()
+
+    request_json = await request.get_json()
+    ratings = request_json.get('feedback', None)
+    try:
+        if not ratings or not isinstance(ratings, list):
+            return jsonify({"error": "feedback is required, as a list of message_id and message_feedback"}), 400
+        if len(ratings) > HISTORY_FEEDBACK_BATCH_SIZE:
+            return jsonify({"error": f"At most {HISTORY_FEEDBACK_BATCH_SIZE} messages can be rated at once"}), 400
+        if any(not rating.get('message_id') or not rating.get('message_feedback') for rating in ratings):
+            return jsonify({"error": "message_id and message_feedback are required for every message"}), 400
+
+        ## a message rated twice gets its last rating
+        feedback = {rating['message_id']: rating['message_feedback'] for rating in ratings}
+        etags = {rating['message_id']: rating['etag'] for rating in ratings if rating.get('etag')}
+        updated_messages = await cosmos_conversation_client.update_messages_feedback(user_id, feedback, etags=etags)
+
+        statuses = {message_id: 200 if message else 412 if message is None else 404 for message_id, message in updated_messages.items()}
+        return jsonify({"results": [{"message_id": message_id, "status": status} for message_id, status in statuses.items()]}), 200
+    except Exception as e:
+        logging.exception("Exception in /history/message_feedback/batch")
+        return jsonify({"error": str(e)}), 500
+
+
+
+async def run_history_job(user_id, kind, coroutine, **response_fields):
+    """
+    Runs a history job such as a bulk delete. Returns None if it finished within HISTORY_JOB_WAIT_SECONDS,
+    otherwise a 202 response with the job id to poll at /history/jobs/<job_id>.
+    """
+    job = history_jobs.start(user_id, kind, coroutine, run_in_background=client_registry.run_in_background)
+    if not await history_jobs.wait(job, HISTORY_JOB_WAIT_SECONDS):
+        return jsonify({"message": f"{kind} is still running", **response_fields, **job.to_dict()}), 202
+    if job.status == "failed":
+        raise Exception(job.error)
+    return None
+
+async def get_history_job(job_id):
+    authenticated_user = get_authenticated_user_details(request_headers=request.headers)
+    user_id = authenticated_user['user_principal_id']
+
+    job = history_jobs.get(user_id, job_id)
+    if not job:
+        return jsonify({"error": f"Job {job_id} was not found"}), 404
+    return jsonify(job.to_dict()), 200
 
 async def delete_conversation():
 
@@ -262,17 +488,19 @@ async def delete_conversation():
             return jsonify({"error": "conversation_id is required"}), 400
         
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        ## delete the conversation messages from cosmos first
-        deleted_messages = await cosmos_conversation_client.delete_messages(conversation_id, user_id)
-
-        ## Now delete the conversation 
-        deleted_conversation = await cosmos_conversation_client.delete_conversation(user_id, conversation_id)
-
-        await cosmos_conversation_client.cosmosdb_client.close()
+        ## delete the conversation messages from cosmos, then the conversation
+        response = await run_history_job(
+            user_id,
+            "Conversation delete",
+            cosmos_conversation_client.delete_conversation_and_messages(user_id, conversation_id, int(AZURE_COSMOSDB_DELETE_CONCURRENCY)),
+            conversation_id=conversation_id
+        )
+        if response:
+            return response
 
         return jsonify({"message": "Successfully deleted conversation and messages", "conversation_id": conversation_id}), 200
     except Exception as e:
@@ -282,17 +510,27 @@ async def delete_conversation():
 
 async def list_conversations():
     offset = request.args.get("offset", 0)
+    # Clients that send a cursor, empty for the first page, get cursor pagination instead of offsets
+    cursor = request.args.get("cursor")
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user['user_principal_id']
 
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmos_conversation_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
+    if cursor is not None:
+        try:
+            continuation_token = decode_cursor(cursor)
+            conversations, continuation_token = await cosmos_conversation_client.get_conversations_page(user_id, limit=HISTORY_PAGE_SIZE, continuation_token=continuation_token)
+        except ValueError:
+            ## a cursor that does not decode, or whose token the history store rejects (InvalidContinuationTokenError)
+            return jsonify({"error": "Invalid cursor"}), 400
+        return jsonify({"conversations": conversations, "cursor": encode_cursor(continuation_token)}), 200
+
     ## get the conversations from cosmos
-    conversations = await cosmos_conversation_client.get_conversations(user_id, offset=offset, limit=25)
-    await cosmos_conversation_client.cosmosdb_client.close()
+    conversations = await cosmos_conversation_client.get_conversations(user_id, offset=offset, limit=HISTORY_PAGE_SIZE)
     if not isinstance(conversations, list):
         return jsonify({"error": f"No conversations for {user_id} were found"}), 404
 
@@ -313,36 +551,60 @@ async def get_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
     
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmos_conversation_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
 
+    # Clients that ask for a stream get NDJSON, optionally only the last limit messages with a cursor to the older ones
+    stream = request_json.get('stream', False)
+    limit = request_json.get('limit', None)
+    if limit is not None and (not isinstance(limit, int) or limit < 1):
+        return jsonify({"error": "limit must be a positive number"}), 400
+    try:
+        until = decode_cursor(request_json.get('cursor'))
+    except ValueError:
+        return jsonify({"error": "Invalid cursor"}), 400
+
     ## get the conversation object and the related messages from cosmos
     conversation = await cosmos_conversation_client.get_conversation(user_id, conversation_id)
     ## return the conversation id and the messages in the bot frontend format
     if not conversation:
         return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
+
+    if stream or limit or until:
+        pages, cursor = await cosmos_conversation_client.stream_messages(user_id, conversation_id, conversation=conversation, limit=limit, until=until, page_size=HISTORY_READ_PAGE_SIZE)
+        response = await make_response(format_as_ndjson(stream_history_messages(conversation_id, pages, cursor)))
+        response.timeout = None
+        response.mimetype = "application/json-lines"
+        return response
     
     # get the messages for the conversation from cosmos
-    conversation_messages = await cosmos_conversation_client.get_messages(user_id, conversation_id)
+    conversation_messages = await cosmos_conversation_client.get_messages(user_id, conversation_id, conversation=conversation)
         
     ## format the messages in the bot frontend format
-    messages = [
-        {
-            'id': msg['id'],
-            'role': msg['role'],
-            'content': msg['content'],
-            'createdAt': msg['createdAt'],
-            'feedback': msg.get('feedback'),
-            'hidden': msg.get('hidden')
-        }
-        for msg in conversation_messages
-    ]
-
-    await cosmos_conversation_client.cosmosdb_client.close()
+    messages = [format_history_message(msg) for msg in conversation_messages]
+
     return jsonify({"conversation_id": conversation_id, "messages": messages}), 200
 
 
+def format_history_message(msg):
+    return {
+        'id': msg['id'],
+        'role': msg['role'],
+        'content': msg['content'],
+        'createdAt': msg['createdAt'],
+        'feedback': msg.get('feedback'),
+        'hidden': msg.get('hidden')
+    }
+
+async def stream_history_messages(conversation_id, pages, cursor):
+    """The lines of a streamed /history/read: {"conversation_id", "cursor"} for the older messages, then a message per line, oldest first."""
+    yield {"conversation_id": conversation_id, "cursor": encode_cursor(cursor)}
+    async for page in pages:
+        for msg in page:
+            yield format_history_message(msg)
+
+
 
 async def rename_conversation():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
@@ -356,23 +618,22 @@ async def rename_conversation():
         return jsonify({"error": "conversation_id is required"}), 400
     
     ## make sure cosmos is configured
-    cosmos_conversation_client = init_cosmosdb_client()
+    cosmos_conversation_client = get_cosmos_conversation_client()
     if not cosmos_conversation_client:
         raise Exception("CosmosDB is not configured or not working")
     
-    ## get the conversation from cosmos
-    conversation = await cosmos_conversation_client.get_conversation(user_id, conversation_id)
-    if not conversation:
-        return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
-
-    ## update the title
     title = request_json.get("title", None)
     if not title:
         return jsonify({"error": "title is required"}), 400
-    conversation['title'] = title
-    updated_conversation = await cosmos_conversation_client.upsert_conversation(conversation)
 
-    await cosmos_conversation_client.cosmosdb_client.close()
+    ## patch the title in cosmos, only if the conversation is unchanged when the client sends the ETag it read
+    try:
+        updated_conversation = await cosmos_conversation_client.update_conversation_title(user_id, conversation_id, title, etag=request_json.get('etag'))
+    except PreconditionFailedError as e:
+        return jsonify({"error": str(e)}), 412
+    if not updated_conversation:
+        return jsonify({"error": f"Conversation {conversation_id} was not found. It either does not exist or the logged in user does not have access to it."}), 404
+
     return jsonify(updated_conversation), 200
 
 
@@ -381,25 +642,21 @@ async def delete_all_conversations():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user['user_principal_id']
 
-    # get conversations for user
+    # delete every conversation of the user
     try:
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
-        conversations = await cosmos_conversation_client.get_conversations(user_id, offset=0, limit=None)
-        if not conversations:
-            return jsonify({"error": f"No conversations for {user_id} were found"}), 404
-        
-        # delete each conversation
-        for conversation in conversations:
-            ## delete the conversation messages from cosmos first
-            deleted_messages = await cosmos_conversation_client.delete_messages(conversation['id'], user_id)
-
-            ## Now delete the conversation 
-            deleted_conversation = await cosmos_conversation_client.delete_conversation(user_id, conversation['id'])
-        await cosmos_conversation_client.cosmosdb_client.close()
+        response = await run_history_job(
+            user_id,
+            "Delete all conversations",
+            cosmos_conversation_client.delete_all_conversations(user_id, int(AZURE_COSMOSDB_DELETE_CONCURRENCY), by_partition_key=AZURE_COSMOSDB_DELETE_BY_PARTITION_KEY)
+        )
+        if response:
+            return response
+
         return jsonify({"message": f"Successfully deleted conversation and messages for user {user_id}"}), 200
     
     except Exception as e:
@@ -421,12 +678,19 @@ async def clear_messages():
             return jsonify({"error": "conversation_id is required"}), 400
         
         ## make sure cosmos is configured
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
         if not cosmos_conversation_client:
             raise Exception("CosmosDB is not configured or not working")
 
         ## delete the conversation messages from cosmos
-        deleted_messages = await cosmos_conversation_client.delete_messages(conversation_id, user_id)
+        response = await run_history_job(
+            user_id,
+            "Clear messages",
+            cosmos_conversation_client.delete_messages(conversation_id, user_id, int(AZURE_COSMOSDB_DELETE_CONCURRENCY)),
+            conversation_id=conversation_id
+        )
+        if response:
+            return response
 
         return jsonify({"message": "Successfully deleted messages in conversation", "conversation_id": conversation_id}), 200
     except Exception as e:
@@ -1,5 +1,7 @@
 import asyncio
+import hashlib
 import json
+import logging
 from typing import Dict, List
 
 from quart import jsonify, request
@@ -11,7 +13,8 @@ import tiktoken
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 
-from azure.storage.blob import BlobServiceClient
+from azure.core.exceptions import ResourceNotFoundError
+from azure.storage.blob import BlobServiceClient, ContentSettings
 from azure.search.documents.indexes.models import *
 from azure.core.credentials import AzureNamedKey
 from azure.core.credentials import AzureNamedKeyCredential
@@ -19,7 +22,7 @@ from azure.core.credentials import AzureNamedKeyCredential
 
 from langchain.schema import Document
 
-from backend.setup import AZURE_OPENAI_MODEL, AZURE_OPENAI_SYSTEM_MESSAGE, AZURE_STORAGE_ACCOUNT, AZURE_STORAGE_KEY, get_doc_from_azure_blob_storage, init_container_client, init_openai_client, init_search_client, init_vector_store
+from backend.setup import AZURE_OPENAI_MODEL, AZURE_OPENAI_SYSTEM_MESSAGE, AZURE_SEARCH_DELETE_BATCH_SIZE, AZURE_STORAGE_ACCOUNT, AZURE_STORAGE_BLOCK_CONCURRENCY, AZURE_STORAGE_KEY, AZURE_STORAGE_UPLOAD_CONCURRENCY, DOCUMENT_INDEX_BATCH_SIZE, DOCUMENT_INGESTION_CONCURRENCY, client_registry, get_cosmos_conversation_client, get_openai_client, init_search_client, init_vector_store
 from backend.utils import secure_filename
 
 def chunkString(text, chunk_size,overlap):
@@ -94,7 +97,7 @@ def merge_chunks(chunks, overlap=200):
 
 
 async def summarize_chunk(chunk: str, max_tokens: int, prompt = 'Produce a detailed summary of the following including all key concepts and takeaways, if it is a guide or a help piece make sure you include a summary of the main actionable steps:') -> str:
-    azure_openai_client = init_openai_client(use_data=False)
+    azure_openai_client = get_openai_client()
     response = await azure_openai_client.chat.completions.create(
         model=AZURE_OPENAI_MODEL,
         messages=[{'role': 'system', 'content': AZURE_OPENAI_SYSTEM_MESSAGE},
@@ -176,76 +179,173 @@ async def documentsummary():
         return jsonify({"error": f"Error reading document: {e}"}), 500
 
 
-async def handle_new_document(websocket, data):
-    encoding = tiktoken.get_encoding("cl100k_base")
-    abort_flag = False
+# Share of a file's ingestion done once it reaches each stage; indexing fills the rest in batches
+INGESTION_STAGES = {'downloading': 0.0, 'parsed': 0.3, 'counted': 0.4, 'split': 0.5, 'indexed': 1.0}
 
-    async def listen_for_abort():
-        nonlocal abort_flag
-        while not abort_flag:
-            data = await websocket.receive()
-            data = json.loads(data)
-            if data.get('command') == 'abort':
-                abort_flag = True
 
-    asyncio.create_task(listen_for_abort())
+def count_tokens(documents):
+    encoding = tiktoken.get_encoding("cl100k_base")
+    return sum(len(encoding.encode(document.page_content)) for document in documents)
+
+
+async def ingest_document(blob_name, url, container_name, vector_store, report):
+    """Downloads, parses, counts, splits and indexes one file, reporting each stage, and returns its result."""
+    blob_client = client_registry.get_blob_service_client().get_blob_client(container_name, blob_name)
+    await report(blob_name, 'downloading')
+    documents = await client_registry.get_document_loader().load(blob_client, blob_name)
+    if not documents:
+        raise Exception('Error getting document from Azure Blob Storage')
+    await report(blob_name, 'parsed')
+
+    num_tokens = await asyncio.to_thread(count_tokens, documents)
+    await blob_client.set_blob_metadata(metadata={'num_tokens': str(num_tokens)})
+    await report(blob_name, 'counted', numTokens=num_tokens)
+
+    joined_docs = await asyncio.to_thread(join_and_split_docs, documents)
+    texts, metadatas = add_metadata_to_docs(joined_docs, container_name, blob_name, url)
+    ## only the chunks are kept from here on
+    del documents, joined_docs
+    await record_documents(container_name, {blob_name: {'numTokens': num_tokens, 'chunks': len(texts), 'status': 'ingesting'}})
+    await report(blob_name, 'split', chunks=len(texts))
+
+    batch_size = int(DOCUMENT_INDEX_BATCH_SIZE)
+    for batch_start in range(0, len(texts), batch_size):
+        batch_end = batch_start + batch_size
+        batch = asyncio.ensure_future(asyncio.to_thread(vector_store.add_texts, texts[batch_start:batch_end], metadatas[batch_start:batch_end]))
+        try:
+            await asyncio.shield(batch)
+        except asyncio.CancelledError:
+            ## the batch carries on in its thread, let it land so its chunks can be deleted after it
+            await asyncio.gather(batch, return_exceptions=True)
+            raise
+        if batch_end < len(texts):
+            await report(blob_name, 'indexing', chunksIndexed=batch_end, chunks=len(texts))
+    await record_documents(container_name, {blob_name: {'status': 'ingested'}})
+    await report(blob_name, 'indexed', chunks=len(texts))
+    return {'filename': blob_name, 'status': 'ingested', 'numTokens': num_tokens, 'chunks': len(texts)}
 
-    list_of_lists = data['documents']
+
+async def handle_new_document(websocket, data):
+    """
+    Ingests the uploaded files DOCUMENT_INGESTION_CONCURRENCY at a time, each added to the search index as
+    soon as its chunks are ready. Sends a JSON event as each file reaches a stage, with the request's overall
+    progress, one for each file that fails, and a final one with the result of every file.
+    """
+    document_tuples = [tuple(item) for item in data['documents']]
     container_name = data['container']
-    document_tuples = [tuple(item) for item in list_of_lists]
+    progress = {blob_name: 0.0 for blob_name, _ in document_tuples}
+    semaphore = asyncio.Semaphore(int(DOCUMENT_INGESTION_CONCURRENCY))
+    tasks = []
 
-    all_texts = []
-    all_metadatas = []
-    for doc in document_tuples:
-        if abort_flag:
-            return
-        num_tokens = 0
-        blob_name, url = doc
+    async def send(event):
+        event['progress'] = round(sum(progress.values()) / max(len(progress), 1), 3)
+        try:
+            await websocket.send(json.dumps(event))
+        except Exception as ex:
+            ## the client went away, ingestion carries on and the catalog has the outcome
+            logging.debug(f"Unable to send ingestion progress: {ex}")
+
+    async def report(blob_name, stage, **fields):
+        if stage == 'indexing':
+            done = INGESTION_STAGES['split']
+            progress[blob_name] = done + (1 - done) * fields['chunksIndexed'] / fields['chunks']
+        else:
+            progress[blob_name] = INGESTION_STAGES[stage]
+        await send({'type': 'progress', 'filename': blob_name, 'stage': stage, **fields})
 
-        documents = get_doc_from_azure_blob_storage(blob_name, container_name)
-        if not documents:
-            raise Exception('Error getting document from Azure Blob Storage')
-        await websocket.send('3')
-        if abort_flag:
-            return
+    async def discard(blob_name, status):
+        """Records a file that was not ingested and deletes any of its chunks already in the index."""
+        if progress[blob_name] >= INGESTION_STAGES['split']:
+            try:
+                await delete_file_chunks(client_registry.get_search_client(), container_name, blob_name)
+            except Exception:
+                logging.exception(f"Unable to delete the indexed chunks of {blob_name}")
+        await record_documents(container_name, {blob_name: {'status': status}})
+        progress[blob_name] = 1.0
 
-        for document in documents:
-            num_tokens += len(encoding.encode(document.page_content))
+    async def ingest(blob_name, url):
+        try:
+            async with semaphore:
+                return await ingest_document(blob_name, url, container_name, vector_store, report)
+        except asyncio.CancelledError:
+            await discard(blob_name, 'aborted')
+            raise
+        except Exception as ex:
+            logging.exception(f"Ingesting {blob_name} failed")
+            await discard(blob_name, 'failed')
+            await send({'type': 'file_error', 'filename': blob_name, 'error': str(ex)})
+            return {'filename': blob_name, 'status': 'failed', 'error': str(ex)}
 
-        container_client = init_container_client(container_name)
-        blob_client = container_client.get_blob_client(blob_name)
-        blob_client.set_blob_metadata(metadata={'num_tokens': str(num_tokens)})
-        await websocket.send('4')
-        if abort_flag:
-            return
-        joined_docs = join_and_split_docs(documents)
-        texts, metadatas = add_metadata_to_docs(joined_docs, container_name, blob_name, url)
-        await websocket.send('5')
-        if abort_flag:
-            return
-        all_texts.extend(texts)
-        all_metadatas.extend(metadatas)
-    vector_store = init_vector_store()
-    await websocket.send('6')
-    if abort_flag:
-        return
-    print(f"Adding {len(all_texts)} documents to the search index")
-    print(all_metadatas)
-    vector_store.add_texts(all_texts, all_metadatas)
-    await websocket.send('7')
-    if abort_flag:
+    async def listen_for_abort():
+        while True:
+            try:
+                message = json.loads(await websocket.receive())
+            except Exception:
+                ## the client went away or sent something else, ingestion carries on
+                return
+            if message.get('command') == 'abort':
+                for task in tasks:
+                    task.cancel()
+                return
+
+    vector_store = await asyncio.to_thread(init_vector_store)
+    listener = asyncio.create_task(listen_for_abort())
+    try:
+        tasks.extend(asyncio.create_task(ingest(blob_name, url)) for blob_name, url in document_tuples)
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        listener.cancel()
+    if any(isinstance(result, asyncio.CancelledError) for result in results):
+        print("Ingestion aborted")
         return
+    results = [
+        result if isinstance(result, dict) else {'filename': blob_name, 'status': 'failed', 'error': str(result)}
+        for result, (blob_name, _) in zip(results, document_tuples)
+    ]
+    if document_tuples and all(result['status'] == 'failed' for result in results):
+        raise Exception(results[0]['error'])
     print(f"Documents added to the search index.")
-    if abort_flag:
-        return
-    await websocket.send(f"done: Documents added to the search index")
+    await send({'type': 'done', 'results': results})
+
 
+ALLOWED_UPLOAD_EXTENSIONS = {'.pdf', '.docx', '.txt', '.csv'}
+HASH_BLOCK_SIZE = 1024 * 1024
+
+def hash_stream(stream):
+    """The MD5 digest and size of a file, read in blocks, leaving the stream at its start."""
+    digest = hashlib.md5()
+    size = 0
+    for block in iter(lambda: stream.read(HASH_BLOCK_SIZE), b""):
+        digest.update(block)
+        size += len(block)
+    stream.seek(0)
+    return digest.digest(), size
+
+
+async def upload_file(container_client, filename, doc, semaphore):
+    """Uploads one file, in blocks sent in parallel when it is large, and returns its result."""
+    async with semaphore:
+        try:
+            digest, size = await asyncio.to_thread(hash_stream, doc.stream)
+            blob_client = container_client.get_blob_client(filename)
+            await blob_client.upload_blob(
+                doc.stream,
+                overwrite=True,
+                max_concurrency=int(AZURE_STORAGE_BLOCK_CONCURRENCY),
+                # Kept on the blob, so a catalog rebuilt from the blobs has the hash too
+                content_settings=ContentSettings(content_md5=bytearray(digest))
+            )
+            print(f"Successfully uploaded {filename} at location {blob_client.url}.")
+            return {"filename": filename, "url": blob_client.url, "uploaded": True, "size": size, "contentHash": digest.hex()}
+        except Exception as e:
+            print(f"Uploading {filename} failed. Exception: {e}")
+            logging.exception(f"Uploading {filename} failed")
+            return {"filename": filename, "uploaded": False, "error": str(e)}
 
 
 async def upload_documents():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     storage_container_name = authenticated_user['user_principal_id']
-    uploadedFiles = []
     try:
         files = await request.files
         if 'file' not in files:
@@ -257,6 +357,8 @@ async def upload_documents():
             print("No files selected for uploading")
             return jsonify({"error": "No files selected for uploading"}), 400
         
+        ## check every file before uploading any
+        uploads = []
         for doc in file_storage_list:
 
             original_filename = doc.filename
@@ -265,109 +367,187 @@ async def upload_documents():
             if not sanitized_filename or '..' in sanitized_filename or '/' in sanitized_filename or '\\' in sanitized_filename:
                 return jsonify({"error": f"Invalid filename: {original_filename}"}), 400
                 
-            allowed_extensions = {'.pdf', '.docx', '.txt', '.csv'}
-            if not any(sanitized_filename.lower().endswith(ext) for ext in allowed_extensions):
+            if not any(sanitized_filename.lower().endswith(ext) for ext in ALLOWED_UPLOAD_EXTENSIONS):
                 return jsonify({"error": f"Unsupported file type: {original_filename}"}), 400
-            
-            storage_account_url = f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net/"
-
-            blob_service_client = BlobServiceClient(
-                account_url=storage_account_url, 
-                credential=AZURE_STORAGE_KEY
-            )
-
-            container_client = blob_service_client.get_container_client(storage_container_name)
-            
-            try:
-                container_client.create_container()
-                print(f"Container '{storage_container_name}' created.")
-            except Exception as e:
-                if "ContainerAlreadyExists" in str(e):
-                    print(f"Container '{storage_container_name}' already exists.")
-                else:
-                    print(f"Error creating container: {e}")
-                    raise e
-            print('Container created')
-            blob_client = blob_service_client.get_blob_client(
-                container=storage_container_name,
-                blob=sanitized_filename
-            )
-            print('Getting blob client')
-            blob_client.upload_blob(doc.stream, overwrite=True)
-            print('Uploading blob')
-            uploadedFiles.append((sanitized_filename, blob_client.url))
-            print(f"Successfully uploaded {sanitized_filename} at location {blob_client.url}.")
-        return jsonify({"Documents": uploadedFiles}, 200)
+            uploads.append((sanitized_filename, doc))
+
+        container_client = await client_registry.ensure_blob_container(storage_container_name)
+        semaphore = asyncio.Semaphore(int(AZURE_STORAGE_UPLOAD_CONCURRENCY))
+        results = await asyncio.gather(*[upload_file(container_client, filename, doc, semaphore) for filename, doc in uploads])
+
+        uploadedFiles = [(result["filename"], result["url"]) for result in results if result["uploaded"]]
+        ## a new upload replaces the file, so what was known of its ingestion no longer holds
+        await record_documents(storage_container_name, {
+            result["filename"]: {"size": result.pop("size"), "contentHash": result.pop("contentHash"), "status": "uploaded", "numTokens": None, "chunks": None}
+            for result in results if result["uploaded"]
+        })
+        if not uploadedFiles:
+            return jsonify({"error": f"Uploading Documents failed. Exception: {results[0]['error']}", "Results": results}), 500
+        ## the frontend reads the documents from the first element of this array
+        return jsonify({"Documents": uploadedFiles, "Results": results}, 200)
     except Exception as ex:
         print(f"Uploading Documents failed. Exception: {ex}")
-        return jsonify({"error": f"Uploading Documents failed. Exception: {ex}"}, 500)
+        return jsonify({"error": f"Uploading Documents failed. Exception: {ex}"}), 500
+
+
+async def list_document_blobs(user_id):
+    """The user's blobs with their metadata, in one listing."""
+    container_client = client_registry.get_blob_service_client().get_container_client(user_id)
+    try:
+        return [blob async for blob in container_client.list_blobs(include=['metadata'])]
+    except ResourceNotFoundError:
+        ## nothing uploaded yet
+        return []
+
+
+def catalog_entries_from_blobs(blobs):
+    """Catalog entries of blobs listed with their metadata, for documents uploaded before the catalog."""
+    entries = {}
+    for blob in blobs:
+        metadata = blob.metadata or {}
+        entry = {'size': blob.size, 'status': 'ingested' if 'num_tokens' in metadata else 'uploaded'}
+        if 'num_tokens' in metadata:
+            entry['numTokens'] = int(metadata['num_tokens'])
+        if blob.content_settings and blob.content_settings.content_md5:
+            entry['contentHash'] = bytes(blob.content_settings.content_md5).hex()
+        entries[blob.name] = entry
+    return entries
+
+
+async def backfill_document_catalog(history_client, user_id, blobs = None):
+    """Adds the user's blobs that are missing from their catalog, creating it if needed, and returns how many were added."""
+    if blobs is None:
+        blobs = await list_document_blobs(user_id)
+    catalog = await history_client.get_document_catalog(user_id)
+    missing = {filename: entry for filename, entry in catalog_entries_from_blobs(blobs).items() if filename not in (catalog or {})}
+    if missing or catalog is None:
+        await history_client.update_document_catalog(user_id, missing)
+    return len(missing)
+
+
+async def record_documents(user_id, updates = None, removals = (), blobs = None):
+    """
+    Records changes to the user's documents in their catalog, building it from their blobs first if they
+    have none. Failures are only logged: the blobs stay the source of truth and the catalog can be rebuilt.
+    """
+    history_client = get_cosmos_conversation_client()
+    if not history_client:
+        return
+    try:
+        if await history_client.get_document_catalog(user_id) is None:
+            await backfill_document_catalog(history_client, user_id, blobs)
+        if updates or removals:
+            await history_client.update_document_catalog(user_id, updates, removals)
+    except Exception:
+        logging.exception(f"Unable to update the document catalog of {user_id}")
 
 
 async def get_documents():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
     user_id = authenticated_user['user_principal_id']
-    container_client = init_container_client(user_id)
     try:
-        blob_list = container_client.list_blob_names()
-        filenames_with_counts = {} 
-        for blob in blob_list:
-            blob_client = container_client.get_blob_client(blob)
-            filenames_with_counts[blob] = blob_client.get_blob_properties().metadata['num_tokens']
-            print('Blob name: ' + blob + ' Number of tokens: ' + filenames_with_counts[blob])
+        history_client = get_cosmos_conversation_client()
+        catalog = await history_client.get_document_catalog(user_id) if history_client else None
+        if catalog is None:
+            ## no catalog yet, list the blobs once and build it from them behind the request
+            blobs = await list_document_blobs(user_id)
+            catalog = catalog_entries_from_blobs(blobs)
+            if history_client:
+                client_registry.run_in_background(record_documents(user_id, blobs=blobs))
+
+        filenames_with_counts = {filename: str(entry.get('numTokens', 0)) for filename, entry in catalog.items()}
         print(f"Successfully retrieved documents: {filenames_with_counts}")
-
-        ### If storage is not being used the data can be retrieved from the search index ###
-
-        # search_client = init_search_client()
-        # search_results = search_client.search(
-        #     search_text=user_id,
-        #     search_fields=["user_id"],
-        #     facets=["filename"],  # Using facets to get unique filenames
-        #     top=0,  # We don't need the actual documents, just the facets
-        #     include_total_count=True
-        # )
-        # facet_results = search_results.get_facets()
-        # print(facet_results)
-        # if 'filename' in facet_results:
-        #     filenames_with_counts = {facet['value']: str(facet['count']) for facet in facet_results['filename'][:10]}
-        # else:
-        #     filenames_with_counts = {}
-        # print(f"successfully retrieved documents from search index:{filenames_with_counts}")
-
-
         return jsonify(filenames_with_counts), 200
     except Exception as ex:
         print(f"Failed to get documents. Exception: {ex}")
         return jsonify({"error": f"Failed to get documents. Exception: {ex}"}), 500
 
 
+# Azure AI Search refuses a $skip above this
+MAX_SEARCH_SKIP = 100000
+
+
+def odata_string(value):
+    """Quotes a value for an OData filter."""
+    return "'" + value.replace("'", "''") + "'"
+
+
+async def search_chunk_ids(search_client, user_id, filename):
+    """
+    The keys of the file's chunks in the search index, found with an exact filter a batch at a time.
+    Pages are ordered by key, as every hit of a "*" search scores the same and would come back in any
+    order. Stops at the most the index lets a search skip; the caller searches again after deleting.
+    """
+    batch_size = int(AZURE_SEARCH_DELETE_BATCH_SIZE)
+    ids = []
+    while len(ids) < MAX_SEARCH_SKIP:
+        results = await search_client.search(
+            search_text="*",
+            filter=f"user_id eq {odata_string(user_id)} and filename eq {odata_string(filename)}",
+            select=["id"],
+            order_by=["id"],
+            top=batch_size,
+            skip=len(ids)
+        )
+        page = [result['id'] async for result in results]
+        ids += page
+        if len(page) < batch_size:
+            break
+    return ids
+
+
+async def delete_file_chunks(search_client, user_id, filename):
+    """Deletes the file's chunks from the search index in batches and returns how many were deleted."""
+    batch_size = int(AZURE_SEARCH_DELETE_BATCH_SIZE)
+    deleted = 0
+    while True:
+        ids = await search_chunk_ids(search_client, user_id, filename)
+        batches = [ids[i:i + batch_size] for i in range(0, len(ids), batch_size)]
+        results = await asyncio.gather(*[search_client.delete_documents(documents=[{"id": id} for id in batch]) for batch in batches])
+        failed = [result.key for batch_results in results for result in batch_results if not result.succeeded]
+        if failed:
+            raise Exception(f"{len(failed)} of {len(ids)} chunks were not deleted")
+        deleted += len(ids)
+        if len(ids) < MAX_SEARCH_SKIP:
+            return deleted
+
+
+async def delete_file(container_client, search_client, user_id, filename):
+    """Deletes the file's blob and its chunks at once, and reports the outcome of each."""
+    print(f"Deleting {filename}")
+    blob_result, chunks_result = await asyncio.gather(
+        container_client.delete_blob(filename),
+        delete_file_chunks(search_client, user_id, filename),
+        return_exceptions=True
+    )
+    result = {"filename": filename, "blobDeleted": True, "chunksDeleted": 0}
+    if isinstance(blob_result, ResourceNotFoundError):
+        result["blobDeleted"] = False
+    elif isinstance(blob_result, Exception):
+        print(f"Failed to delete {filename} from storage. Exception: {blob_result}")
+        result["blobDeleted"] = False
+        result["error"] = str(blob_result)
+    if isinstance(chunks_result, Exception):
+        print(f"Failed to delete {filename} from search index. Exception: {chunks_result}")
+        result["error"] = str(chunks_result)
+    else:
+        result["chunksDeleted"] = chunks_result
+        print(f"Deleted {chunks_result} chunks of {filename} from search index")
+    return result
+
+
 async def delete_documents():
     authenticated_user = get_authenticated_user_details(request_headers=request.headers)
-    container_client = init_container_client(authenticated_user['user_principal_id'])
+    user_id = authenticated_user['user_principal_id']
     request_json = await request.get_json()
     requested_blobs = request_json.get('filenames', [])
     try:
-        search_client = init_search_client()
-        blob_list = container_client.list_blob_names()
-        for blob in requested_blobs:
-            print(f"Deleting {blob}")
-
-            try:
-                container_client.delete_blob(blob)
-            except Exception as ex:
-                print(f"Failed to delete {blob} from storage. Exception: {ex}")
-            try:
-                results = search_client.search(search_text=blob, search_fields=["filename"])
-                for doc in results:
-                    print(doc['id'])
-                    if doc['filename'] == blob:
-                        search_client.delete_documents(documents=[{"id": doc['id']}])
-                        print(f"Deleted {doc['id']} from search index")
-                    else:
-                       Exception('Document not found in search index')
-            except Exception as ex:
-                print(f"Failed to delete {blob} from search index. Exception: {ex}")
-        return jsonify({"success": "All documents deleted"}), 200
+        container_client = client_registry.get_blob_service_client().get_container_client(user_id)
+        search_client = client_registry.get_search_client()
+        results = await asyncio.gather(*[delete_file(container_client, search_client, user_id, blob) for blob in requested_blobs])
+        ## a file whose blob or chunks are still there stays in the catalog
+        await record_documents(user_id, removals=[result["filename"] for result in results if "error" not in result])
+        return jsonify({"success": "All documents deleted", "Results": results}), 200
     except Exception as ex:
         return jsonify({"error": f"Failed to delete documents. Exception: {ex}"}), 500
 
@@ -419,7 +599,7 @@ async def ingest_all_docs_from_storage():
         container_client = blob_service_client.get_container_client(container.name)
         blob_list = container_client.list_blob_names()        
         for blob in blob_list:
-            docs = get_doc_from_azure_blob_storage(blob, container.name)
+            docs = await client_registry.get_document_loader().load(client_registry.get_blob_service_client().get_blob_client(container.name, blob), blob)
             joined_docs = join_and_split_docs(docs)
             texts, metadatas = add_metadata_to_docs(joined_docs, container.name, blob, blob)
             init_vector_store().add_texts(texts, metadatas)
@@ -0,0 +1,107 @@
+import asyncio
+import csv
+import io
+import logging
+import multiprocessing
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain.schema import Document
+
+try:
+    import resource
+except ImportError:
+    # No address space limits outside Unix; parsers there are only bounded by recycling
+    resource = None
+
+# Parsers run in spawned processes that import this module only, so it stays clear of backend.setup
+SUPPORTED_EXTENSIONS = ('.pdf', '.txt', '.docx', '.csv')
+
+
+def limit_memory(memory_limit):
+    """Runs in each parser process: a parse that needs more than memory_limit bytes fails with MemoryError."""
+    if memory_limit and resource:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, memory_limit))
+
+
+def parse_csv(stream, blob_name):
+    """One document per row, as the CSVLoader makes them."""
+    documents = []
+    for i, row in enumerate(csv.DictReader(io.TextIOWrapper(stream, encoding="utf-8", newline=""))):
+        content = "\n".join(
+            f"{k.strip() if k is not None else k}: {v.strip() if isinstance(v, str) else ','.join(map(str.strip, v)) if isinstance(v, list) else v}"
+            for k, v in row.items()
+        )
+        documents.append(Document(page_content=content, metadata={"source": blob_name, "row": i}))
+    return documents
+
+
+def parse_document(blob_name, data = None, path = None):
+    """
+    Parses a PDF, TXT, DOCX or CSV file held in memory (data) or in a temporary file (path) into
+    documents, the way the LangChain file loaders do. CPU bound, so it runs in the parser processes.
+    """
+    extension = os.path.splitext(blob_name)[1].lower()
+    if extension not in SUPPORTED_EXTENSIONS:
+        raise ValueError(f"Unsupported file type: {blob_name}")
+
+    with (io.BytesIO(data) if path is None else open(path, "rb")) as stream:
+        if extension == '.pdf':
+            import pypdf
+            reader = pypdf.PdfReader(stream)
+            return [Document(page_content=page.extract_text(), metadata={"source": blob_name, "page": number}) for number, page in enumerate(reader.pages)]
+        if extension == '.docx':
+            import docx2txt
+            return [Document(page_content=docx2txt.process(stream), metadata={"source": blob_name})]
+        if extension == '.csv':
+            return parse_csv(stream, blob_name)
+        return [Document(page_content=stream.read().decode("utf-8"), metadata={"source": blob_name})]
+
+
+class DocumentLoader():
+    """
+    Loads documents from blob storage without blocking the event loop. A blob is streamed into memory,
+    or into a temporary file when it is larger than in_memory_limit, and parsed in a pool of processes.
+
+    Loads beyond the number of processes wait before downloading, so at most that many files are held at
+    once. Each process is limited to memory_limit bytes and is replaced after max_tasks_per_child parses,
+    handing back whatever the parsers' allocations left behind.
+    """
+
+    def __init__(self, processes = 2, in_memory_limit = 32 * 1024 * 1024, memory_limit = None, max_tasks_per_child = 10, block_concurrency = 4):
+        self.in_memory_limit = in_memory_limit
+        self.block_concurrency = block_concurrency
+        self.semaphore = asyncio.Semaphore(processes)
+        self.executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=limit_memory,
+            initargs=(memory_limit,),
+            max_tasks_per_child=max_tasks_per_child
+        )
+
+    async def load(self, blob_client, blob_name):
+        """The documents of a blob, parsed in the process pool."""
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            downloader = await blob_client.download_blob(max_concurrency=self.block_concurrency)
+            if downloader.size <= self.in_memory_limit:
+                buffer = bytearray()
+                async for chunk in downloader.chunks():
+                    buffer += chunk
+                return await loop.run_in_executor(self.executor, parse_document, blob_name, bytes(buffer))
+
+            ## too large to hold in memory, spool it to disk and let the parser read it from there
+            handle = tempfile.NamedTemporaryFile(suffix=os.path.splitext(blob_name)[1], delete=False)
+            try:
+                with handle:
+                    async for chunk in downloader.chunks():
+                        await asyncio.to_thread(handle.write, chunk)
+                return await loop.run_in_executor(self.executor, parse_document, blob_name, None, handle.name)
+            finally:
+                os.remove(handle.name)
+
+    async def close(self):
+        logging.debug("Shutting down the document parser processes")
+        await asyncio.to_thread(self.executor.shutdown, cancel_futures=True)
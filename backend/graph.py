@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+import httpx
+
+GRAPH_MEMBER_OF_URL = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
+
+
+class GroupCacheEntry():
+    def __init__(self, group_ids, filter_string):
+        self.group_ids = group_ids
+        self.filter_string = filter_string
+        self.fetched_at = time.monotonic()
+
+
+class GraphGroupResolver():
+    """
+    Resolves a user's transitive group memberships from Microsoft Graph for document-level access control.
+
+    Results, and the search.in filter built from them, are cached per user for ttl seconds.
+    Once an entry is older than refresh_after seconds it is still served, but a background
+    task fetches a fresh copy so active users never wait on Graph. Concurrent lookups for the
+    same user share one request.
+    """
+
+    def __init__(self, permitted_groups_column: str, ttl: float = 900, refresh_after: float = None, max_entries: int = 10000, http_client=None):
+        self.permitted_groups_column = permitted_groups_column
+        self.ttl = ttl
+        self.refresh_after = refresh_after if refresh_after is not None else ttl * 0.8
+        self.max_entries = max_entries
+        self.http_client = http_client
+        self._entries = OrderedDict()
+        self._in_flight = {}
+
+    def get_http_client(self):
+        if not self.http_client:
+            self.http_client = httpx.AsyncClient(timeout=10)
+        return self.http_client
+
+    async def fetch_group_ids(self, user_token):
+        """Walks every page of the user's memberships. Returns None if Graph could not be read."""
+        headers = {
+            'Authorization': "bearer " + user_token
+        }
+        group_ids = []
+        endpoint = GRAPH_MEMBER_OF_URL
+        try:
+            while endpoint:
+                r = await self.get_http_client().get(endpoint, headers=headers)
+                if r.status_code != 200:
+                    logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
+                    return None
+                r = r.json()
+                group_ids.extend(obj['id'] for obj in r.get('value', []))
+                endpoint = r.get("@odata.nextLink")
+        except Exception as e:
+            logging.error(f"Exception in fetch_group_ids: {e}")
+            return None
+        return group_ids
+
+    def build_filter_string(self, group_ids):
+        if not group_ids:
+            logging.debug("No user groups found")
+        return f"{self.permitted_groups_column}/any(g:search.in(g, '{', '.join(group_ids)}'))"
+
+    async def _refresh(self, user_id, user_token):
+        group_ids = await self.fetch_group_ids(user_token)
+        if group_ids is None:
+            # Failures are not cached, the next request tries Graph again
+            return GroupCacheEntry([], self.build_filter_string([]))
+
+        entry = GroupCacheEntry(group_ids, self.build_filter_string(group_ids))
+        self._entries[user_id] = entry
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def _start_refresh(self, user_id, user_token):
+        task = self._in_flight.get(user_id)
+        if not task:
+            task = asyncio.ensure_future(self._refresh(user_id, user_token))
+            self._in_flight[user_id] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(user_id, None))
+        return task
+
+    async def get_entry(self, user_id, user_token):
+        entry = self._entries.get(user_id)
+        if entry:
+            age = time.monotonic() - entry.fetched_at
+            if age < self.ttl:
+                self._entries.move_to_end(user_id)
+                if age >= self.refresh_after:
+                    self._start_refresh(user_id, user_token)
+                return entry
+        # shield so a cancelled request does not cancel a lookup other requests are waiting on
+        return await asyncio.shield(self._start_refresh(user_id, user_token))
+
+    async def get_group_ids(self, user_id, user_token):
+        return (await self.get_entry(user_id, user_token)).group_ids
+
+    async def get_filter_string(self, user_id, user_token):
+        return (await self.get_entry(user_id, user_token)).filter_string
+
+    async def close(self):
+        for task in list(self._in_flight.values()):
+            task.cancel()
+        if self.http_client:
+            await self.http_client.aclose()
+            self.http_client = None
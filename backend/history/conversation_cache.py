@@ -0,0 +1,85 @@
+import time
+from collections import OrderedDict
+
+
+class CachedConversation():
+    def __init__(self, conversation, messages=None):
+        self.conversation = conversation
+        self.messages = messages
+        self.cached_at = time.monotonic()
+
+    @property
+    def etag(self):
+        return self.conversation.get('_etag')
+
+
+class ConversationCache():
+    """
+    Per-worker LRU of conversation documents and their message lists, keyed by user and conversation.
+
+    A cached conversation is revalidated with an ETag point read, and its message list is only
+    served while the conversation's ETag is unchanged: every message write also touches the
+    conversation, so a new ETag means the messages may have changed. Writes made through
+    CosmosConversationClient update the cache so this worker never serves its own stale data.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def get(self, user_id, conversation_id):
+        key = (user_id, conversation_id)
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        if time.monotonic() - entry.cached_at > self.ttl:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def set_conversation(self, user_id, conversation, keep_messages=False):
+        key = (user_id, conversation['id'])
+        entry = self._entries.get(key)
+        messages = entry.messages if entry and keep_messages else None
+        self._entries[key] = CachedConversation(conversation, messages)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def set_messages(self, user_id, conversation_id, etag, messages):
+        entry = self._entries.get((user_id, conversation_id))
+        # Only if nothing has changed the conversation since the messages were read
+        if entry and etag and entry.etag == etag:
+            entry.messages = messages
+
+    def add_messages(self, user_id, conversation, messages, new_conversation=False):
+        """
+        Records messages written to a conversation, given the conversation document as it is after the write.
+        Writes to a conversation whose messages are cached are conditional on its cached ETag (see
+        CosmosConversationClient.conversation_patch), so the extended list is complete.
+        """
+        entry = self.get(user_id, conversation['id'])
+        if new_conversation:
+            cached_messages = []
+        else:
+            cached_messages = entry.messages if entry else None
+        self.set_conversation(user_id, conversation)
+        if cached_messages is not None:
+            written = {message['id'] for message in messages}
+            self._entries[(user_id, conversation['id'])].messages = [message for message in cached_messages if message['id'] not in written] + list(messages)
+
+    def update_message(self, user_id, conversation, message):
+        entry = self.get(user_id, conversation['id'])
+        cached_messages = entry.messages if entry else None
+        self.set_conversation(user_id, conversation)
+        if cached_messages is not None:
+            self._entries[(user_id, conversation['id'])].messages = [message if cached['id'] == message['id'] else cached for cached in cached_messages]
+
+    def discard(self, user_id, conversation_id):
+        self._entries.pop((user_id, conversation_id), None)
+
+    def discard_user(self, user_id):
+        for key in [key for key in self._entries if key[0] == user_id]:
+            del self._entries[key]
@@ -1,18 +1,67 @@
-import uuid
+import asyncio
+import json
 from datetime import datetime
+from azure.core import MatchConditions
 from azure.cosmos.aio import CosmosClient
 from azure.cosmos import exceptions
+from backend.history.conversation_cache import ConversationCache
+from backend.history.historyservice import HistoryClient, InvalidContinuationTokenError, PreconditionFailedError, iterate_pages, merge_document_catalog, message_window
+from backend.history.telemetry import CosmosTelemetry, OperationMetrics, cosmos_operation
+
+# The fields the conversation list shows
+CONVERSATION_LIST_FIELDS = "c.id, c.title, c.createdAt, c.updatedAt"
+# Most operations CosmosDB accepts in one transactional batch
+MAX_BATCH_OPERATIONS = 100
+# Most operations CosmosDB accepts in one patch
+MAX_PATCH_OPERATIONS = 10
+# Messages are stored either as one item each, or packed into bucket items of up to bucket_size messages
+MESSAGE_LAYOUTS = ('items', 'buckets')
+DEFAULT_BUCKET_SIZE = 50
+# A bucket is closed early once its messages reach this size, well under CosmosDB's 2 MB item limit
+MAX_BUCKET_BYTES = 1500000
+# Times a bucketed write is retried when another write moved the conversation on first
+MAX_BUCKET_WRITE_ATTEMPTS = 5
+# Writes of message items only apply to conversations that have not been moved to buckets
+ITEMS_LAYOUT_PREDICATE = "FROM c WHERE NOT IS_DEFINED(c.latestBucket)"
+# The item holding a user's document catalog, in their partition
+DOCUMENT_CATALOG_ID = 'document-catalog'
+# Times a catalog update is merged again when another update changed the catalog first
+MAX_CATALOG_WRITE_ATTEMPTS = 5
+# Feedback patches only apply to message items, whatever id the caller sent
+MESSAGE_PREDICATE = "FROM c WHERE c.type = 'message'"
+
+
+def catalog_partition(user_id):
+    """
+    Document catalogs live in their own partition rather than the user's history partition, so clearing
+    the chat history (dropping the partition with delete_all_items_by_partition_key) leaves them alone.
+    """
+    return f"documents:{user_id}"
+
+def is_bucketed(conversation):
+    return 'latestBucket' in conversation
+
+def bucket_id(conversation_id, index):
+    return f"{conversation_id}-bucket-{index}"
   
-class CosmosConversationClient():
+class CosmosConversationClient(HistoryClient):
     
-    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False):
+    def __init__(self, cosmosdb_endpoint: str, credential: any, database_name: str, container_name: str, enable_message_feedback: bool = False, cosmosdb_client: CosmosClient = None, cache: ConversationCache = None, message_layout: str = 'items', bucket_size: int = DEFAULT_BUCKET_SIZE, telemetry: CosmosTelemetry = None):
+        if message_layout not in MESSAGE_LAYOUTS:
+            raise ValueError(f"Invalid message layout {message_layout}, expected one of {', '.join(MESSAGE_LAYOUTS)}")
         self.cosmosdb_endpoint = cosmosdb_endpoint
         self.credential = credential
         self.database_name = database_name
         self.container_name = container_name
         self.enable_message_feedback = enable_message_feedback
+        self.cache = cache
+        self.message_layout = message_layout
+        self.bucket_size = bucket_size
+        self.telemetry = telemetry
+        self.owns_cosmosdb_client = cosmosdb_client is None
         try:
-            self.cosmosdb_client = CosmosClient(self.cosmosdb_endpoint, credential=credential)
+            # Clients for containers in the same account can share one CosmosClient and its connections
+            self.cosmosdb_client = cosmosdb_client or CosmosClient(self.cosmosdb_endpoint, credential=credential)
         except exceptions.CosmosHttpResponseError as e:
             if e.status_code == 401:
                 raise ValueError("Invalid credentials") from e
@@ -28,6 +77,8 @@ class CosmosConversationClient():
             self.container_client = self.database_client.get_container_client(container_name)
         except exceptions.CosmosResourceNotFoundError:
             raise ValueError("Invalid CosmosDB container name")
+        if telemetry:
+            self.container_client = telemetry.instrument(self.container_client, container_name)
                 
 
     async def ensure(self):
@@ -46,15 +97,21 @@ class CosmosConversationClient():
             
         return True, "CosmosDB client initialized successfully"
 
+    async def close(self):
+        ## a shared CosmosClient is closed by its owner
+        if self.owns_cosmosdb_client:
+            await self.cosmosdb_client.close()
+
+    def build_conversation(self, user_id, title = '', conversation_id = None):
+        conversation = super().build_conversation(user_id, title, conversation_id)
+        if self.message_layout == 'buckets':
+            ## the latest bucket does not exist until the first message is written
+            conversation.update({'latestBucket': 0, 'latestBucketMessages': 0, 'latestBucketBytes': 0})
+        return conversation
+
+    @cosmos_operation
     async def create_conversation(self, user_id, title = ''):
-        conversation = {
-            'id': str(uuid.uuid4()),  
-            'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
-            'userId': user_id,
-            'title': title
-        }
+        conversation = self.build_conversation(user_id, title)
         ## TODO: add some error handling based on the output of the upsert_item call
         resp = await self.container_client.upsert_item(conversation)  
         if resp:
@@ -62,15 +119,9 @@ class CosmosConversationClient():
         else:
             return False
         
+    @cosmos_operation
     async def create_log_conversation(self, user_id, conversation_id, title = ''):
-        conversation = {
-            'id': conversation_id,  
-            'type': 'conversation',
-            'createdAt': datetime.utcnow().isoformat(),  
-            'updatedAt': datetime.utcnow().isoformat(),  
-            'userId': user_id,
-            'title': title
-        }
+        conversation = self.build_conversation(user_id, title, conversation_id)
         ## TODO: add some error handling based on the output of the upsert_item call
         resp = await self.container_client.upsert_item(conversation)  
         if resp:
@@ -78,14 +129,47 @@ class CosmosConversationClient():
         else:
             return False
     
+    @cosmos_operation
     async def upsert_conversation(self, conversation):
         resp = await self.container_client.upsert_item(conversation)
         if resp:
+            if self.cache:
+                self.cache.set_conversation(conversation['userId'], resp)
             return resp
         else:
             return False
 
+    async def set_conversation_fields(self, user_id, conversation_id, fields, etag = None):
+        options = {'etag': etag, 'match_condition': MatchConditions.IfNotModified} if etag else {}
+        try:
+            resp = await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': f'/{field}', 'value': value} for field, value in fields.items()],
+                **options
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            if self.cache:
+                self.cache.discard(user_id, conversation_id)
+            return False
+        except exceptions.CosmosAccessConditionFailedError:
+            raise PreconditionFailedError(f"Conversation {conversation_id} has changed since it was read")
+        if self.cache:
+            self.cache.set_conversation(user_id, resp)
+        return resp
+
+    @cosmos_operation
+    async def update_conversation_title(self, user_id, conversation_id, title, etag = None):
+        return await self.set_conversation_fields(user_id, conversation_id, {'title': title}, etag=etag)
+
+    @cosmos_operation
+    async def touch_conversation(self, user_id, conversation_id, updated_at = None, etag = None):
+        return await self.set_conversation_fields(user_id, conversation_id, {'updatedAt': updated_at or datetime.utcnow().isoformat()}, etag=etag)
+
+    @cosmos_operation
     async def delete_conversation(self, user_id, conversation_id):
+        if self.cache:
+            self.cache.discard(user_id, conversation_id)
         conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)        
         if conversation:
             resp = await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
@@ -94,17 +178,135 @@ class CosmosConversationClient():
             return True
 
         
-    async def delete_messages(self, conversation_id, user_id):
-        ## get a list of all the messages in the conversation
-        messages = await self.get_messages(user_id, conversation_id)
-        response_list = []
-        if messages:
-            for message in messages:
-                resp = await self.container_client.delete_item(item=message['id'], partition_key=user_id)
-                response_list.append(resp)
-            return response_list
+    @cosmos_operation
+    async def delete_items(self, user_id, item_ids, concurrency = 4):
+        """Deletes items from the user's partition in transactional batches, running up to concurrency batches at once."""
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def delete_batch(batch_ids):
+            async with semaphore:
+                try:
+                    await self.container_client.execute_item_batch(batch_operations=[('delete', (item_id,)) for item_id in batch_ids], partition_key=user_id)
+                except exceptions.CosmosBatchOperationError as e:
+                    if e.status_code != 404:
+                        raise
+                    # Something else deleted part of the batch first, delete the rest one by one
+                    for item_id in batch_ids:
+                        try:
+                            await self.container_client.delete_item(item=item_id, partition_key=user_id)
+                        except exceptions.CosmosResourceNotFoundError:
+                            pass
 
+        await asyncio.gather(*[
+            delete_batch(item_ids[start:start + MAX_BATCH_OPERATIONS])
+            for start in range(0, len(item_ids), MAX_BATCH_OPERATIONS)
+        ])
+        return item_ids
 
+    @cosmos_operation
+    async def get_message_ids(self, user_id, conversation_id):
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            }
+        ]
+        query = "SELECT VALUE c.id FROM c WHERE c.conversationId = @conversationId AND (c.type='message' OR c.type='messageBucket')"
+        return [item_id async for item_id in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)]
+
+    @cosmos_operation
+    async def delete_messages(self, conversation_id, user_id, concurrency = 4):
+        """
+        Deletes the messages of the conversation. A bucketed conversation is pointed back at an empty first
+        bucket in the same transactional batch that deletes its buckets, conditional on its ETag, so the
+        next write opens a new bucket rather than appending to a deleted one. Either way the conversation
+        is written last, so other workers' caches see its ETag change and drop the deleted messages.
+        """
+        if self.cache:
+            self.cache.discard(user_id, conversation_id)
+        for attempt in range(MAX_BUCKET_WRITE_ATTEMPTS):
+            try:
+                conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+            except exceptions.CosmosResourceNotFoundError:
+                conversation = None
+            ## get the ids of all the messages in the conversation
+            message_ids = await self.get_message_ids(user_id, conversation_id)
+            if not conversation or not is_bucketed(conversation):
+                await self.delete_items(user_id, message_ids, concurrency)
+                if conversation:
+                    await self.touch_messages(user_id, conversation_id)
+                return message_ids
+
+            ## the first buckets are the ones later writes fill again, they go with the reset; the rest after it
+            first_buckets = [bucket_id(conversation_id, index) for index in range(MAX_BATCH_OPERATIONS - 1)]
+            cleared = [item_id for item_id in first_buckets if item_id in message_ids]
+            operations = [('delete', (item_id,)) for item_id in cleared]
+            operations.append(('patch', (conversation_id, [
+                {'op': 'set', 'path': '/latestBucket', 'value': 0},
+                {'op': 'set', 'path': '/latestBucketMessages', 'value': 0},
+                {'op': 'set', 'path': '/latestBucketBytes', 'value': 0},
+                {'op': 'set', 'path': '/messagesUpdatedAt', 'value': datetime.utcnow().isoformat()}
+            ]), {'if_match_etag': conversation['_etag']}))
+            try:
+                await self.container_client.execute_item_batch(batch_operations=operations, partition_key=user_id)
+            except exceptions.CosmosBatchOperationError as e:
+                if e.status_code not in (404, 412):
+                    raise
+                ## a write or another delete got there first, read the conversation again
+                continue
+            await self.delete_items(user_id, [item_id for item_id in message_ids if item_id not in cleared], concurrency)
+            return message_ids
+
+        raise Exception(f"Unable to delete the messages of conversation {conversation_id}, it kept changing")
+
+    async def touch_messages(self, user_id, conversation_id):
+        try:
+            await self.container_client.patch_item(
+                item=conversation_id,
+                partition_key=user_id,
+                patch_operations=[{'op': 'set', 'path': '/messagesUpdatedAt', 'value': datetime.utcnow().isoformat()}]
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+
+    @cosmos_operation
+    async def delete_conversation_and_messages(self, user_id, conversation_id, concurrency = 4):
+        # The conversation goes last, so a failed delete leaves it listed for the user to retry
+        if self.cache:
+            self.cache.discard(user_id, conversation_id)
+        await self.delete_messages(conversation_id, user_id, concurrency)
+        try:
+            await self.container_client.delete_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            pass
+        return conversation_id
+
+    @cosmos_operation
+    async def delete_all_conversations(self, user_id, concurrency = 4, by_partition_key = False):
+        """
+        Deletes every conversation and message of the user. With by_partition_key the whole userId
+        partition is dropped in one call, which needs the delete by partition key feature enabled on the account.
+        """
+        if self.cache:
+            self.cache.discard_user(user_id)
+        if by_partition_key:
+            await self.container_client.delete_all_items_by_partition_key(user_id)
+            return None
+
+        parameters = [
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        query = "SELECT c.id, c.type FROM c WHERE c.userId = @userId AND (c.type='message' OR c.type='messageBucket' OR c.type='conversation')"
+        items = [item async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)]
+        await self.delete_items(user_id, [item['id'] for item in items if item['type'] != 'conversation'], concurrency)
+        conversation_ids = [item['id'] for item in items if item['type'] == 'conversation']
+        await self.delete_items(user_id, conversation_ids, concurrency)
+        return len(conversation_ids)
+
+    @cosmos_operation
     async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
         parameters = [
             {
@@ -112,76 +314,369 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        query = f"SELECT {CONVERSATION_LIST_FIELDS} FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
         if limit is not None:
-            query += f" offset {offset} limit {limit}" 
+            query += " offset @offset limit @limit"
+            parameters += [{'name': '@offset', 'value': int(offset)}, {'name': '@limit', 'value': int(limit)}]
         
         conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
             conversations.append(item)
         
         return conversations
 
-    async def get_conversation(self, user_id, conversation_id):
+    @cosmos_operation
+    async def get_conversations_page(self, user_id, limit, continuation_token = None, sort_order = 'DESC'):
+        """
+        Returns up to limit conversations and the continuation token of the next page, None on the last page.
+        Unlike offset paging, the cost of a page does not grow with how deep into the list it is.
+        """
         parameters = [
-            {
-                'name': '@conversationId',
-                'value': conversation_id
-            },
             {
                 'name': '@userId',
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c where c.id = @conversationId and c.type='conversation' and c.userId = @userId"
+        query = f"SELECT {CONVERSATION_LIST_FIELDS} FROM c where c.userId = @userId and c.type='conversation' order by c.updatedAt {sort_order}"
+        pages = self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id, max_item_count=limit).by_page(continuation_token)
+
         conversations = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
+        try:
+            page = await pages.__anext__()
+        except StopAsyncIteration:
+            return conversations, None
+        except exceptions.CosmosHttpResponseError as e:
+            if continuation_token and e.status_code == 400:
+                raise InvalidContinuationTokenError("Invalid continuation token") from e
+            raise
+        async for item in page:
             conversations.append(item)
 
-        ## if no conversations are found, return None
-        if len(conversations) == 0:
+        return conversations, pages.continuation_token
+
+    @cosmos_operation
+    async def get_conversation(self, user_id, conversation_id):
+        entry = self.cache.get(user_id, conversation_id) if self.cache else None
+        try:
+            if entry:
+                conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id, etag=entry.etag, match_condition=MatchConditions.IfModified)
+                if conversation is None:
+                    ## not modified, the cached conversation is current
+                    return entry.conversation
+            else:
+                conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            if self.cache:
+                self.cache.discard(user_id, conversation_id)
             return None
+
+        ## if the item is not a conversation, return None
+        if conversation.get('type') != 'conversation':
+            return None
+        if self.cache:
+            self.cache.set_conversation(user_id, conversation)
+        return conversation
+
+    def conversation_patch(self, user_id, conversation_id, patch_operations, filter_predicate = None):
+        """
+        A batch operation patching the conversation. While its messages are cached the patch is
+        conditional on the cached ETag, so the cached list is only extended if nothing else changed it.
+        """
+        entry = self.cache.get(user_id, conversation_id) if self.cache else None
+        options = {'if_match_etag': entry.etag} if entry and entry.messages is not None else {}
+        if filter_predicate:
+            options['filter_predicate'] = filter_predicate
+        return ('patch', (conversation_id, patch_operations), options)
+
+    async def execute_conversation_batch(self, user_id, conversation_id, operations):
+        try:
+            return await self.container_client.execute_item_batch(batch_operations=operations, partition_key=user_id)
+        except exceptions.CosmosBatchOperationError as e:
+            unconditional = [
+                operation[:2] + ({key: value for key, value in operation[2].items() if key != 'if_match_etag'},) if len(operation) > 2 else operation
+                for operation in operations
+            ]
+            if e.status_code != 412 or unconditional == operations:
+                raise
+            ## the conversation changed since it was cached, write again without the ETag condition
+            self.cache.discard(user_id, conversation_id)
+            return await self.container_client.execute_item_batch(batch_operations=unconditional, partition_key=user_id)
+
+    def cache_written_messages(self, user_id, conversation_id, written_conversation, messages, new_conversation = False):
+        if not self.cache:
+            return
+        if written_conversation:
+            self.cache.add_messages(user_id, written_conversation, messages, new_conversation=new_conversation)
+        else:
+            self.cache.discard(user_id, conversation_id)
+
+    def cache_updated_message(self, user_id, conversation_id, written_conversation, message):
+        if not self.cache:
+            return
+        if written_conversation:
+            self.cache.update_message(user_id, written_conversation, message)
         else:
-            return conversations[0]
- 
-    async def create_message(self, uuid, conversation_id, user_id, input_message: dict, hidden = False):
-        message = {
-            'id': uuid,
-            'type': 'message',
-            'userId' : user_id,
-            'createdAt': datetime.utcnow().isoformat(),
-            'updatedAt': datetime.utcnow().isoformat(),
-            'conversationId' : conversation_id,
-            'role': input_message['role'],
-            'content': input_message['content'],
-            'hidden': hidden,
+            self.cache.discard(user_id, conversation_id)
+
+    def build_bucket(self, user_id, conversation_id, index):
+        return {
+            'id': bucket_id(conversation_id, index),
+            'type': 'messageBucket',
+            'userId': user_id,
+            'conversationId': conversation_id,
+            'bucket': index,
+            'messages': []
         }
 
-        if self.enable_message_feedback:
-            message['feedback'] = ''
-        
-        resp = await self.container_client.upsert_item(message)  
-        if resp:
-            ## update the parent conversations's updatedAt field with the current message's createdAt datetime value
-            conversation = await self.get_conversation(user_id, conversation_id)
-            if not conversation:
+    def bucket_operations(self, user_id, conversation_id, conversation, messages):
+        """
+        Batch operations placing the messages after those in the conversation's latest bucket, opening
+        new buckets as they fill up, and the conversation fields pointing at the new latest bucket.
+        """
+        latest_bucket = conversation.get('latestBucket', 0)
+        index = latest_bucket
+        count = conversation.get('latestBucketMessages', 0)
+        size = conversation.get('latestBucketBytes', 0)
+        appended, new_buckets = [], []
+        for message in messages:
+            message_size = len(json.dumps(message))
+            if count >= self.bucket_size or (count and size + message_size > MAX_BUCKET_BYTES):
+                index, count, size = index + 1, 0, 0
+            if count == 0:
+                new_buckets.append(self.build_bucket(user_id, conversation_id, index))
+            if new_buckets:
+                new_buckets[-1]['messages'].append(message)
+            else:
+                appended.append(message)
+            count += 1
+            size += message_size
+
+        operations = [
+            ('patch', (bucket_id(conversation_id, latest_bucket), [{'op': 'add', 'path': '/messages/-', 'value': message} for message in appended[start:start + MAX_PATCH_OPERATIONS]]))
+            for start in range(0, len(appended), MAX_PATCH_OPERATIONS)
+        ]
+        operations += [('upsert', (bucket,)) for bucket in new_buckets]
+        return operations, {'latestBucket': index, 'latestBucketMessages': count, 'latestBucketBytes': size}
+
+    @cosmos_operation
+    async def create_messages(self, user_id, conversation_id, messages, conversation = None):
+        """
+        Writes the messages in one transactional batch on the user's partition, together with
+        either the new conversation or a patch of the existing conversation's updatedAt.
+        Nothing is written if the conversation does not exist.
+
+        New conversations get the client's message layout; existing ones keep theirs, so conversations
+        written before and after switching to buckets can be read and written side by side.
+        """
+        if conversation:
+            if self.message_layout == 'buckets':
+                return await self.create_bucketed_messages(user_id, conversation_id, messages, conversation=conversation)
+            return await self.create_message_items(user_id, conversation_id, messages, conversation=conversation)
+
+        current = None
+        if self.message_layout == 'buckets':
+            current = await self.get_conversation(user_id, conversation_id)
+            if not current:
                 return "Conversation not found"
-            conversation['updatedAt'] = message['createdAt']
-            await self.upsert_conversation(conversation)
-            return resp
-        else:
-            return False
-    
-    async def update_message_feedback(self, user_id, message_id, feedback):
-        message = await self.container_client.read_item(item=message_id, partition_key=user_id)
-        if message:
-            message['feedback'] = feedback
-            resp = await self.container_client.upsert_item(message)
-            return resp
-        else:
+        if not current or not is_bucketed(current):
+            resp = await self.create_message_items(user_id, conversation_id, messages)
+            if resp is not None:
+                return resp
+            ## the conversation has been moved to buckets
+            current = None
+        return await self.create_bucketed_messages(user_id, conversation_id, messages, current=current)
+
+    async def create_message_items(self, user_id, conversation_id, messages, conversation = None):
+        """Writes the messages as one item each. Returns None if the conversation has been moved to buckets."""
+        if conversation:
+            conversation = {key: value for key, value in conversation.items() if key not in ('latestBucket', 'latestBucketMessages', 'latestBucketBytes')}
+        operations = [('upsert', (conversation,))] if conversation else []
+        operations += [('upsert', (message,)) for message in messages]
+        if not conversation:
+            ## update the parent conversations's updatedAt field with the last message's createdAt datetime value
+            operations.append(self.conversation_patch(user_id, conversation_id, [{'op': 'set', 'path': '/updatedAt', 'value': messages[-1]['createdAt']}], filter_predicate=ITEMS_LAYOUT_PREDICATE))
+
+        try:
+            results = await self.execute_conversation_batch(user_id, conversation_id, operations)
+        except exceptions.CosmosBatchOperationError as e:
+            if conversation or e.error_index != len(operations) - 1 or e.status_code not in (404, 412):
+                raise
+            if self.cache:
+                self.cache.discard(user_id, conversation_id)
+            if e.status_code == 412:
+                return None
+            return "Conversation not found"
+
+        self.cache_written_messages(user_id, conversation_id, results[0 if conversation else -1].get('resourceBody'), messages, new_conversation=bool(conversation))
+        return messages
+
+    async def create_bucketed_messages(self, user_id, conversation_id, messages, conversation = None, current = None):
+        """
+        Appends the messages to the conversation's buckets in one transactional batch, together with either
+        the new conversation or a patch pointing the existing conversation at its new latest bucket. The
+        patch is conditional on the conversation's ETag, so concurrent writes cannot fill the same places;
+        the losing write reads the conversation again and retries.
+        """
+        for attempt in range(MAX_BUCKET_WRITE_ATTEMPTS):
+            if not conversation and (attempt or not current):
+                current = await self.get_conversation(user_id, conversation_id)
+                if not current:
+                    return "Conversation not found"
+
+            operations, pointer = self.bucket_operations(user_id, conversation_id, current or {}, messages)
+            if conversation:
+                operations.insert(0, ('upsert', ({**conversation, **pointer},)))
+            else:
+                patch_operations = [{'op': 'set', 'path': '/updatedAt', 'value': messages[-1]['createdAt']}]
+                patch_operations += [{'op': 'set', 'path': f'/{key}', 'value': value} for key, value in pointer.items()]
+                operations.append(('patch', (conversation_id, patch_operations), {'if_match_etag': current['_etag']}))
+
+            try:
+                results = await self.container_client.execute_item_batch(batch_operations=operations, partition_key=user_id)
+            except exceptions.CosmosBatchOperationError as e:
+                if conversation or e.error_index != len(operations) - 1 or e.status_code not in (404, 412):
+                    raise
+                if self.cache:
+                    self.cache.discard(user_id, conversation_id)
+                if e.status_code == 404:
+                    return "Conversation not found"
+                continue
+
+            self.cache_written_messages(user_id, conversation_id, results[0 if conversation else -1].get('resourceBody'), messages, new_conversation=bool(conversation))
+            return messages
+
+        raise Exception(f"Unable to write messages to conversation {conversation_id}, it kept changing")
+
+    async def patch_conversation(self, user_id, conversation_id, patch_operations, filter_predicate = None):
+        """
+        Patches the conversation outside a batch. While its messages are cached the patch is first made
+        conditional on the cached ETag, like conversation_patch. Raises CosmosResourceNotFoundError, or
+        CosmosAccessConditionFailedError if filter_predicate does not hold.
+        """
+        entry = self.cache.get(user_id, conversation_id) if self.cache else None
+        if entry and entry.messages is not None:
+            try:
+                return await self.container_client.patch_item(
+                    item=conversation_id,
+                    partition_key=user_id,
+                    patch_operations=patch_operations,
+                    filter_predicate=filter_predicate,
+                    etag=entry.etag,
+                    match_condition=MatchConditions.IfNotModified
+                )
+            except exceptions.CosmosAccessConditionFailedError:
+                ## changed since it was cached, or the predicate failed; patch again without the ETag to tell which
+                self.cache.discard(user_id, conversation_id)
+        return await self.container_client.patch_item(item=conversation_id, partition_key=user_id, patch_operations=patch_operations, filter_predicate=filter_predicate)
+
+    @cosmos_operation
+    async def update_message_feedback(self, user_id, message_id, feedback, etag = None):
+        results = await self.update_messages_feedback(user_id, {message_id: feedback}, etags={message_id: etag} if etag else None)
+        if results[message_id] is None:
+            raise PreconditionFailedError(f"Message {message_id} has changed since it was read")
+        return results[message_id]
+
+    @cosmos_operation
+    async def update_messages_feedback(self, user_id, feedback, etags = None, concurrency = 4):
+        """
+        Patches the feedback of each message item without reading it first, then touches each of their
+        conversations once, so its ETag tells caches the messages changed. Messages stored in buckets have
+        no ETag of their own and are updated unconditionally.
+        """
+        etags = etags or {}
+        semaphore = asyncio.Semaphore(concurrency)
+        ## bucketed messages are written together with their conversation's touch
+        bucketed = set()
+
+        async def patch_message(message_id):
+            options = {'etag': etags[message_id], 'match_condition': MatchConditions.IfNotModified} if etags.get(message_id) else {}
+            async with semaphore:
+                try:
+                    return await self.container_client.patch_item(
+                        item=message_id,
+                        partition_key=user_id,
+                        patch_operations=[{'op': 'set', 'path': '/feedback', 'value': feedback[message_id]}],
+                        filter_predicate=MESSAGE_PREDICATE,
+                        **options
+                    )
+                except exceptions.CosmosResourceNotFoundError:
+                    ## not a message item, look for it in the buckets
+                    bucketed.add(message_id)
+                    return await self.update_bucketed_message_feedback(user_id, message_id, feedback[message_id])
+                except exceptions.CosmosAccessConditionFailedError:
+                    ## the ETag did not match, or the id is not a message's
+                    return None if options else False
+
+        message_ids = list(feedback)
+        results = dict(zip(message_ids, await asyncio.gather(*[patch_message(message_id) for message_id in message_ids])))
+
+        by_conversation = {}
+        for message_id, message in results.items():
+            if message and message_id not in bucketed:
+                by_conversation.setdefault(message['conversationId'], []).append(message)
+
+        async def touch_conversation(conversation_id, messages):
+            async with semaphore:
+                try:
+                    written_conversation = await self.patch_conversation(
+                        user_id,
+                        conversation_id,
+                        [{'op': 'set', 'path': '/messagesUpdatedAt', 'value': datetime.utcnow().isoformat()}],
+                        filter_predicate=ITEMS_LAYOUT_PREDICATE
+                    )
+                except exceptions.CosmosResourceNotFoundError:
+                    ## the conversation is gone, the messages are updated on their own
+                    written_conversation = None
+                except exceptions.CosmosAccessConditionFailedError:
+                    ## message items left behind by a move to buckets, the bucketed copies are the ones read
+                    if self.cache:
+                        self.cache.discard(user_id, conversation_id)
+                    for message in messages:
+                        results[message['id']] = await self.update_bucketed_message_feedback(user_id, message['id'], feedback[message['id']])
+                    return
+            for message in messages:
+                self.cache_updated_message(user_id, conversation_id, written_conversation, message)
+
+        await asyncio.gather(*[touch_conversation(conversation_id, messages) for conversation_id, messages in by_conversation.items()])
+        return results
+
+    async def update_bucketed_message_feedback(self, user_id, message_id, feedback):
+        parameters = [
+            {
+                'name': '@messageId',
+                'value': message_id
+            }
+        ]
+        query = "SELECT * FROM c WHERE c.type='messageBucket' AND EXISTS(SELECT VALUE m FROM m IN c.messages WHERE m.id = @messageId)"
+        buckets = [bucket async for bucket in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id)]
+        if not buckets:
             return False
 
-    async def get_messages(self, user_id, conversation_id):
+        bucket = buckets[0]
+        position = next(position for position, message in enumerate(bucket['messages']) if message['id'] == message_id)
+        message = {**bucket['messages'][position], 'feedback': feedback}
+        conversation_id = bucket['conversationId']
+        ## messages are only ever appended to a bucket, so the position stays valid
+        bucket_patch = [{'op': 'set', 'path': f'/messages/{position}/feedback', 'value': feedback}]
+        operations = [
+            ('patch', (bucket['id'], bucket_patch)),
+            self.conversation_patch(user_id, conversation_id, [{'op': 'set', 'path': '/messagesUpdatedAt', 'value': datetime.utcnow().isoformat()}])
+        ]
+        try:
+            results = await self.execute_conversation_batch(user_id, conversation_id, operations)
+        except exceptions.CosmosBatchOperationError as e:
+            if e.status_code != 404 or e.error_index != 1:
+                raise
+            ## the conversation is gone, update the bucket on its own
+            if self.cache:
+                self.cache.discard(user_id, conversation_id)
+            await self.container_client.patch_item(item=bucket['id'], partition_key=user_id, patch_operations=bucket_patch)
+            return message
+
+        self.cache_updated_message(user_id, conversation_id, results[-1].get('resourceBody'), message)
+        return message
+
+    async def get_message_items(self, user_id, conversation_id):
         parameters = [
             {
                 'name': '@conversationId',
@@ -192,10 +687,206 @@ class CosmosConversationClient():
                 'value': user_id
             }
         ]
-        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.timestamp ASC"
+        query = f"SELECT * FROM c WHERE c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId ORDER BY c.createdAt ASC"
         messages = []
-        async for item in self.container_client.query_items(query=query, parameters=parameters):
+        async for item in self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id):
             messages.append(item)
+        return messages
 
+    async def read_bucket(self, user_id, conversation_id, index):
+        try:
+            return await self.container_client.read_item(item=bucket_id(conversation_id, index), partition_key=user_id)
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+
+    async def get_bucketed_messages(self, user_id, conversation):
+        """Point reads the conversation's buckets concurrently; a conversation of up to bucket_size messages is one read."""
+        buckets = await asyncio.gather(*[self.read_bucket(user_id, conversation['id'], index) for index in range(conversation['latestBucket'] + 1)])
+        return [message for bucket in buckets if bucket for message in bucket['messages']]
+
+    @cosmos_operation
+    async def get_messages(self, user_id, conversation_id, conversation = None):
+        """
+        Messages of the conversation, oldest first. Call get_conversation first so cached messages are
+        revalidated, and pass the conversation it returned to tell which layout the messages are in.
+        """
+        entry = self.cache.get(user_id, conversation_id) if self.cache else None
+        if entry and entry.messages is not None:
+            return list(entry.messages)
+
+        if not conversation:
+            conversation = entry.conversation if entry else await self.get_conversation(user_id, conversation_id)
+        if not conversation:
+            return []
+        if is_bucketed(conversation):
+            messages = await self.get_bucketed_messages(user_id, conversation)
+        else:
+            messages = await self.get_message_items(user_id, conversation_id)
+
+        if entry:
+            self.cache.set_messages(user_id, conversation_id, entry.etag, messages)
         return messages
 
+    @cosmos_operation
+    async def stream_messages(self, user_id, conversation_id, conversation = None, limit = None, until = None, page_size = 100):
+        """
+        Messages of the conversation like get_messages, without collecting them all first. Message items
+        are paged from the query as the pages are consumed; buckets are read one at a time, and only back
+        as far as the last limit messages when a limit is given.
+        """
+        entry = self.cache.get(user_id, conversation_id) if self.cache else None
+        if entry and entry.messages is not None:
+            messages, cursor = message_window(entry.messages, limit, until)
+            return iterate_pages(messages, page_size), cursor
+
+        if not conversation:
+            conversation = entry.conversation if entry else await self.get_conversation(user_id, conversation_id)
+        if not conversation:
+            return iterate_pages([], page_size), None
+        if is_bucketed(conversation):
+            return await self.stream_bucketed_messages(user_id, conversation, limit, until, page_size)
+        return await self.stream_message_items(user_id, conversation_id, limit, until, page_size)
+
+    async def stream_message_items(self, user_id, conversation_id, limit, until, page_size):
+        parameters = [
+            {
+                'name': '@conversationId',
+                'value': conversation_id
+            },
+            {
+                'name': '@userId',
+                'value': user_id
+            }
+        ]
+        conditions = "c.conversationId = @conversationId AND c.type='message' AND c.userId = @userId"
+        if until:
+            conditions += " AND c.createdAt <= @until"
+            parameters.append({'name': '@until', 'value': until})
+
+        cursor = None
+        if limit is not None:
+            ## the newest message left out of the window, if there is one, bounds it
+            query = f"SELECT VALUE c.createdAt FROM c WHERE {conditions} ORDER BY c.createdAt DESC OFFSET @limit LIMIT 1"
+            boundaries = [value async for value in self.container_client.query_items(query=query, parameters=parameters + [{'name': '@limit', 'value': int(limit)}], partition_key=user_id)]
+            if boundaries:
+                cursor = boundaries[0]
+                conditions += " AND c.createdAt > @cursor"
+                parameters.append({'name': '@cursor', 'value': cursor})
+
+        query = f"SELECT * FROM c WHERE {conditions} ORDER BY c.createdAt ASC"
+        ## the pages are read after stream_messages has returned, so they are recorded as an operation of their own
+        operation = OperationMetrics('stream_message_pages', self.container_name) if self.telemetry else None
+        hook = {'raw_response_hook': operation.on_response} if operation else {}
+        pager = self.container_client.query_items(query=query, parameters=parameters, partition_key=user_id, max_item_count=page_size, **hook).by_page()
+        async def pages():
+            try:
+                async for page in pager:
+                    messages = [item async for item in page]
+                    if messages:
+                        yield messages
+            finally:
+                if operation:
+                    self.telemetry.record(operation)
+        return pages(), cursor
+
+    async def stream_bucketed_messages(self, user_id, conversation, limit, until, page_size):
+        def in_window(bucket):
+            return [message for message in bucket['messages'] if not until or message['createdAt'] <= until] if bucket else []
+
+        if limit is None:
+            async def pages():
+                for index in range(conversation['latestBucket'] + 1):
+                    async for page in iterate_pages(in_window(await self.read_bucket(user_id, conversation['id'], index)), page_size):
+                        yield page
+            return pages(), None
+
+        ## read back from the latest bucket until the window is full
+        messages = []
+        for index in range(conversation['latestBucket'], -1, -1):
+            messages = in_window(await self.read_bucket(user_id, conversation['id'], index)) + messages
+            if len(messages) > limit:
+                break
+        messages, cursor = message_window(messages, limit)
+        return iterate_pages(messages, page_size), cursor
+
+    @cosmos_operation
+    async def migrate_to_buckets(self, user_id, conversation_id, concurrency = 4):
+        """
+        Moves the messages of a conversation from message items to buckets and returns how many were moved.
+
+        The buckets are written first, then the conversation is pointed at them with a patch conditional
+        on its ETag, so messages written meanwhile make the move start over. The message items are deleted
+        last; running the move again deletes any a previous run left behind.
+        """
+        for attempt in range(MAX_BUCKET_WRITE_ATTEMPTS):
+            try:
+                conversation = await self.container_client.read_item(item=conversation_id, partition_key=user_id)
+            except exceptions.CosmosResourceNotFoundError:
+                return 0
+            message_items = await self.get_message_items(user_id, conversation_id)
+
+            if not is_bucketed(conversation):
+                ## drop the system properties of the message items
+                messages = [{key: value for key, value in item.items() if not key.startswith('_')} for item in message_items]
+                operations, pointer = self.bucket_operations(user_id, conversation_id, {}, messages)
+                ## buckets are not read until the conversation points at them
+                await asyncio.gather(*[self.container_client.upsert_item(bucket) for _, (bucket,) in operations])
+                try:
+                    await self.container_client.patch_item(
+                        item=conversation_id,
+                        partition_key=user_id,
+                        patch_operations=[{'op': 'set', 'path': f'/{key}', 'value': value} for key, value in pointer.items()],
+                        etag=conversation['_etag'],
+                        match_condition=MatchConditions.IfNotModified
+                    )
+                except exceptions.CosmosAccessConditionFailedError:
+                    continue
+                except exceptions.CosmosResourceNotFoundError:
+                    return 0
+
+            if self.cache:
+                self.cache.discard(user_id, conversation_id)
+            await self.delete_items(user_id, [item['id'] for item in message_items], concurrency)
+            return len(message_items)
+
+        raise Exception(f"Unable to move conversation {conversation_id} to buckets, it kept changing")
+
+    @cosmos_operation
+    async def get_document_catalog(self, user_id):
+        try:
+            catalog = await self.container_client.read_item(item=DOCUMENT_CATALOG_ID, partition_key=catalog_partition(user_id))
+        except exceptions.CosmosResourceNotFoundError:
+            return None
+        return catalog['documents']
+
+    @cosmos_operation
+    async def update_document_catalog(self, user_id, updates = None, removals = ()):
+        """
+        The catalog is one item per user, replaced conditional on its ETag; an update that loses
+        to another one reads the catalog again and merges into that.
+        """
+        for attempt in range(MAX_CATALOG_WRITE_ATTEMPTS):
+            try:
+                catalog = await self.container_client.read_item(item=DOCUMENT_CATALOG_ID, partition_key=catalog_partition(user_id))
+            except exceptions.CosmosResourceNotFoundError:
+                catalog = None
+            documents = merge_document_catalog(catalog['documents'] if catalog else {}, updates, removals)
+            try:
+                if catalog:
+                    await self.container_client.replace_item(
+                        item=DOCUMENT_CATALOG_ID,
+                        body={**catalog, 'documents': documents},
+                        etag=catalog['_etag'],
+                        match_condition=MatchConditions.IfNotModified
+                    )
+                else:
+                    await self.container_client.create_item(body={
+                        'id': DOCUMENT_CATALOG_ID,
+                        'type': 'documentCatalog',
+                        'userId': catalog_partition(user_id),
+                        'documents': documents
+                    })
+                return documents
+            except (exceptions.CosmosAccessConditionFailedError, exceptions.CosmosResourceExistsError):
+                continue
+        raise Exception(f"Unable to update the document catalog of {user_id}, it kept changing")
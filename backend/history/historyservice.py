@@ -0,0 +1,189 @@
+import uuid
+from datetime import datetime
+
+
+def message_window(messages, limit = None, until = None):
+    """
+    The messages, oldest first, created at or before until, or only the last limit of them, and the cursor of
+    the older ones left out: the createdAt to pass as until for them, or None if there are none. Messages
+    created at the same time are kept together, so a window can hold a few more than limit.
+    """
+    if until:
+        messages = [message for message in messages if message['createdAt'] <= until]
+    if limit is None or len(messages) <= limit:
+        return messages, None
+    cursor = messages[-limit - 1]['createdAt']
+    return [message for message in messages if message['createdAt'] > cursor], cursor
+
+async def iterate_pages(messages, page_size):
+    for start in range(0, len(messages), page_size):
+        yield messages[start:start + page_size]
+
+
+def merge_document_catalog(documents, updates = None, removals = ()):
+    """The catalog with the updates' fields merged into its entries and the removals left out; fields set to None are dropped."""
+    documents = {filename: dict(entry) for filename, entry in documents.items() if filename not in removals}
+    for filename, fields in (updates or {}).items():
+        entry = documents.setdefault(filename, {'filename': filename})
+        entry.update(fields)
+        for field in [field for field, value in entry.items() if value is None]:
+            del entry[field]
+        entry['updatedAt'] = datetime.utcnow().isoformat()
+    return documents
+
+
+class PreconditionFailedError(Exception):
+    """The item changed since the ETag the caller sent was read."""
+
+
+class InvalidContinuationTokenError(ValueError):
+    """The continuation token the caller sent is not one a page returned."""
+
+
+class HistoryClient():
+    """
+    The storage interface of the chat history. Conversations and messages are dicts shaped like the
+    CosmosDB items, whichever store keeps them; each user only ever sees their own.
+    """
+
+    container_name = None
+    enable_message_feedback = False
+
+    def build_conversation(self, user_id, title = '', conversation_id = None):
+        return {
+            'id': conversation_id or str(uuid.uuid4()),
+            'type': 'conversation',
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'userId': user_id,
+            'title': title
+        }
+
+    def build_message(self, uuid, conversation_id, user_id, input_message: dict, hidden = False):
+        message = {
+            'id': uuid,
+            'type': 'message',
+            'userId' : user_id,
+            'createdAt': datetime.utcnow().isoformat(),
+            'updatedAt': datetime.utcnow().isoformat(),
+            'conversationId' : conversation_id,
+            'role': input_message['role'],
+            'content': input_message['content'],
+            'hidden': hidden,
+        }
+
+        if self.enable_message_feedback:
+            message['feedback'] = ''
+        return message
+
+    async def ensure(self):
+        """Returns whether the store is reachable, and a message saying why not."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+    async def create_conversation(self, user_id, title = ''):
+        raise NotImplementedError
+
+    async def create_log_conversation(self, user_id, conversation_id, title = ''):
+        raise NotImplementedError
+
+    async def upsert_conversation(self, conversation):
+        raise NotImplementedError
+
+    async def update_conversation_title(self, user_id, conversation_id, title, etag = None):
+        """
+        Sets the title without reading the conversation first. Returns the updated conversation, or False if
+        the user has no such conversation. Raises PreconditionFailedError if etag is given and no longer matches.
+        """
+        raise NotImplementedError
+
+    async def touch_conversation(self, user_id, conversation_id, updated_at = None, etag = None):
+        """Sets the conversation's updatedAt, to now by default, like update_conversation_title."""
+        raise NotImplementedError
+
+    async def get_conversation(self, user_id, conversation_id):
+        """The conversation, or None if the user has no such conversation."""
+        raise NotImplementedError
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        """The id, title, createdAt and updatedAt of the user's conversations, by updatedAt."""
+        raise NotImplementedError
+
+    async def get_conversations_page(self, user_id, limit, continuation_token = None, sort_order = 'DESC'):
+        """
+        Up to limit conversations like get_conversations, and the continuation token of the next page or None.
+        Raises InvalidContinuationTokenError if the token is malformed.
+        """
+        raise NotImplementedError
+
+    async def create_messages(self, user_id, conversation_id, messages, conversation = None):
+        """
+        Writes the messages and moves the conversation's updatedAt on, or creates the conversation if given.
+        Returns the messages, or "Conversation not found" without writing anything.
+        """
+        raise NotImplementedError
+
+    async def create_message(self, uuid, conversation_id, user_id, input_message: dict, hidden = False):
+        message = self.build_message(uuid, conversation_id, user_id, input_message, hidden)
+        resp = await self.create_messages(user_id, conversation_id, [message])
+        if resp == "Conversation not found":
+            return resp
+        return message
+
+    async def get_messages(self, user_id, conversation_id, conversation = None):
+        """Messages of the conversation, oldest first."""
+        raise NotImplementedError
+
+    async def stream_messages(self, user_id, conversation_id, conversation = None, limit = None, until = None, page_size = 100):
+        """
+        Messages of the conversation like get_messages, windowed like message_window, as (pages, cursor): an
+        async iterator of lists of up to page_size messages, oldest first, and the cursor of the older messages.
+        """
+        messages, cursor = message_window(await self.get_messages(user_id, conversation_id, conversation=conversation), limit, until)
+        return iterate_pages(messages, page_size), cursor
+
+    async def update_message_feedback(self, user_id, message_id, feedback, etag = None):
+        """
+        The updated message, or False if the user has no such message. Raises PreconditionFailedError if
+        etag, the message's _etag, is given and no longer matches.
+        """
+        raise NotImplementedError
+
+    async def update_messages_feedback(self, user_id, feedback, etags = None):
+        """
+        Sets the feedback of several messages, given as {message_id: feedback}, with optional {message_id: etag}
+        preconditions. Returns {message_id: updated message, False if not found or None if its ETag did not match}.
+        """
+        results = {}
+        for message_id, message_feedback in feedback.items():
+            try:
+                results[message_id] = await self.update_message_feedback(user_id, message_id, message_feedback, etag=(etags or {}).get(message_id))
+            except PreconditionFailedError:
+                results[message_id] = None
+        return results
+
+    async def delete_conversation(self, user_id, conversation_id):
+        raise NotImplementedError
+
+    async def delete_messages(self, conversation_id, user_id, concurrency = 4):
+        raise NotImplementedError
+
+    async def delete_conversation_and_messages(self, user_id, conversation_id, concurrency = 4):
+        raise NotImplementedError
+
+    async def delete_all_conversations(self, user_id, concurrency = 4, by_partition_key = False):
+        """Deletes every conversation and message of the user and returns how many conversations there were, if known."""
+        raise NotImplementedError
+
+    async def get_document_catalog(self, user_id):
+        """
+        The user's uploaded documents as {filename: entry}, or None if no catalog has been recorded for them.
+        Entries have the filename, size, contentHash, numTokens, chunks, status and updatedAt, as far as known.
+        """
+        raise NotImplementedError
+
+    async def update_document_catalog(self, user_id, updates = None, removals = ()):
+        """Merges {filename: fields} into the user's catalog like merge_document_catalog, creating it if needed, and returns it."""
+        raise NotImplementedError
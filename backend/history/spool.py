@@ -0,0 +1,281 @@
+import asyncio
+import contextvars
+import glob
+import itertools
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+
+from backend.history.historyservice import HistoryClient, PreconditionFailedError
+from backend.metrics import MetricsRegistry
+
+try:
+    import fcntl
+except ImportError:
+    # Without file locks (Windows) a worker cannot tell a dead worker's spool from a live one's,
+    # so it only replays spools when it starts; run a single worker there
+    fcntl = None
+
+# Most messages merged into one write, leaving room for the conversation patch in a 100 operation batch
+MAX_MERGED_MESSAGES = 99
+MAX_RETRY_DELAY = 30
+
+
+def try_lock(handle):
+    if not fcntl:
+        return True
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+def read_pending(handle):
+    """The records of a spool file that were not acknowledged, in order."""
+    records = OrderedDict()
+    for line in handle:
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
+            # The last line of a worker that stopped mid-write
+            continue
+        if 'ack' in entry:
+            for seq in entry['ack']:
+                records.pop(seq, None)
+        else:
+            records[entry['seq']] = entry
+    return list(records.values())
+
+
+class SpooledHistoryClient():
+    """
+    Writes to a history container behind the request, for the logs audit container that nothing reads
+    interactively. Writes return once they are appended to a local spool file; a background drainer
+    writes them to the container in batches, retrying failures, and acknowledges them in the spool.
+
+    Each worker appends to its own spool file and holds a lock on it. On start a worker takes over the
+    spools of workers that stopped, so writes survive restarts. Writes to one conversation are applied
+    in order: when a write gives up after max_attempts, it and every later write to its conversation are
+    held back and queued again after blocked_retry_delay seconds. Once max_queue writes are waiting, new
+    writes wait for the drainer (backpressure).
+    Everything other than writes goes straight to the wrapped client.
+    """
+
+    def __init__(self, history_client: HistoryClient, spool_dir: str, batch_size: int = 100, max_queue: int = 10000, max_attempts: int = 8, retry_delay: float = 0.5, blocked_retry_delay: float = MAX_RETRY_DELAY, shutdown_timeout: float = 10, registry: MetricsRegistry = None):
+        self.history_client = history_client
+        self.container_name = history_client.container_name
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.blocked_retry_delay = blocked_retry_delay
+        self.shutdown_timeout = shutdown_timeout
+        self.path = None
+        self._file = None
+        self._seq = itertools.count()
+        # Records appended to the spool and not yet acknowledged
+        self._records = {}
+        # Records of conversations whose last write gave up, held in order until their retry
+        self._blocked = OrderedDict()
+        self._retry_handles = {}
+        self._queue = asyncio.Queue()
+        self._space = asyncio.Event()
+        self._drainer = None
+
+        registry = registry or MetricsRegistry()
+        self.queue_depth = registry.histogram("history_spool_queue_depth", "Writes waiting in the spool when a batch starts", ("container",), (0, 10, 100, 1000, 10000))
+        self.batch_seconds = registry.histogram("history_spool_batch_seconds", "Time taken to write a batch from the spool", ("container",))
+        self.batch_records = registry.histogram("history_spool_batch_records", "Writes per batch from the spool", ("container",), (1, 5, 10, 25, 50, 100, 250))
+        self.retries = registry.histogram("history_spool_retries", "Retries of a write from the spool", ("container",), (0, 1, 2, 4, 8))
+        self.backpressure_seconds = registry.histogram("history_spool_backpressure_seconds", "Time writes waited for room in a full spool", ("container",))
+
+    def __getattr__(self, name):
+        return getattr(self.history_client, name)
+
+    def start(self):
+        """Opens this worker's spool, takes over the spools of stopped workers and starts the drainer."""
+        if self._file:
+            return
+        os.makedirs(self.spool_dir, exist_ok=True)
+        self.path = os.path.join(self.spool_dir, f"{self.container_name}-{os.getpid()}-{uuid.uuid4().hex[:8]}.spool")
+        self._file = open(self.path, 'a', encoding='utf-8')
+        try_lock(self._file)
+
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, f"{self.container_name}-*.spool"))):
+            if path == self.path:
+                continue
+            try:
+                handle = open(path, 'r', encoding='utf-8')
+            except OSError:
+                continue
+            try:
+                if not try_lock(handle):
+                    continue
+                pending = read_pending(handle)
+                for record in pending:
+                    self._spool(record['method'], record['arguments'])
+                os.remove(path)
+                if pending:
+                    logging.warning(f"Recovered {len(pending)} unwritten {self.container_name} writes from {path}")
+            finally:
+                handle.close()
+
+        # A fresh context, so the drainer's writes are not counted towards the request that started it
+        self._drainer = asyncio.get_running_loop().create_task(self._drain(), context=contextvars.Context())
+
+    async def ensure(self):
+        self.start()
+        return await self.history_client.ensure()
+
+    def _write_line(self, entry):
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def _spool(self, method, arguments):
+        record = {'seq': next(self._seq), 'method': method, 'arguments': arguments}
+        self._write_line(record)
+        self._records[record['seq']] = record
+        self._queue.put_nowait(record)
+        return record
+
+    async def enqueue(self, method, **arguments):
+        self.start()
+        if self._queue.qsize() >= self.max_queue:
+            started = time.perf_counter()
+            while self._queue.qsize() >= self.max_queue:
+                self._space.clear()
+                await self._space.wait()
+            self.backpressure_seconds.observe(time.perf_counter() - started, container=self.container_name)
+        self._spool(method, arguments)
+
+    async def create_messages(self, user_id, conversation_id, messages, conversation = None):
+        await self.enqueue('create_messages', user_id=user_id, conversation_id=conversation_id, messages=messages, conversation=conversation)
+        return messages
+
+    async def update_conversation_title(self, user_id, conversation_id, title, etag = None):
+        await self.enqueue('update_conversation_title', user_id=user_id, conversation_id=conversation_id, title=title, etag=etag)
+        return True
+
+    async def _drain(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            self.queue_depth.observe(self._queue.qsize() + len(batch), container=self.container_name)
+            started = time.perf_counter()
+            try:
+                await self.write_batch(batch)
+            except Exception:
+                logging.exception(f"Exception writing a batch of {self.container_name} writes")
+            finally:
+                self.batch_seconds.observe(time.perf_counter() - started, container=self.container_name)
+                self.batch_records.observe(len(batch), container=self.container_name)
+                for _ in batch:
+                    self._queue.task_done()
+                self._space.set()
+
+    def merge(self, records):
+        """Groups records by conversation, merging consecutive message writes to the same existing conversation."""
+        groups = OrderedDict()
+        for record in records:
+            arguments = record['arguments']
+            units = groups.setdefault((arguments['user_id'], arguments['conversation_id']), [])
+            previous = units[-1] if units else None
+            if (
+                previous and record['method'] == 'create_messages' and previous['method'] == 'create_messages'
+                and not arguments['conversation'] and not previous['arguments']['conversation']
+                and len(previous['arguments']['messages']) + len(arguments['messages']) <= MAX_MERGED_MESSAGES
+            ):
+                previous['arguments']['messages'] = previous['arguments']['messages'] + arguments['messages']
+                previous['seqs'].append(record['seq'])
+            else:
+                units.append({'method': record['method'], 'arguments': dict(arguments), 'seqs': [record['seq']]})
+        return list(groups.values())
+
+    async def write_unit(self, unit):
+        for attempt in range(self.max_attempts):
+            try:
+                result = await getattr(self.history_client, unit['method'])(**unit['arguments'])
+                if result == "Conversation not found":
+                    logging.warning(f"Dropped {self.container_name} write to conversation {unit['arguments']['conversation_id']}, which does not exist")
+                self.retries.observe(attempt, container=self.container_name)
+                return True
+            except PreconditionFailedError:
+                ## the item changed since the write was made, retrying cannot help
+                logging.warning(f"Dropped {self.container_name} write to conversation {unit['arguments']['conversation_id']}, which changed since")
+                return True
+            except Exception as e:
+                logging.warning(f"Attempt {attempt + 1} of a {self.container_name} write failed: {e}")
+                if attempt + 1 < self.max_attempts:
+                    await asyncio.sleep(min(self.retry_delay * 2 ** attempt, MAX_RETRY_DELAY))
+        self.retries.observe(self.max_attempts, container=self.container_name)
+        logging.error(f"Gave up on a {self.container_name} write to conversation {unit['arguments']['conversation_id']}; retrying it in {self.blocked_retry_delay}s")
+        return False
+
+    def block(self, key, records):
+        """Holds back a conversation's records behind its failed write, and queues them again after a delay."""
+        self._blocked[key] = records
+        self._retry_handles[key] = asyncio.get_running_loop().call_later(self.blocked_retry_delay, self.unblock, key)
+
+    def unblock(self, key):
+        self._retry_handles.pop(key, None)
+        for record in self._blocked.pop(key, []):
+            self._queue.put_nowait(record)
+
+    async def write_batch(self, records):
+        async def write_group(units):
+            ## one at a time, so the writes to a conversation land in order
+            written = []
+            for i, unit in enumerate(units):
+                if not await self.write_unit(unit):
+                    ## it and the later writes wait for the retry
+                    held = sorted(seq for later in units[i:] for seq in later['seqs'])
+                    arguments = unit['arguments']
+                    self.block((arguments['user_id'], arguments['conversation_id']), [self._records[seq] for seq in held])
+                    break
+                written += unit['seqs']
+            return written
+
+        ready = []
+        for record in records:
+            key = (record['arguments']['user_id'], record['arguments']['conversation_id'])
+            if key in self._blocked:
+                ## behind a failed write to the same conversation
+                self._blocked[key].append(record)
+            else:
+                ready.append(record)
+
+        written = await asyncio.gather(*[write_group(units) for units in self.merge(ready)])
+        acknowledged = [seq for seqs in written for seq in seqs]
+        if acknowledged:
+            self._write_line({'ack': acknowledged})
+        for seq in acknowledged:
+            self._records.pop(seq, None)
+        if not self._records:
+            ## everything is written, start the spool over
+            self._file.seek(0)
+            self._file.truncate()
+
+    async def close(self):
+        if self._drainer:
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=self.shutdown_timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"{self._queue.qsize()} {self.container_name} writes left in {self.path} for the next start")
+            self._drainer.cancel()
+            self._drainer = None
+        for handle in self._retry_handles.values():
+            handle.cancel()
+        held = sum(len(records) for records in self._blocked.values())
+        if held:
+            logging.warning(f"{held} {self.container_name} writes held back by failed writes left in {self.path} for the next start")
+        self._retry_handles = {}
+        self._blocked = OrderedDict()
+        if self._file:
+            self._file.close()
+            self._file = None
+        await self.history_client.close()
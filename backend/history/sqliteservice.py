@@ -0,0 +1,285 @@
+import asyncio
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+from backend.history.historyservice import HistoryClient, InvalidContinuationTokenError, merge_document_catalog
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS conversations (
+        container TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        id TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (container, user_id, id)
+    ) WITHOUT ROWID""",
+    # The conversation list, newest first
+    "CREATE INDEX IF NOT EXISTS conversations_by_updated_at ON conversations (container, user_id, updated_at, id)",
+    """CREATE TABLE IF NOT EXISTS messages (
+        container TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        id TEXT NOT NULL,
+        conversation_id TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (container, user_id, id)
+    ) WITHOUT ROWID""",
+    # A conversation's messages in order
+    "CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (container, user_id, conversation_id, created_at)",
+    """CREATE TABLE IF NOT EXISTS document_catalogs (
+        container TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        data TEXT NOT NULL,
+        PRIMARY KEY (container, user_id)
+    ) WITHOUT ROWID""",
+]
+LIST_FIELDS = ('id', 'title', 'createdAt', 'updatedAt')
+
+
+class SqliteConversationClient(HistoryClient):
+    """
+    Chat history in a local SQLite database, for development, load tests and small deployments
+    without CosmosDB. Several containers, e.g. conversations and logs, can share one database file.
+    Items have no ETags here, so ETag preconditions are not checked.
+
+    The database runs in WAL mode: writes go through one connection, one at a time, while reads use
+    a connection per thread and run alongside them. The work runs in threads so it never blocks the
+    event loop. Workers on the same machine can share the file.
+    """
+
+    def __init__(self, database_path: str, container_name: str, enable_message_feedback: bool = False):
+        self.database_path = database_path
+        self.container_name = container_name
+        self.enable_message_feedback = enable_message_feedback
+        self._write_lock = threading.Lock()
+        self._writer = None
+        self._readers = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.database_path, check_same_thread=False, timeout=30)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # Safe in WAL mode; only a power loss can lose the last transactions
+        connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connections_lock:
+            self._connections.append(connection)
+        return connection
+
+    def _get_writer(self):
+        if not self._writer:
+            self._writer = self._connect()
+            with self._writer:
+                for statement in SCHEMA:
+                    self._writer.execute(statement)
+        return self._writer
+
+    def _get_reader(self):
+        if not getattr(self._readers, 'connection', None):
+            ## the writer creates the tables
+            with self._write_lock:
+                self._get_writer()
+            self._readers.connection = self._connect()
+        return self._readers.connection
+
+    def _read(self, function, *args):
+        return function(self._get_reader(), *args)
+
+    def _write(self, function, *args):
+        with self._write_lock:
+            connection = self._get_writer()
+            with connection:
+                return function(connection, *args)
+
+    async def read(self, function, *args):
+        return await asyncio.to_thread(self._read, function, *args)
+
+    async def write(self, function, *args):
+        """Runs function(connection, *args) in a transaction, committed if it returns and rolled back if it raises."""
+        return await asyncio.to_thread(self._write, function, *args)
+
+    async def ensure(self):
+        try:
+            await self.read(lambda connection: connection.execute("SELECT 1").fetchone())
+        except sqlite3.Error as e:
+            return False, f"SQLite history database {self.database_path} is not available: {e}"
+        return True, "SQLite history database initialized successfully"
+
+    async def close(self):
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._writer = None
+        self._readers = threading.local()
+
+    def _put_conversation(self, connection, conversation):
+        connection.execute(
+            "INSERT OR REPLACE INTO conversations (container, user_id, id, updated_at, data) VALUES (?, ?, ?, ?, ?)",
+            (self.container_name, conversation['userId'], conversation['id'], conversation['updatedAt'], json.dumps(conversation))
+        )
+        return conversation
+
+    def _select_conversation(self, connection, user_id, conversation_id):
+        row = connection.execute(
+            "SELECT data FROM conversations WHERE container = ? AND user_id = ? AND id = ?",
+            (self.container_name, user_id, conversation_id)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _update_conversation(self, connection, user_id, conversation_id, changes):
+        conversation = self._select_conversation(connection, user_id, conversation_id)
+        if not conversation:
+            return None
+        conversation.update(changes)
+        return self._put_conversation(connection, conversation)
+
+    async def create_conversation(self, user_id, title = ''):
+        return await self.write(self._put_conversation, self.build_conversation(user_id, title))
+
+    async def create_log_conversation(self, user_id, conversation_id, title = ''):
+        return await self.write(self._put_conversation, self.build_conversation(user_id, title, conversation_id))
+
+    async def upsert_conversation(self, conversation):
+        return await self.write(self._put_conversation, conversation)
+
+    async def update_conversation_title(self, user_id, conversation_id, title, etag = None):
+        return await self.write(self._update_conversation, user_id, conversation_id, {'title': title}) or False
+
+    async def touch_conversation(self, user_id, conversation_id, updated_at = None, etag = None):
+        return await self.write(self._update_conversation, user_id, conversation_id, {'updatedAt': updated_at or datetime.utcnow().isoformat()}) or False
+
+    async def get_conversation(self, user_id, conversation_id):
+        return await self.read(self._select_conversation, user_id, conversation_id)
+
+    def _list_conversations(self, connection, user_id, limit, sort_order, offset = 0, after = None):
+        direction = 'ASC' if sort_order.upper() == 'ASC' else 'DESC'
+        query = "SELECT data FROM conversations WHERE container = ? AND user_id = ?"
+        parameters = [self.container_name, user_id]
+        if after:
+            ## keyset paging: the conversations after the last one of the previous page
+            query += f" AND (updated_at, id) {'>' if direction == 'ASC' else '<'} (?, ?)"
+            parameters += after
+        query += f" ORDER BY updated_at {direction}, id {direction}"
+        if limit is not None:
+            query += " LIMIT ? OFFSET ?"
+            parameters += [int(limit), int(offset)]
+        conversations = [json.loads(row[0]) for row in connection.execute(query, parameters)]
+        return [{field: conversation.get(field) for field in LIST_FIELDS} for conversation in conversations]
+
+    async def get_conversations(self, user_id, limit, sort_order = 'DESC', offset = 0):
+        return await self.read(self._list_conversations, user_id, limit, sort_order, offset)
+
+    async def get_conversations_page(self, user_id, limit, continuation_token = None, sort_order = 'DESC'):
+        try:
+            after = json.loads(continuation_token) if continuation_token else None
+        except ValueError as e:
+            raise InvalidContinuationTokenError("Invalid continuation token") from e
+        if after is not None and not (isinstance(after, list) and len(after) == 2 and all(isinstance(value, str) for value in after)):
+            raise InvalidContinuationTokenError("Invalid continuation token")
+        ## read one more to know whether there is a next page
+        conversations = await self.read(self._list_conversations, user_id, limit + 1, sort_order, 0, after)
+        if len(conversations) <= limit:
+            return conversations, None
+        conversations = conversations[:limit]
+        return conversations, json.dumps([conversations[-1]['updatedAt'], conversations[-1]['id']])
+
+    def _insert_messages(self, connection, user_id, conversation_id, messages, conversation):
+        if conversation:
+            self._put_conversation(connection, conversation)
+        elif not self._update_conversation(connection, user_id, conversation_id, {'updatedAt': messages[-1]['createdAt']}):
+            return "Conversation not found"
+        connection.executemany(
+            "INSERT OR REPLACE INTO messages (container, user_id, id, conversation_id, created_at, data) VALUES (?, ?, ?, ?, ?, ?)",
+            [(self.container_name, user_id, message['id'], conversation_id, message['createdAt'], json.dumps(message)) for message in messages]
+        )
+        return messages
+
+    async def create_messages(self, user_id, conversation_id, messages, conversation = None):
+        return await self.write(self._insert_messages, user_id, conversation_id, messages, conversation)
+
+    def _select_messages(self, connection, user_id, conversation_id):
+        rows = connection.execute(
+            "SELECT data FROM messages WHERE container = ? AND user_id = ? AND conversation_id = ? ORDER BY created_at",
+            (self.container_name, user_id, conversation_id)
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    async def get_messages(self, user_id, conversation_id, conversation = None):
+        return await self.read(self._select_messages, user_id, conversation_id)
+
+    def _set_feedback(self, connection, user_id, message_id, feedback):
+        row = connection.execute(
+            "SELECT data FROM messages WHERE container = ? AND user_id = ? AND id = ?",
+            (self.container_name, user_id, message_id)
+        ).fetchone()
+        if not row:
+            return False
+        message = json.loads(row[0])
+        message['feedback'] = feedback
+        message['updatedAt'] = datetime.utcnow().isoformat()
+        connection.execute(
+            "UPDATE messages SET data = ? WHERE container = ? AND user_id = ? AND id = ?",
+            (json.dumps(message), self.container_name, user_id, message_id)
+        )
+        return message
+
+    def _set_feedbacks(self, connection, user_id, feedback):
+        return {message_id: self._set_feedback(connection, user_id, message_id, message_feedback) for message_id, message_feedback in feedback.items()}
+
+    async def update_message_feedback(self, user_id, message_id, feedback, etag = None):
+        return await self.write(self._set_feedback, user_id, message_id, feedback)
+
+    async def update_messages_feedback(self, user_id, feedback, etags = None):
+        return await self.write(self._set_feedbacks, user_id, feedback)
+
+    def _delete_conversation(self, connection, user_id, conversation_id):
+        connection.execute("DELETE FROM conversations WHERE container = ? AND user_id = ? AND id = ?", (self.container_name, user_id, conversation_id))
+
+    def _delete_messages(self, connection, user_id, conversation_id):
+        parameters = (self.container_name, user_id, conversation_id)
+        message_ids = [row[0] for row in connection.execute("SELECT id FROM messages WHERE container = ? AND user_id = ? AND conversation_id = ?", parameters)]
+        connection.execute("DELETE FROM messages WHERE container = ? AND user_id = ? AND conversation_id = ?", parameters)
+        return message_ids
+
+    def _delete_conversation_and_messages(self, connection, user_id, conversation_id):
+        self._delete_messages(connection, user_id, conversation_id)
+        self._delete_conversation(connection, user_id, conversation_id)
+        return conversation_id
+
+    def _delete_all(self, connection, user_id):
+        connection.execute("DELETE FROM messages WHERE container = ? AND user_id = ?", (self.container_name, user_id))
+        return connection.execute("DELETE FROM conversations WHERE container = ? AND user_id = ?", (self.container_name, user_id)).rowcount
+
+    async def delete_conversation(self, user_id, conversation_id):
+        await self.write(self._delete_conversation, user_id, conversation_id)
+        return True
+
+    async def delete_messages(self, conversation_id, user_id, concurrency = 4):
+        return await self.write(self._delete_messages, user_id, conversation_id)
+
+    async def delete_conversation_and_messages(self, user_id, conversation_id, concurrency = 4):
+        return await self.write(self._delete_conversation_and_messages, user_id, conversation_id)
+
+    async def delete_all_conversations(self, user_id, concurrency = 4, by_partition_key = False):
+        return await self.write(self._delete_all, user_id)
+
+    def _select_document_catalog(self, connection, user_id):
+        row = connection.execute("SELECT data FROM document_catalogs WHERE container = ? AND user_id = ?", (self.container_name, user_id)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _merge_document_catalog(self, connection, user_id, updates, removals):
+        documents = merge_document_catalog(self._select_document_catalog(connection, user_id) or {}, updates, removals)
+        connection.execute(
+            "INSERT OR REPLACE INTO document_catalogs (container, user_id, data) VALUES (?, ?, ?)",
+            (self.container_name, user_id, json.dumps(documents))
+        )
+        return documents
+
+    async def get_document_catalog(self, user_id):
+        return await self.read(self._select_document_catalog, user_id)
+
+    async def update_document_catalog(self, user_id, updates = None, removals = ()):
+        return await self.write(self._merge_document_catalog, user_id, updates, removals)
@@ -0,0 +1,163 @@
+import contextvars
+import functools
+import logging
+import time
+
+from backend.metrics import MetricsRegistry
+
+REQUEST_CHARGE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+ITEM_COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 1000)
+THROTTLE_RETRY_BUCKETS = (0, 1, 2, 4, 8, 16)
+# ContainerProxy methods that return a pager, whose requests are made while it is iterated
+PAGED_CONTAINER_OPERATIONS = ('query_items', 'read_all_items')
+ASYNC_CONTAINER_OPERATIONS = ('read_item', 'create_item', 'upsert_item', 'replace_item', 'patch_item', 'delete_item', 'execute_item_batch', 'delete_all_items_by_partition_key')
+
+# The client operation the CosmosDB calls of the running task belong to
+current_operation = contextvars.ContextVar("cosmos_operation", default=None)
+# The summary of the CosmosDB operations of the request being served
+current_request = contextvars.ContextVar("cosmos_request", default=None)
+
+
+class OperationMetrics():
+    def __init__(self, name: str, container_name: str):
+        self.name = name
+        self.container_name = container_name
+        self.request_charge = 0.0
+        self.items = 0
+        self.throttle_retries = 0
+        self.started_at = time.perf_counter()
+        self.seconds = 0.0
+        # Kept for pagers iterated after the request has ended, like streamed responses
+        self.request = current_request.get()
+
+    def on_response(self, pipeline_response):
+        """raw_response_hook for every HTTP response of the operation, including the throttled ones the SDK retries."""
+        response = pipeline_response.http_response
+        self.request_charge += float(response.headers.get('x-ms-request-charge') or 0)
+        if response.status_code == 429:
+            self.throttle_retries += 1
+        # Set on query pages
+        item_count = response.headers.get('x-ms-item-count')
+        if item_count:
+            self.items += int(item_count)
+
+
+class RequestSummary():
+    def __init__(self, route: str):
+        self.route = route
+        self.request_charge = 0.0
+        self.seconds = 0.0
+        self.throttle_retries = 0
+        self.operations = {}
+
+    def add(self, operation: OperationMetrics):
+        self.request_charge += operation.request_charge
+        self.seconds += operation.seconds
+        self.throttle_retries += operation.throttle_retries
+        count, request_charge = self.operations.get(operation.name, (0, 0.0))
+        self.operations[operation.name] = (count + 1, request_charge + operation.request_charge)
+
+    def describe(self):
+        operations = ", ".join(f"{name} x{count} {request_charge:.2f} RU" for name, (count, request_charge) in self.operations.items())
+        return (
+            f"CosmosDB usage of {self.route}: {sum(count for count, _ in self.operations.values())} operations, "
+            f"{self.request_charge:.2f} RU, {self.seconds * 1000:.1f} ms, {self.throttle_retries} throttling retries ({operations})"
+        )
+
+
+class CosmosTelemetry():
+    """
+    Records the request charge, latency, item count and throttling retries of CosmosDB operations as
+    histograms labelled by operation, container and route, and logs a summary of each request's usage.
+    """
+
+    def __init__(self, registry: MetricsRegistry, log_level: int = logging.INFO):
+        self.log_level = log_level
+        labels = ("operation", "container", "route")
+        self.request_charge = registry.histogram("cosmos_request_charge", "Request units charged per CosmosDB operation", labels, REQUEST_CHARGE_BUCKETS)
+        self.latency = registry.histogram("cosmos_operation_seconds", "Duration of CosmosDB operations in seconds", labels)
+        self.items = registry.histogram("cosmos_operation_items", "Items read or written per CosmosDB operation", labels, ITEM_COUNT_BUCKETS)
+        self.throttle_retries = registry.histogram("cosmos_throttle_retries", "Requests of a CosmosDB operation throttled with 429 and retried", labels, THROTTLE_RETRY_BUCKETS)
+
+    def instrument(self, container_client, container_name):
+        return InstrumentedContainer(container_client, self, container_name)
+
+    def record(self, operation: OperationMetrics):
+        operation.seconds = time.perf_counter() - operation.started_at
+        summary = operation.request
+        labels = {"operation": operation.name, "container": operation.container_name, "route": summary.route if summary else "none"}
+        self.request_charge.observe(operation.request_charge, **labels)
+        self.latency.observe(operation.seconds, **labels)
+        self.items.observe(operation.items, **labels)
+        self.throttle_retries.observe(operation.throttle_retries, **labels)
+        if summary:
+            summary.add(operation)
+
+    def start_request(self, route):
+        current_request.set(RequestSummary(route))
+
+    def end_request(self):
+        summary = current_request.get()
+        if summary and summary.operations:
+            logging.log(self.log_level, summary.describe())
+        current_request.set(None)
+
+
+class InstrumentedContainer():
+    """Wraps a ContainerProxy so the responses of every call are counted towards the current operation."""
+
+    def __init__(self, container_client, telemetry: CosmosTelemetry, container_name: str):
+        self.container_client = container_client
+        self.telemetry = telemetry
+        self.container_name = container_name
+
+    def __getattr__(self, name):
+        attribute = getattr(self.container_client, name)
+        if name in PAGED_CONTAINER_OPERATIONS:
+            @functools.wraps(attribute)
+            def paged(*args, **kwargs):
+                # Queries are only counted inside an operation, which finishes iterating them, or
+                # towards the operation whose hook the caller binds for a pager it iterates later
+                operation = current_operation.get()
+                if operation:
+                    kwargs.setdefault('raw_response_hook', operation.on_response)
+                return attribute(*args, **kwargs)
+            return paged
+
+        if name in ASYNC_CONTAINER_OPERATIONS:
+            @functools.wraps(attribute)
+            async def call(*args, **kwargs):
+                operation = current_operation.get()
+                standalone = operation is None
+                if standalone:
+                    operation = OperationMetrics(name, self.container_name)
+                kwargs['raw_response_hook'] = operation.on_response
+                try:
+                    result = await attribute(*args, **kwargs)
+                    if name == 'execute_item_batch':
+                        operation.items += len(kwargs.get('batch_operations') or args[0])
+                    elif name != 'delete_all_items_by_partition_key' and not (name == 'read_item' and result is None):
+                        operation.items += 1
+                    return result
+                finally:
+                    if standalone:
+                        self.telemetry.record(operation)
+            return call
+
+        return attribute
+
+
+def cosmos_operation(method):
+    """Records the CosmosDB calls a client method makes, including through other client methods, as one operation."""
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        if not self.telemetry or current_operation.get():
+            return await method(self, *args, **kwargs)
+        operation = OperationMetrics(method.__name__, self.container_name)
+        token = current_operation.set(operation)
+        try:
+            return await method(self, *args, **kwargs)
+        finally:
+            current_operation.reset(token)
+            self.telemetry.record(operation)
+    return wrapper
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+import time
+import uuid
+
+# Seconds a finished job's status stays available for polling
+DEFAULT_JOB_RETENTION = 3600
+
+
+class Job():
+    def __init__(self, user_id: str, kind: str):
+        self.id = str(uuid.uuid4())
+        self.user_id = user_id
+        self.kind = kind
+        self.status = "running"
+        self.error = None
+        self.result = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self.task = None
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "error": self.error,
+            "result": self.result,
+        }
+
+
+class JobTracker():
+    """
+    Tracks long-running work, such as bulk deletes, that may outlast the request that started it.
+
+    The request waits up to a short timeout; if the job is still running it answers with the job id
+    and the client polls for the status. Jobs live in this worker's memory, so polling has to reach
+    the same worker (e.g. with session affinity) to see the job.
+    """
+
+    def __init__(self, retention: float = DEFAULT_JOB_RETENTION):
+        self.retention = retention
+        self._jobs = {}
+
+    def _prune(self):
+        now = time.time()
+        for job_id, job in list(self._jobs.items()):
+            if job.finished_at and now - job.finished_at > self.retention:
+                del self._jobs[job_id]
+
+    async def _run(self, job, coroutine):
+        try:
+            job.result = await coroutine
+            job.status = "succeeded"
+        except Exception as e:
+            logging.exception(f"Exception in {job.kind} job {job.id}")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+
+    def start(self, user_id, kind, coroutine, run_in_background=asyncio.ensure_future):
+        self._prune()
+        job = Job(user_id, kind)
+        job.task = run_in_background(self._run(job, coroutine))
+        self._jobs[job.id] = job
+        return job
+
+    async def wait(self, job, timeout):
+        """Waits up to timeout seconds for the job; returns whether it finished."""
+        await asyncio.wait({job.task}, timeout=timeout)
+        return job.status != "running"
+
+    def get(self, user_id, job_id):
+        job = self._jobs.get(job_id)
+        if not job or job.user_id != user_id:
+            return None
+        return job
@@ -0,0 +1,70 @@
+import threading
+
+# Upper bounds of the default histogram buckets, in seconds
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram():
+    """Cumulative bucket counts, sum and count of the observed values, per set of label values."""
+
+    def __init__(self, name: str, description: str, label_names, buckets=DEFAULT_LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.label_names)
+        with self._lock:
+            series = self._series.get(key)
+            if not series:
+                series = self._series[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def collect(self):
+        with self._lock:
+            return {key: {"buckets": list(series["buckets"]), "sum": series["sum"], "count": series["count"]} for key, series in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self.collect().items()):
+            labels = [f'{name}="{escape_label(value)}"' for name, value in zip(self.label_names, key)]
+            for bound, count in zip(self.buckets, series["buckets"]):
+                bucket_labels = format_labels(labels + [f'le="{bound}"'])
+                lines.append(f"{self.name}_bucket{bucket_labels} {count}")
+            bucket_labels = format_labels(labels + ['le="+Inf"'])
+            lines.append(f"{self.name}_bucket{bucket_labels} {series['count']}")
+            lines.append(f"{self.name}_sum{format_labels(labels)} {series['sum']}")
+            lines.append(f"{self.name}_count{format_labels(labels)} {series['count']}")
+        return "\n".join(lines)
+
+
+def format_labels(labels):
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+def escape_label(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry():
+    """
+    The histograms of this worker process, rendered in the Prometheus text format for /metrics.
+    Each worker keeps its own, so a scrape only sees the worker that answered it.
+    """
+
+    def __init__(self):
+        self._histograms = {}
+
+    def histogram(self, name: str, description: str, label_names, buckets=DEFAULT_LATENCY_BUCKETS):
+        if name not in self._histograms:
+            self._histograms[name] = Histogram(name, description, label_names, buckets)
+        return self._histograms[name]
+
+    def render(self):
+        return "\n".join(histogram.render() for histogram in self._histograms.values()) + "\n"
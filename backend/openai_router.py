@@ -0,0 +1,210 @@
+import asyncio
+import logging
+import random
+import time
+from types import SimpleNamespace
+
+import openai
+
+# Consecutive failures before a backend's circuit opens, and how long it stays open
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_CIRCUIT_COOLDOWN = 30
+# Cooldown used when a 429 carries no retry-after header
+DEFAULT_RETRY_AFTER = 5
+# Longest time to wait for a cooling-down backend when every backend is unavailable
+MAX_WAIT_FOR_BACKEND = 10
+
+
+def get_retry_after(headers):
+    """Seconds to wait according to the retry-after-ms or retry-after response headers."""
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class OpenAIBackend():
+    def __init__(self, name: str, client, deployment: str, weight: float = 1):
+        self.name = name
+        self.client = client
+        self.deployment = deployment
+        self.weight = weight
+        self.outstanding = 0
+        self.failures = 0
+        self.unavailable_until = 0
+        self.circuit_open = False
+        self.probing = False
+        self.remaining_requests = None
+        self.remaining_tokens = None
+
+    def is_available(self, now):
+        # Once its cooldown is over an open circuit is half-open: it takes one probe request at a time
+        return now >= self.unavailable_until and not self.probing
+
+    def is_saturated(self):
+        return self.remaining_requests == 0 or self.remaining_tokens == 0
+
+    def score(self):
+        return (self.outstanding + 1) / self.weight
+
+    def record_headers(self, headers):
+        for header, attribute in (("x-ratelimit-remaining-requests", "remaining_requests"), ("x-ratelimit-remaining-tokens", "remaining_tokens")):
+            value = headers.get(header) if headers else None
+            if value is not None:
+                try:
+                    setattr(self, attribute, int(value))
+                except ValueError:
+                    pass
+
+    def record_success(self, headers):
+        self.failures = 0
+        self.probing = False
+        if self.circuit_open:
+            logging.info(f"Azure OpenAI backend {self.name} recovered, closing its circuit")
+            self.circuit_open = False
+        self.record_headers(headers)
+
+    def record_throttled(self, headers):
+        retry_after = get_retry_after(headers) or DEFAULT_RETRY_AFTER
+        self.probing = False
+        self.unavailable_until = time.monotonic() + retry_after
+        self.record_headers(headers)
+        logging.warning(f"Azure OpenAI backend {self.name} throttled, retrying other backends for {retry_after}s")
+
+    def record_failure(self, failure_threshold, cooldown):
+        self.failures += 1
+        self.probing = False
+        if self.circuit_open or self.failures >= failure_threshold:
+            # A failed probe opens the circuit for another cooldown
+            self.circuit_open = True
+            self.unavailable_until = time.monotonic() + cooldown
+            logging.warning(f"Azure OpenAI backend {self.name} failed {self.failures} times, opening its circuit for {cooldown}s")
+
+
+class RoutedStream():
+    """Wraps a streamed response so its backend counts as busy until the stream ends."""
+
+    def __init__(self, stream, on_done):
+        self.stream = stream
+        self.on_done = on_done
+
+    def _done(self):
+        if self.on_done:
+            self.on_done()
+            self.on_done = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.stream.__anext__()
+        except BaseException:
+            self._done()
+            raise
+
+    async def close(self):
+        self._done()
+        await self.stream.close()
+
+    async def aclose(self):
+        await self.close()
+
+    def __del__(self):
+        # A consumer that goes away without closing the stream must not keep the backend busy
+        self._done()
+
+
+class OpenAIRouter():
+    """
+    Spreads chat completions over a pool of Azure OpenAI deployments.
+
+    Requests go to the available backend with the fewest outstanding requests relative to
+    its weight. A 429 takes the backend out of rotation for its retry-after period and the
+    request fails over to the next backend; repeated errors open the backend's circuit.
+    Exposes chat.completions.create like AsyncAzureOpenAI so call sites do not change.
+    """
+
+    def __init__(self, backends, failure_threshold=DEFAULT_FAILURE_THRESHOLD, circuit_cooldown=DEFAULT_CIRCUIT_COOLDOWN, max_attempts=None):
+        if not backends:
+            raise ValueError("At least one Azure OpenAI backend is required")
+        self.backends = backends
+        self.failure_threshold = failure_threshold
+        self.circuit_cooldown = circuit_cooldown
+        self.max_attempts = max_attempts or max(3, len(backends) + 1)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create_chat_completion))
+
+    def pick_backend(self, exclude=()):
+        now = time.monotonic()
+        candidates = [backend for backend in self.backends if backend.is_available(now) and backend not in exclude]
+        if not candidates:
+            return None
+        unsaturated = [backend for backend in candidates if not backend.is_saturated()]
+        candidates = unsaturated or candidates
+        best_score = min(backend.score() for backend in candidates)
+        return random.choice([backend for backend in candidates if backend.score() == best_score])
+
+    async def wait_for_backend(self, exclude=()):
+        backend = self.pick_backend(exclude) or self.pick_backend()
+        if backend:
+            return backend
+        # Every backend is cooling down; wait for the first to come back rather than fail
+        wait = min(backend.unavailable_until for backend in self.backends) - time.monotonic()
+        if wait > MAX_WAIT_FOR_BACKEND:
+            return None
+        await asyncio.sleep(max(wait, 0))
+        return self.pick_backend()
+
+    async def create_chat_completion(self, **model_args):
+        tried = []
+        last_error = None
+        for attempt in range(self.max_attempts):
+            backend = await self.wait_for_backend(exclude=tried)
+            if not backend:
+                break
+            tried.append(backend)
+            if len(tried) == len(self.backends):
+                tried = []
+
+            backend.outstanding += 1
+            ## a request to a backend whose circuit is open is the probe of its half-open circuit
+            backend.probing = backend.circuit_open
+            try:
+                raw_response = await backend.client.chat.completions.with_raw_response.create(**{**model_args, "model": backend.deployment})
+            except openai.RateLimitError as e:
+                backend.outstanding -= 1
+                backend.record_throttled(e.response.headers)
+                last_error = e
+                continue
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                backend.outstanding -= 1
+                backend.record_failure(self.failure_threshold, self.circuit_cooldown)
+                last_error = e
+                continue
+            except BaseException:
+                backend.outstanding -= 1
+                backend.probing = False
+                raise
+
+            backend.record_success(raw_response.headers)
+            response = raw_response.parse()
+            if model_args.get("stream"):
+                def on_done(backend=backend):
+                    backend.outstanding -= 1
+                return RoutedStream(response, on_done)
+            backend.outstanding -= 1
+            return response
+
+        if last_error:
+            raise last_error
+        raise Exception("No Azure OpenAI backend is available")
+
+    async def close(self):
+        for backend in self.backends:
+            await backend.client.close()
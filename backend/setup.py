@@ -1,12 +1,9 @@
-import copy
+import asyncio
 import json
 import os
-import random
 import re
 import logging
 import shutil
-import tempfile
-from typing import List
 from dotenv import load_dotenv
 
 from langchain_openai import AzureOpenAIEmbeddings
@@ -15,37 +12,46 @@ from quart import (
     request,
 )
 
-from openai import AsyncAzureOpenAI
+import httpx
+from openai import AsyncAzureOpenAI, DefaultAsyncHttpxClient
 from azure.identity.aio import DefaultAzureCredential, get_bearer_token_provider
 from backend.auth.auth_utils import get_authenticated_user_details
+from azure.cosmos.aio import CosmosClient
+from backend.history.conversation_cache import ConversationCache
 from backend.history.cosmosdbservice import CosmosConversationClient
-
-
-import tiktoken
+from backend.history.spool import SpooledHistoryClient
+from backend.history.sqliteservice import SqliteConversationClient
+from backend.history.telemetry import CosmosTelemetry
+from backend.completion_cache import CompletionCache
+from backend.document_loader import DocumentLoader
+from backend.graph import GraphGroupResolver
+from backend.jobs import JobTracker
+from backend.metrics import MetricsRegistry
+from backend.openai_router import OpenAIBackend, OpenAIRouter
+from backend.token_budget import HistoryTokenBudget
 
 
 from azure.core.credentials import AzureKeyCredential
+from azure.core.exceptions import ResourceExistsError
 from azure.storage.blob import BlobServiceClient
 from azure.storage.blob.aio import BlobClient as AsyncBlobClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
 from azure.storage.blob import BlobClient
 
 from azure.search.documents import SearchClient
+from azure.search.documents.aio import SearchClient as AsyncSearchClient
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import *
 
-from backend.utils import generateFilterString, generateSimpleFilterString, parse_multi_columns
+from backend.utils import generateSimpleFilterString, parse_multi_columns
 from opentelemetry.trace import SpanKind
 from opentelemetry import trace
 from opentelemetry import metrics
 # from azure.monitor.opentelemetry import configure_azure_monitor
 from azure.monitor.events.extension import track_event
 
-from langchain_community.document_loaders import PyPDFLoader, TextLoader, Docx2txtLoader
-from langchain_core.documents import Document
 from langchain_community.vectorstores.azuresearch import AzureSearch
 from langchain_community.retrievers import AzureCognitiveSearchRetriever
-from langchain_community.document_loaders import UnstructuredExcelLoader
-from langchain_community.document_loaders.csv_loader import CSVLoader
 
 MONITORING_ENABLED = False
 # if MONITORING_ENABLED:
@@ -54,8 +60,6 @@ MONITORING_ENABLED = False
 #     meter = metrics.get_meter_provider().get_meter("otel_azure_monitor_counter_demo")
 #     counter = meter.create_counter("counter")
 
-from backend.utils import generateFilterString, parse_multi_columns
-
 
 # Current minimum Azure OpenAI version supported
 MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION="2024-02-15-preview"
@@ -97,6 +101,14 @@ SEARCH_ENABLE_IN_DOMAIN = os.environ.get("SEARCH_ENABLE_IN_DOMAIN", "true")
 # Document storage settings
 AZURE_STORAGE_ACCOUNT = os.environ.get("AZURE_STORAGE_ACCOUNT")
 AZURE_STORAGE_KEY = os.environ.get("AZURE_STORAGE_KEY")
+AZURE_STORAGE_UPLOAD_CONCURRENCY = os.environ.get("AZURE_STORAGE_UPLOAD_CONCURRENCY", 4) # Files of an upload request sent at once
+AZURE_STORAGE_BLOCK_CONCURRENCY = os.environ.get("AZURE_STORAGE_BLOCK_CONCURRENCY", 4) # Blocks of a large file sent at once
+DOCUMENT_PARSER_PROCESSES = os.environ.get("DOCUMENT_PARSER_PROCESSES", 2) # Processes parsing documents for ingestion, and documents loaded at once
+DOCUMENT_PARSER_IN_MEMORY_LIMIT_MB = os.environ.get("DOCUMENT_PARSER_IN_MEMORY_LIMIT_MB", 32) # Larger documents are downloaded to a temporary file
+DOCUMENT_PARSER_MEMORY_LIMIT_MB = os.environ.get("DOCUMENT_PARSER_MEMORY_LIMIT_MB", 2048) # Address space of a parser process, 0 for no limit
+DOCUMENT_PARSER_MAX_TASKS_PER_CHILD = os.environ.get("DOCUMENT_PARSER_MAX_TASKS_PER_CHILD", 10) # Documents a parser process parses before it is replaced
+DOCUMENT_INGESTION_CONCURRENCY = os.environ.get("DOCUMENT_INGESTION_CONCURRENCY", 3) # Files of a request ingested at once
+DOCUMENT_INDEX_BATCH_SIZE = os.environ.get("DOCUMENT_INDEX_BATCH_SIZE", 100) # Chunks embedded and added to the search index at once
 
 
 # ACS Integration Settings
@@ -114,7 +126,10 @@ AZURE_SEARCH_URL_COLUMN = os.environ.get("AZURE_SEARCH_URL_COLUMN")
 AZURE_SEARCH_VECTOR_COLUMNS = os.environ.get("AZURE_SEARCH_VECTOR_COLUMNS")
 AZURE_SEARCH_QUERY_TYPE = os.environ.get("AZURE_SEARCH_QUERY_TYPE")
 AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN")
+AZURE_SEARCH_GROUPS_CACHE_TTL = os.environ.get("AZURE_SEARCH_GROUPS_CACHE_TTL", 900) # Seconds a user's Graph group memberships are cached
+AZURE_SEARCH_GROUPS_REFRESH_AFTER = os.environ.get("AZURE_SEARCH_GROUPS_REFRESH_AFTER") # Seconds after which cached groups are refreshed in the background, defaults to 80% of the TTL
 AZURE_SEARCH_STRICTNESS = os.environ.get("AZURE_SEARCH_STRICTNESS", SEARCH_STRICTNESS)
+AZURE_SEARCH_DELETE_BATCH_SIZE = os.environ.get("AZURE_SEARCH_DELETE_BATCH_SIZE", 1000) # Chunks read and deleted per request to the index, 1000 at most
 
 # AOAI Integration Settings
 AZURE_OPENAI_RESOURCE = os.environ.get("AZURE_OPENAI_RESOURCE")
@@ -128,11 +143,27 @@ AZURE_OPENAI_STOP_SEQUENCE = os.environ.get("AZURE_OPENAI_STOP_SEQUENCE")
 AZURE_OPENAI_SYSTEM_MESSAGE = os.environ.get("AZURE_OPENAI_SYSTEM_MESSAGE", "You are an AI assistant that helps people find information.")
 AZURE_OPENAI_PREVIEW_API_VERSION = os.environ.get("AZURE_OPENAI_PREVIEW_API_VERSION", MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION)
 AZURE_OPENAI_STREAM = os.environ.get("AZURE_OPENAI_STREAM", "true")
+AZURE_OPENAI_STREAM_FLUSH_INTERVAL_MS = os.environ.get("AZURE_OPENAI_STREAM_FLUSH_INTERVAL_MS", 30) # Only used by the compact stream protocol
+AZURE_OPENAI_STREAM_FLUSH_SIZE = os.environ.get("AZURE_OPENAI_STREAM_FLUSH_SIZE", 1024)
+AZURE_OPENAI_STREAM_RETRIES = os.environ.get("AZURE_OPENAI_STREAM_RETRIES", 2) # Retries when the data source returns no citations
+AZURE_OPENAI_STREAM_RETRY_BACKOFF_MS = os.environ.get("AZURE_OPENAI_STREAM_RETRY_BACKOFF_MS", 250)
+AZURE_OPENAI_STREAM_HEDGE_AFTER_MS = os.environ.get("AZURE_OPENAI_STREAM_HEDGE_AFTER_MS") # Unset disables hedged requests
 AZURE_OPENAI_MODEL_NAME = os.environ.get("AZURE_OPENAI_MODEL_NAME", "gpt-35-turbo-16k") # Name of the model, e.g. 'gpt-35-turbo-16k' or 'gpt-4'
 AZURE_OPENAI_EMBEDDING_ENDPOINT = os.environ.get("AZURE_OPENAI_EMBEDDING_ENDPOINT")
 AZURE_OPENAI_EMBEDDING_KEY = os.environ.get("AZURE_OPENAI_EMBEDDING_KEY")
 AZURE_OPENAI_EMBEDDING_NAME = os.environ.get("AZURE_OPENAI_EMBEDDING_NAME", "")
 AZURE_OPENAI_EMBEDDING_MODEL_NAME = os.environ.get("AZURE_OPENAI_EMBEDDING_MODEL_NAME")
+AZURE_OPENAI_MAX_CONNECTIONS = os.environ.get("AZURE_OPENAI_MAX_CONNECTIONS", 100)
+AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS = os.environ.get("AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS", 20)
+AZURE_OPENAI_KEEPALIVE_EXPIRY = os.environ.get("AZURE_OPENAI_KEEPALIVE_EXPIRY", 30)
+AZURE_OPENAI_CONTEXT_WINDOW = os.environ.get("AZURE_OPENAI_CONTEXT_WINDOW") # Defaults to the known context window of AZURE_OPENAI_MODEL_NAME
+AZURE_OPENAI_MAX_HISTORY_TOKENS = os.environ.get("AZURE_OPENAI_MAX_HISTORY_TOKENS")
+AZURE_OPENAI_BACKENDS = os.environ.get("AZURE_OPENAI_BACKENDS") # JSON list of {"endpoint", "deployment", "key", "weight"}, defaults to AZURE_OPENAI_ENDPOINT and AZURE_OPENAI_MODEL
+AZURE_OPENAI_CIRCUIT_BREAKER_FAILURES = os.environ.get("AZURE_OPENAI_CIRCUIT_BREAKER_FAILURES", 5)
+AZURE_OPENAI_CIRCUIT_BREAKER_COOLDOWN = os.environ.get("AZURE_OPENAI_CIRCUIT_BREAKER_COOLDOWN", 30)
+AZURE_OPENAI_CACHE_TTL = os.environ.get("AZURE_OPENAI_CACHE_TTL", 0) # Seconds, 0 disables the completion cache
+AZURE_OPENAI_CACHE_MAX_ENTRIES = os.environ.get("AZURE_OPENAI_CACHE_MAX_ENTRIES", 1000)
+AZURE_OPENAI_CACHE_SQLITE_PATH = os.environ.get("AZURE_OPENAI_CACHE_SQLITE_PATH")
 
 # CosmosDB Mongo vcore vector db Settings
 AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING = os.environ.get("AZURE_COSMOSDB_MONGO_VCORE_CONNECTION_STRING")  #This has to be secure string
@@ -149,6 +180,19 @@ AZURE_COSMOSDB_MONGO_VCORE_URL_COLUMN = os.environ.get("AZURE_COSMOSDB_MONGO_VCO
 AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS = os.environ.get("AZURE_COSMOSDB_MONGO_VCORE_VECTOR_COLUMNS")
 
 SHOULD_STREAM = True if AZURE_OPENAI_STREAM.lower() == "true" else False
+COMPACT_STREAM_PROTOCOL = "compact"
+# Conversations returned per /history/list page
+HISTORY_PAGE_SIZE = 25
+# Messages per page of a streamed /history/read
+HISTORY_READ_PAGE_SIZE = 100
+# Seconds a history delete runs inline before the request answers with a job id to poll
+HISTORY_JOB_WAIT_SECONDS = 10
+# Most ratings /history/message_feedback/batch takes in one request
+HISTORY_FEEDBACK_BATCH_SIZE = 100
+# Words of the user's first question used as a new conversation's title until the generated one is ready
+PROVISIONAL_TITLE_WORDS = 4
+# Seconds a worker waits for background tasks, such as title generation, when shutting down
+BACKGROUND_TASKS_SHUTDOWN_TIMEOUT = 10
 
 # Chat History CosmosDB Integration Settings
 AZURE_COSMOSDB_DATABASE = os.environ.get("AZURE_COSMOSDB_DATABASE")
@@ -156,6 +200,19 @@ AZURE_COSMOSDB_ACCOUNT = os.environ.get("AZURE_COSMOSDB_ACCOUNT")
 AZURE_COSMOSDB_CONVERSATIONS_CONTAINER = os.environ.get("AZURE_COSMOSDB_CONVERSATIONS_CONTAINER")
 AZURE_COSMOSDB_ACCOUNT_KEY = os.environ.get("AZURE_COSMOSDB_ACCOUNT_KEY")
 AZURE_COSMOSDB_ENABLE_FEEDBACK = os.environ.get("AZURE_COSMOSDB_ENABLE_FEEDBACK", "false").lower() == "true"
+AZURE_COSMOSDB_DELETE_CONCURRENCY = os.environ.get("AZURE_COSMOSDB_DELETE_CONCURRENCY", 4) # Delete batches run at once per request
+AZURE_COSMOSDB_DELETE_BY_PARTITION_KEY = os.environ.get("AZURE_COSMOSDB_DELETE_BY_PARTITION_KEY", "false").lower() == "true"
+AZURE_COSMOSDB_CACHE_TTL = os.environ.get("AZURE_COSMOSDB_CACHE_TTL", 3600) # Seconds conversations and their messages stay in a worker's cache, 0 disables it
+AZURE_COSMOSDB_CACHE_MAX_ENTRIES = os.environ.get("AZURE_COSMOSDB_CACHE_MAX_ENTRIES", 1000)
+AZURE_COSMOSDB_MESSAGE_LAYOUT = os.environ.get("AZURE_COSMOSDB_MESSAGE_LAYOUT", "items") # "items" or "buckets", for new conversations
+AZURE_COSMOSDB_MESSAGE_BUCKET_SIZE = os.environ.get("AZURE_COSMOSDB_MESSAGE_BUCKET_SIZE", 50)
+CHAT_HISTORY_BACKEND = os.environ.get("CHAT_HISTORY_BACKEND", "cosmosdb").lower() # "cosmosdb" or "sqlite"
+CHAT_HISTORY_SQLITE_PATH = os.environ.get("CHAT_HISTORY_SQLITE_PATH", "chat_history.db")
+AZURE_COSMOSDB_REQUEST_LOG_LEVEL = os.environ.get("AZURE_COSMOSDB_REQUEST_LOG_LEVEL", "WARNING") # Level of the per-request CosmosDB usage summary
+AZURE_COSMOSDB_LOGS_SPOOL_ENABLED = os.environ.get("AZURE_COSMOSDB_LOGS_SPOOL_ENABLED", "true").lower() == "true" # Writes to the logs container go through a local spool, behind the request
+AZURE_COSMOSDB_LOGS_SPOOL_DIR = os.environ.get("AZURE_COSMOSDB_LOGS_SPOOL_DIR", "logs_spool")
+AZURE_COSMOSDB_LOGS_SPOOL_BATCH_SIZE = os.environ.get("AZURE_COSMOSDB_LOGS_SPOOL_BATCH_SIZE", 100)
+AZURE_COSMOSDB_LOGS_SPOOL_MAX_QUEUE = os.environ.get("AZURE_COSMOSDB_LOGS_SPOOL_MAX_QUEUE", 10000) # Writes waiting before new ones wait for room
 
 # Elasticsearch Integration Settings
 ELASTICSEARCH_ENDPOINT = os.environ.get("ELASTICSEARCH_ENDPOINT")
@@ -202,7 +259,7 @@ AZURE_MLINDEX_QUERY_TYPE = os.environ.get("AZURE_MLINDEX_QUERY_TYPE")
 
 # Frontend Settings via Environment Variables
 AUTH_ENABLED = os.environ.get("AUTH_ENABLED", "true").lower() == "true"
-CHAT_HISTORY_ENABLED = AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER
+CHAT_HISTORY_ENABLED = CHAT_HISTORY_BACKEND == "sqlite" or (AZURE_COSMOSDB_ACCOUNT and AZURE_COSMOSDB_DATABASE and AZURE_COSMOSDB_CONVERSATIONS_CONTAINER)
 SANITIZE_ANSWER = os.environ.get("SANITIZE_ANSWER", "false").lower() == "true"
 
 print("cosmosdb key", AZURE_COSMOSDB_ACCOUNT_KEY)
@@ -253,8 +310,51 @@ def should_use_data():
 
 SHOULD_USE_DATA = should_use_data()
 
+history_budget = HistoryTokenBudget(
+    model_name=AZURE_OPENAI_MODEL_NAME,
+    max_tokens=int(AZURE_OPENAI_MAX_TOKENS),
+    context_window=int(AZURE_OPENAI_CONTEXT_WINDOW) if AZURE_OPENAI_CONTEXT_WINDOW else None,
+    max_history_tokens=int(AZURE_OPENAI_MAX_HISTORY_TOKENS) if AZURE_OPENAI_MAX_HISTORY_TOKENS else None,
+    system_message=AZURE_OPENAI_SYSTEM_MESSAGE
+)
+
+# Model args that do not change between requests, parsed once
+MODEL_ARGS_TEMPLATE = {
+    "temperature": float(AZURE_OPENAI_TEMPERATURE),
+    "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
+    "top_p": float(AZURE_OPENAI_TOP_P),
+    "stop": parse_multi_columns(AZURE_OPENAI_STOP_SEQUENCE) if AZURE_OPENAI_STOP_SEQUENCE else None,
+    "stream": SHOULD_STREAM,
+    "model": AZURE_OPENAI_MODEL,
+}
+
+completion_cache = CompletionCache(
+    ttl=float(AZURE_OPENAI_CACHE_TTL),
+    max_entries=int(AZURE_OPENAI_CACHE_MAX_ENTRIES),
+    sqlite_path=AZURE_OPENAI_CACHE_SQLITE_PATH or None
+)
+
+history_jobs = JobTracker()
+
+# Metrics
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "false").lower() == "true" # Serves /metrics
+metrics_registry = MetricsRegistry()
+cosmos_telemetry = CosmosTelemetry(metrics_registry, log_level=logging.getLevelName(AZURE_COSMOSDB_REQUEST_LOG_LEVEL.upper()))
+
+conversation_cache = ConversationCache(
+    max_entries=int(AZURE_COSMOSDB_CACHE_MAX_ENTRIES),
+    ttl=float(AZURE_COSMOSDB_CACHE_TTL)
+) if float(AZURE_COSMOSDB_CACHE_TTL) > 0 else None
+
+group_resolver = GraphGroupResolver(
+    permitted_groups_column=AZURE_SEARCH_PERMITTED_GROUPS_COLUMN,
+    ttl=float(AZURE_SEARCH_GROUPS_CACHE_TTL),
+    refresh_after=float(AZURE_SEARCH_GROUPS_REFRESH_AFTER) if AZURE_SEARCH_GROUPS_REFRESH_AFTER else None
+)
+
 # Initialize Azure OpenAI Client
-def init_openai_client(use_data=SHOULD_USE_DATA):
+def init_openai_client(use_data=SHOULD_USE_DATA, http_client=None, ad_token_provider=None, endpoint=None, api_key=None, max_retries=None):
     azure_openai_client = None
     try:
         # API version check
@@ -262,15 +362,17 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
             raise Exception(f"The minimum supported Azure OpenAI preview API version is '{MINIMUM_SUPPORTED_AZURE_OPENAI_PREVIEW_API_VERSION}'")
         
         # Endpoint
-        if not AZURE_OPENAI_ENDPOINT and not AZURE_OPENAI_RESOURCE:
+        if not endpoint and not AZURE_OPENAI_ENDPOINT and not AZURE_OPENAI_RESOURCE:
             raise Exception("AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE is required")
         
-        endpoint = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
+        if not endpoint:
+            endpoint = AZURE_OPENAI_ENDPOINT if AZURE_OPENAI_ENDPOINT else f"https://{AZURE_OPENAI_RESOURCE}.openai.azure.com/"
         
         # Authentication
-        aoai_api_key = AZURE_OPENAI_KEY
-        ad_token_provider = None
-        if not aoai_api_key:
+        aoai_api_key = api_key if api_key is not None else AZURE_OPENAI_KEY
+        if aoai_api_key:
+            ad_token_provider = None
+        elif not ad_token_provider:
             logging.debug("No AZURE_OPENAI_KEY found, using Azure AD auth")
             ad_token_provider = get_bearer_token_provider(DefaultAzureCredential(), "https://cognitiveservices.azure.com/.default")
 
@@ -289,8 +391,11 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
             api_key=aoai_api_key,
             azure_ad_token_provider=ad_token_provider,
             default_headers=default_headers,
-            azure_endpoint=endpoint
+            azure_endpoint=endpoint,
+            http_client=http_client
         )
+        if max_retries is not None:
+            azure_openai_client = azure_openai_client.with_options(max_retries=max_retries)
             
         return azure_openai_client
     except Exception as e:
@@ -298,6 +403,234 @@ def init_openai_client(use_data=SHOULD_USE_DATA):
         azure_openai_client = None
         raise e
 
+def init_openai_http_client():
+    limits = httpx.Limits(
+        max_connections=int(AZURE_OPENAI_MAX_CONNECTIONS),
+        max_keepalive_connections=int(AZURE_OPENAI_MAX_KEEPALIVE_CONNECTIONS),
+        keepalive_expiry=float(AZURE_OPENAI_KEEPALIVE_EXPIRY)
+    )
+    return DefaultAsyncHttpxClient(limits=limits)
+
+
+def get_openai_backend_configs():
+    if not AZURE_OPENAI_BACKENDS:
+        return [{"endpoint": None, "deployment": AZURE_OPENAI_MODEL, "key": AZURE_OPENAI_KEY, "weight": 1}]
+
+    backend_configs = json.loads(AZURE_OPENAI_BACKENDS)
+    if not isinstance(backend_configs, list) or not backend_configs:
+        raise Exception("AZURE_OPENAI_BACKENDS must be a non-empty JSON list")
+    for backend_config in backend_configs:
+        if not backend_config.get("endpoint"):
+            raise Exception("Every entry in AZURE_OPENAI_BACKENDS needs an endpoint")
+        backend_config.setdefault("deployment", AZURE_OPENAI_MODEL)
+        backend_config.setdefault("key", AZURE_OPENAI_KEY)
+        backend_config.setdefault("weight", 1)
+    return backend_configs
+
+
+class ClientRegistry():
+    """
+    Clients that live for the lifetime of a worker rather than a single request.
+
+    Started from the app's before_serving hook and closed from after_serving, so every
+    request in the worker shares one connection pool and one cached AAD token.
+    Clients are also created lazily on first use so scripts and tests work without
+    the app lifecycle.
+    """
+
+    def __init__(self):
+        self.http_client = None
+        self.credential = None
+        self.ad_token_provider = None
+        self.openai_client = None
+        self.cosmosdb_client = None
+        self.cosmos_conversation_client = None
+        self.cosmos_logs_client = None
+        self.blob_service_client = None
+        self.search_client = None
+        self.document_loader = None
+        # Blob containers this worker has already created, one per user
+        self.blob_containers = set()
+        self.background_tasks = set()
+
+    def run_in_background(self, coroutine):
+        """Runs work that outlives the request that started it; close() waits for it to finish."""
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+
+    def get_credential(self):
+        if not self.credential:
+            self.credential = DefaultAzureCredential()
+        return self.credential
+
+    def get_ad_token_provider(self):
+        if not self.ad_token_provider:
+            self.ad_token_provider = get_bearer_token_provider(self.get_credential(), "https://cognitiveservices.azure.com/.default")
+        return self.ad_token_provider
+
+    def get_openai_client(self):
+        if self.openai_client:
+            return self.openai_client
+
+        if not self.http_client:
+            self.http_client = init_openai_http_client()
+
+        backends = []
+        for backend_config in get_openai_backend_configs():
+            client = init_openai_client(
+                http_client=self.http_client,
+                ad_token_provider=None if backend_config["key"] else self.get_ad_token_provider(),
+                endpoint=backend_config["endpoint"],
+                api_key=backend_config["key"] or "",
+                # The router retries and fails over itself
+                max_retries=0
+            )
+            backends.append(OpenAIBackend(
+                name=backend_config["endpoint"] or AZURE_OPENAI_ENDPOINT or AZURE_OPENAI_RESOURCE,
+                client=client,
+                deployment=backend_config["deployment"],
+                weight=float(backend_config["weight"])
+            ))
+
+        self.openai_client = OpenAIRouter(
+            backends,
+            failure_threshold=int(AZURE_OPENAI_CIRCUIT_BREAKER_FAILURES),
+            circuit_cooldown=float(AZURE_OPENAI_CIRCUIT_BREAKER_COOLDOWN)
+        )
+        return self.openai_client
+
+    def get_blob_service_client(self):
+        if not self.blob_service_client:
+            self.blob_service_client = init_blob_service_client()
+        return self.blob_service_client
+
+    async def ensure_blob_container(self, container_name):
+        """Creates the container the first time this worker needs it, and returns its client."""
+        container_client = self.get_blob_service_client().get_container_client(container_name)
+        if container_name not in self.blob_containers:
+            try:
+                await container_client.create_container()
+                logging.debug(f"Container '{container_name}' created.")
+            except ResourceExistsError:
+                pass
+            self.blob_containers.add(container_name)
+        return container_client
+
+    def get_search_client(self):
+        if not self.search_client:
+            self.search_client = init_async_search_client()
+        return self.search_client
+
+    def get_document_loader(self):
+        if not self.document_loader:
+            self.document_loader = DocumentLoader(
+                processes=int(DOCUMENT_PARSER_PROCESSES),
+                in_memory_limit=int(DOCUMENT_PARSER_IN_MEMORY_LIMIT_MB) * 1024 * 1024,
+                memory_limit=int(DOCUMENT_PARSER_MEMORY_LIMIT_MB) * 1024 * 1024,
+                max_tasks_per_child=int(DOCUMENT_PARSER_MAX_TASKS_PER_CHILD),
+                block_concurrency=int(AZURE_STORAGE_BLOCK_CONCURRENCY)
+            )
+        return self.document_loader
+
+    def get_cosmosdb_account_client(self):
+        if not self.cosmosdb_client:
+            self.cosmosdb_client = init_cosmosdb_account_client(credential=None if AZURE_COSMOSDB_ACCOUNT_KEY else self.get_credential())
+        return self.cosmosdb_client
+
+    def get_cosmos_conversation_client(self):
+        if not self.cosmos_conversation_client and CHAT_HISTORY_ENABLED:
+            if CHAT_HISTORY_BACKEND == "sqlite":
+                self.cosmos_conversation_client = init_sqlite_history_client(AZURE_COSMOSDB_CONVERSATIONS_CONTAINER or "conversations")
+                return self.cosmos_conversation_client
+            self.cosmos_conversation_client = init_cosmosdb_client(self.get_cosmosdb_account_client(), cache=conversation_cache, telemetry=cosmos_telemetry)
+        return self.cosmos_conversation_client
+
+    def get_cosmos_logs_client(self):
+        if not self.cosmos_logs_client and CHAT_HISTORY_ENABLED:
+            if CHAT_HISTORY_BACKEND == "sqlite":
+                self.cosmos_logs_client = init_sqlite_history_client("logs")
+                return self.cosmos_logs_client
+            self.cosmos_logs_client = init_cosmosdb_logs_client(self.get_cosmosdb_account_client(), telemetry=cosmos_telemetry)
+            if self.cosmos_logs_client and AZURE_COSMOSDB_LOGS_SPOOL_ENABLED:
+                self.cosmos_logs_client = SpooledHistoryClient(
+                    self.cosmos_logs_client,
+                    spool_dir=AZURE_COSMOSDB_LOGS_SPOOL_DIR,
+                    batch_size=int(AZURE_COSMOSDB_LOGS_SPOOL_BATCH_SIZE),
+                    max_queue=int(AZURE_COSMOSDB_LOGS_SPOOL_MAX_QUEUE),
+                    shutdown_timeout=BACKGROUND_TASKS_SHUTDOWN_TIMEOUT,
+                    registry=metrics_registry
+                )
+        return self.cosmos_logs_client
+
+    async def start(self):
+        logging.debug("Starting shared clients")
+        self.get_openai_client()
+        if CHAT_HISTORY_ENABLED:
+            # Reading the containers opens the connections (and fetches the AAD token) before the first request
+            for client in (self.get_cosmos_conversation_client(), self.get_cosmos_logs_client()):
+                try:
+                    success, err = await client.ensure()
+                    if not success:
+                        logging.warning(f"Chat history warmup failed: {err}")
+                except Exception:
+                    logging.exception("Exception warming up the chat history client")
+        if SHOULD_USE_DATA:
+            try:
+                get_data_source_template()
+            except Exception:
+                logging.exception("Exception building the data source template")
+
+    async def close(self):
+        logging.debug("Closing shared clients")
+        if self.background_tasks:
+            await asyncio.wait(self.background_tasks, timeout=BACKGROUND_TASKS_SHUTDOWN_TIMEOUT)
+        if self.openai_client:
+            await self.openai_client.close()
+        if self.http_client:
+            await self.http_client.aclose()
+        for history_client in (self.cosmos_conversation_client, self.cosmos_logs_client):
+            if history_client:
+                await history_client.close()
+        if self.cosmosdb_client:
+            await self.cosmosdb_client.close()
+        if self.blob_service_client:
+            await self.blob_service_client.close()
+        if self.search_client:
+            await self.search_client.close()
+        if self.document_loader:
+            await self.document_loader.close()
+        if self.credential:
+            await self.credential.close()
+        completion_cache.close()
+        await group_resolver.close()
+        self.http_client = None
+        self.credential = None
+        self.ad_token_provider = None
+        self.openai_client = None
+        self.cosmosdb_client = None
+        self.cosmos_conversation_client = None
+        self.cosmos_logs_client = None
+        self.blob_service_client = None
+        self.search_client = None
+        self.document_loader = None
+        self.blob_containers = set()
+
+
+client_registry = ClientRegistry()
+
+
+def get_cosmos_conversation_client():
+    return client_registry.get_cosmos_conversation_client()
+
+def get_cosmos_logs_client():
+    return client_registry.get_cosmos_logs_client()
+
+def get_openai_client():
+    return client_registry.get_openai_client()
+
+
 def init_embed_model():
     try:
         params = {
@@ -318,7 +651,15 @@ def init_embed_model():
 
 
 
-def init_cosmosdb_client():
+def init_cosmosdb_account_client(credential=None):
+    cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
+    if AZURE_COSMOSDB_ACCOUNT_KEY:
+        credential = AZURE_COSMOSDB_ACCOUNT_KEY
+    elif not credential:
+        credential = DefaultAzureCredential()
+    return CosmosClient(cosmos_endpoint, credential=credential)
+
+def init_cosmosdb_client(cosmosdb_client=None, cache=None, telemetry=None):
     logging.debug("Initializing CosmosDB client")
     cosmos_conversation_client = None
     if CHAT_HISTORY_ENABLED:
@@ -326,7 +667,9 @@ def init_cosmosdb_client():
         try:
             cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
 
-            if not AZURE_COSMOSDB_ACCOUNT_KEY:
+            if cosmosdb_client:
+                credential = None
+            elif not AZURE_COSMOSDB_ACCOUNT_KEY:
                 credential = DefaultAzureCredential()
             else:
                 credential = AZURE_COSMOSDB_ACCOUNT_KEY
@@ -336,7 +679,12 @@ def init_cosmosdb_client():
                 credential=credential, 
                 database_name=AZURE_COSMOSDB_DATABASE,
                 container_name=AZURE_COSMOSDB_CONVERSATIONS_CONTAINER,
-                enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK
+                enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK,
+                cosmosdb_client=cosmosdb_client,
+                cache=cache,
+                message_layout=AZURE_COSMOSDB_MESSAGE_LAYOUT.lower(),
+                bucket_size=int(AZURE_COSMOSDB_MESSAGE_BUCKET_SIZE),
+                telemetry=telemetry
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB initialization", e)
@@ -347,7 +695,7 @@ def init_cosmosdb_client():
         
     return cosmos_conversation_client
 
-def init_cosmosdb_logs_client():
+def init_cosmosdb_logs_client(cosmosdb_client=None, telemetry=None):
     logging.debug("Initializing CosmosDB logs client")
     cosmos_logs_client = None
     if CHAT_HISTORY_ENABLED:
@@ -355,7 +703,9 @@ def init_cosmosdb_logs_client():
         try:
             cosmos_endpoint = f'https://{AZURE_COSMOSDB_ACCOUNT}.documents.azure.com:443/'
 
-            if not AZURE_COSMOSDB_ACCOUNT_KEY:
+            if cosmosdb_client:
+                credential = None
+            elif not AZURE_COSMOSDB_ACCOUNT_KEY:
                 credential = DefaultAzureCredential()
             else:
                 credential = AZURE_COSMOSDB_ACCOUNT_KEY
@@ -365,7 +715,9 @@ def init_cosmosdb_logs_client():
                 credential=credential, 
                 database_name=AZURE_COSMOSDB_DATABASE,
                 container_name="logs",
-                enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK
+                enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK,
+                cosmosdb_client=cosmosdb_client,
+                telemetry=telemetry
             )
         except Exception as e:
             logging.exception("Exception in CosmosDB logs initialization", e)
@@ -377,6 +729,22 @@ def init_cosmosdb_logs_client():
     return cosmos_logs_client
 
 
+def init_sqlite_history_client(container_name):
+    logging.debug(f"Initializing SQLite history client for {container_name} at {CHAT_HISTORY_SQLITE_PATH}")
+    return SqliteConversationClient(
+        database_path=CHAT_HISTORY_SQLITE_PATH,
+        container_name=container_name,
+        enable_message_feedback=AZURE_COSMOSDB_ENABLE_FEEDBACK
+    )
+
+
+def init_blob_service_client():
+    return AsyncBlobServiceClient(
+        account_url=f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net/",
+        credential=AZURE_STORAGE_KEY
+    )
+
+
 def init_container_client(storage_container_name):
 
     storage_account_url = f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net/"
@@ -405,6 +773,14 @@ def init_search_client():
     return search_client
 
 
+def init_async_search_client():
+    return AsyncSearchClient(
+        endpoint=f"https://{AZURE_SEARCH_SERVICE}.search.windows.net/",
+        index_name=AZURE_SEARCH_INDEX,
+        credential=AzureKeyCredential(AZURE_SEARCH_KEY)
+    )
+
+
 def init_vector_store():
     # 'Python HTTP trigger function processed a request for CreateSearchIndex.'
 
@@ -499,18 +875,19 @@ def init_vector_store():
 
 
 async def ensure_cosmos():
-    if not AZURE_COSMOSDB_ACCOUNT:
+    if not CHAT_HISTORY_ENABLED:
         return jsonify({"error": "CosmosDB is not configured"}), 404
     
     try:
-        cosmos_conversation_client = init_cosmosdb_client()
+        cosmos_conversation_client = get_cosmos_conversation_client()
+        if not cosmos_conversation_client:
+            return jsonify({"error": "CosmosDB is not configured or not working"}), 500
         success, err = await cosmos_conversation_client.ensure()
-        if not cosmos_conversation_client or not success:
+        if not success:
             if err:
                 return jsonify({"error": err}), 422
             return jsonify({"error": "CosmosDB is not configured or not working"}), 500
-        
-        await cosmos_conversation_client.cosmosdb_client.close()
+
         return jsonify({"message": "CosmosDB is configured and working"}), 200
     except Exception as e:
         logging.exception("Exception in /history/ensure")
@@ -525,7 +902,11 @@ async def ensure_cosmos():
             return jsonify({"error": "CosmosDB is not working"}), 500
 
 
-def get_configured_data_source(user_id, filenames):
+def build_data_source_template():
+    """
+    Builds the data source for DATASOURCE_TYPE from the environment, without the per-request filter.
+    Called once per worker, see get_data_source_template.
+    """
     data_source = {}
     query_type = "simple"
     if DATASOURCE_TYPE == "AzureCognitiveSearch":
@@ -535,17 +916,6 @@ def get_configured_data_source(user_id, filenames):
         elif AZURE_SEARCH_USE_SEMANTIC_SEARCH.lower() == "true" and AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG:
             query_type = "semantic"
 
-        # Set filter
-        filter = generateSimpleFilterString(user_id, filenames)
-        userToken = None
-        if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
-            userToken = request.headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN', "")
-            logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
-            if not userToken:
-                raise Exception("Document-level access control is enabled, but user access token could not be fetched.")
-
-            filter = generateFilterString(userToken)
-            logging.debug(f"FILTER: {filter}")
         # Set authentication
         authentication = {}
         # if AZURE_SEARCH_KEY:
@@ -578,7 +948,7 @@ def get_configured_data_source(user_id, filenames):
                     "query_type": query_type,
                     "semantic_configuration": AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG if AZURE_SEARCH_SEMANTIC_SEARCH_CONFIG else "",
                     "role_information": AZURE_OPENAI_SYSTEM_MESSAGE,
-                    "filter": filter,
+                    "filter": None,
                     "strictness": int(AZURE_SEARCH_STRICTNESS) if AZURE_SEARCH_STRICTNESS else int(SEARCH_STRICTNESS)
                 }
             }
@@ -717,7 +1087,51 @@ def get_configured_data_source(user_id, filenames):
 
     return data_source
 
-def prepare_model_args(request_body):
+
+_data_source_template = None
+
+def get_data_source_template():
+    """
+    The data source template is shared by every request and must not be mutated;
+    get_configured_data_source overlays the per-request parts on copies of the top levels.
+    """
+    global _data_source_template
+    if _data_source_template is None:
+        _data_source_template = build_data_source_template()
+    return _data_source_template
+
+async def get_configured_data_source(user_id, filenames):
+    data_source = get_data_source_template()
+    if DATASOURCE_TYPE != "AzureCognitiveSearch":
+        return data_source
+
+    # Set filter
+    filter = generateSimpleFilterString(user_id, filenames)
+    userToken = None
+    if AZURE_SEARCH_PERMITTED_GROUPS_COLUMN:
+        userToken = request.headers.get('X-MS-TOKEN-AAD-ACCESS-TOKEN', "")
+        logging.debug(f"USER TOKEN is {'present' if userToken else 'not present'}")
+        if not userToken:
+            raise Exception("Document-level access control is enabled, but user access token could not be fetched.")
+
+        filter = await group_resolver.get_filter_string(user_id, userToken)
+        logging.debug(f"FILTER: {filter}")
+
+    return {**data_source, "parameters": {**data_source["parameters"], "filter": filter}}
+
+
+SECRET_PARAMS = ["key", "connection_string", "embedding_key", "encoded_api_key", "api_key"]
+
+def redact_secrets(value):
+    """Returns a copy of the value with every secret parameter, at any depth, replaced by *****."""
+    if isinstance(value, dict):
+        return {k: "*****" if k in SECRET_PARAMS and v else redact_secrets(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact_secrets(v) for v in value]
+    return value
+
+
+async def prepare_model_args(request_body):
 
     def cleanMessage(message):
         #remove citation tags
@@ -733,33 +1147,22 @@ def prepare_model_args(request_body):
     user_id = authenticated_user['user_principal_id']
     request_messages = request_body.get("messages", [])
     request_filenames = request_body.get("filenames", [])
-    messages = []
-    totalTokens = 0
-    encoding = tiktoken.get_encoding("cl100k_base")
-
-    for index, message in enumerate(reversed(request_messages)):
-        if message and message["role"] != "tool":
-            totalTokens += len(encoding.encode(message["content"]))
-            if totalTokens>6000:
-                print('Message list too long, truncating to 6000 tokens which is ', index, ' messages.')
-                break
-            messages.insert(0,{
-                "role": message["role"] ,
-                "content": cleanMessage(message["content"])
-            })
-                
+    history_messages = [message for message in request_messages if message and message["role"] != "tool"]
+    messages = [
+        {
+            "role": message["role"],
+            "content": cleanMessage(message["content"])
+        }
+        for message in history_budget.trim(history_messages)
+    ]
+
     model_args = {
         "messages": messages,
-        "temperature": float(AZURE_OPENAI_TEMPERATURE),
-        "max_tokens": int(AZURE_OPENAI_MAX_TOKENS),
-        "top_p": float(AZURE_OPENAI_TOP_P),
-        "stop": parse_multi_columns(AZURE_OPENAI_STOP_SEQUENCE) if AZURE_OPENAI_STOP_SEQUENCE else None,
-        "stream": SHOULD_STREAM,
-        "model": AZURE_OPENAI_MODEL,
+        **MODEL_ARGS_TEMPLATE
     }
 
     if len(request_filenames) == 0:
-        print('no files')
+        logging.debug("No files in request")
         messages.insert(0,
                 {
                     "role": "system",
@@ -767,34 +1170,26 @@ def prepare_model_args(request_body):
                 }
         )
     elif len(request_filenames) > 0:
-        print('Request filenames: ', request_filenames)
+        logging.debug("Request filenames: %s", request_filenames)
         editted_messages = messages.copy()
         editted_messages[-1]["content"] = "You are answering questions about the following documents: " + ", ".join(request_filenames) + ". " + editted_messages[-1]["content"]
         model_args["messages"] = editted_messages
         model_args["extra_body"] = {
-            "data_sources": [get_configured_data_source(user_id, request_filenames)]
+            "data_sources": [await get_configured_data_source(user_id, request_filenames)]
         }
 
-    model_args_clean = copy.deepcopy(model_args)
-    if model_args_clean.get("extra_body"):
-        secret_params = ["key", "connection_string", "embedding_key", "encoded_api_key", "api_key"]
-        for secret_param in secret_params:
-            if model_args_clean["extra_body"]["data_sources"][0]["parameters"].get(secret_param):
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"][secret_param] = "*****"
-        authentication = model_args_clean["extra_body"]["data_sources"][0]["parameters"].get("authentication", {})
-        for field in authentication:
-            if field in secret_params:
-                model_args_clean["extra_body"]["data_sources"][0]["parameters"]["authentication"][field] = "*****"
-        embeddingDependency = model_args_clean["extra_body"]["data_sources"][0]["parameters"].get("embedding_dependency", {})
-        if "authentication" in embeddingDependency:
-            for field in embeddingDependency["authentication"]:
-                if field in secret_params:
-                    model_args_clean["extra_body"]["data_sources"][0]["parameters"]["embedding_dependency"]["authentication"][field] = "*****"
-        
-    logging.debug(f"REQUEST BODY: {json.dumps(model_args_clean, indent=4)}")
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("REQUEST BODY: %s", json.dumps(redact_secrets(model_args), indent=4))
     return model_args
 
 
+def get_provisional_title(conversation_messages):
+    """A title for a new conversation to use until generate_title has run: the first words of the user's question."""
+    question = next((msg['content'] for msg in reversed(conversation_messages) if msg['role'] == 'user'), '')
+    words = re.sub(r'[^\w\s\'-]', ' ', question).split()
+    return ' '.join(words[:PROVISIONAL_TITLE_WORDS]) or 'New chat'
+
+
 async def generate_title(conversation_messages):
     ## make sure the messages are sorted by _ts descending
     title_prompt = 'Summarize the conversation so far into a 4-word or less title. Do not use any quotation marks or punctuation. Respond with a json object in the format {{"title": string}}. Do not include any other commentary or description.'
@@ -803,7 +1198,7 @@ async def generate_title(conversation_messages):
     messages.append({'role': 'user', 'content': title_prompt})
 
     try:
-        azure_openai_client = init_openai_client(use_data=False)
+        azure_openai_client = get_openai_client()
         response = await azure_openai_client.chat.completions.create(
             model=AZURE_OPENAI_MODEL,
             messages=messages,
@@ -815,53 +1210,3 @@ async def generate_title(conversation_messages):
         return title
     except Exception as e:
         return messages[-2]['content']
-
-
-def get_doc_from_azure_blob_storage(blob_name: str, storage_account_container: str) -> List[Document]:
-    """Load a file (PDF, TXT, DOCX, CSV, XLSX, XLS) from Azure Storage Blob."""
-    print(f'Downloading file from Azure Blob Storage: {blob_name}')
-    storage_account_url = f"https://{AZURE_STORAGE_ACCOUNT}.blob.core.windows.net/"
-    try:
-        blob_client = BlobClient(
-            account_url=storage_account_url,
-            container_name=storage_account_container,
-            blob_name=blob_name,
-            credential=AZURE_STORAGE_KEY
-        )
-        
-        # Truncate the original blob name if needed, keeping the extension
-        name, ext = os.path.splitext(blob_name)
-        if len(name) > 50:  # arbitrary reasonable length
-            name = name[:47] + "..."  # 47 + 3 dots = 50
-        safe_blob_name = name + ext
-
-        rand_int = random.randint(0, 1000000)
-        temp_dir = tempfile.gettempdir()
-        file_path = os.path.join(temp_dir, f"{storage_account_container[:10]}-{rand_int}-{safe_blob_name}")
-        
-        with open(file_path, "wb") as file:
-            blob_data = blob_client.download_blob()
-            blob_data.readinto(file)
-        
-        try:
-            if blob_name.lower().endswith('.pdf'):
-                loader = PyPDFLoader(file_path)
-            elif blob_name.lower().endswith('.txt'):
-                loader = TextLoader(file_path)
-            elif blob_name.lower().endswith('.docx'):
-                loader = Docx2txtLoader(file_path)
-            elif blob_name.lower().endswith('.csv'):
-                loader = CSVLoader(file_path)
-            else:
-                raise ValueError(f"Unsupported file type: {blob_name}")
-            
-            docs = loader.load()
-            return docs
-        finally:
-            # Clean up the temporary file
-            if os.path.exists(file_path):
-                os.remove(file_path)
-
-    except Exception as ex:
-        print(f'ERROR DOWNLOADING FILE FROM AZURE BLOB STORAGE: {ex}')
-        return 'error: ' + str(ex)
\ No newline at end of file
@@ -0,0 +1,128 @@
+import hashlib
+import logging
+from collections import OrderedDict
+
+import tiktoken
+
+# Tokens the chat completions format adds around every message (role, separators)
+TOKENS_PER_MESSAGE = 4
+
+# Context window sizes, matched on the longest prefix of the model name
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-4.1": 1047576,
+    "gpt-4o": 128000,
+    "gpt-4-turbo": 128000,
+    "gpt-4-32k": 32768,
+    "gpt-4": 8192,
+    "gpt-35-turbo-16k": 16384,
+    "gpt-35-turbo": 16384,
+    "gpt-3.5-turbo": 16384,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+
+def get_context_window(model_name):
+    matches = [name for name in MODEL_CONTEXT_WINDOWS if model_name and model_name.startswith(name)]
+    if not matches:
+        return DEFAULT_CONTEXT_WINDOW
+    return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+
+
+def get_encoding_name(model_name):
+    try:
+        return tiktoken.encoding_name_for_model(model_name)
+    except KeyError:
+        return "cl100k_base"
+
+
+class HistoryTokenBudget():
+    """
+    Trims chat history to the newest messages that fit the model's context window.
+
+    Token counts are cached per message content hash in an LRU, so each turn only
+    encodes the messages it has not seen before instead of the whole history.
+    """
+
+    def __init__(self, model_name: str, max_tokens: int, context_window: int = None, max_history_tokens: int = None, system_message: str = "", cache_size: int = 10000, encoding=None):
+        self.model_name = model_name
+        self.context_window = context_window or get_context_window(model_name)
+        self.max_tokens = max_tokens
+        self.max_history_tokens = max_history_tokens
+        self.system_message = system_message
+        self.cache_size = cache_size
+        self._encoding = encoding
+        self._budget = None
+        self._token_counts = OrderedDict()
+
+    @property
+    def encoding(self):
+        # Loaded on first use, tiktoken may need to download the BPE file
+        if self._encoding is None:
+            self._encoding = tiktoken.get_encoding(get_encoding_name(self.model_name))
+        return self._encoding
+
+    @property
+    def budget(self):
+        if self._budget is None:
+            system_tokens = self.count_texts([self.system_message])[0] + TOKENS_PER_MESSAGE if self.system_message else 0
+            budget = self.context_window - self.max_tokens - system_tokens
+            if self.max_history_tokens:
+                budget = min(budget, self.max_history_tokens)
+            self._budget = max(budget, 0)
+        return self._budget
+
+    def _key(self, content):
+        return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+    def count_texts(self, texts):
+        keys = [self._key(text) for text in texts]
+        counts = {}
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key in self._token_counts:
+                self._token_counts.move_to_end(key)
+                counts[key] = self._token_counts[key]
+            else:
+                missing[key] = text
+
+        if missing:
+            encoded = self.encoding.encode_batch(list(missing.values()), disallowed_special=())
+            for key, tokens in zip(missing.keys(), encoded):
+                counts[key] = self._token_counts[key] = len(tokens)
+            # A batch larger than the cache evicts some of its own counts, which are already read
+            while len(self._token_counts) > self.cache_size:
+                self._token_counts.popitem(last=False)
+
+        return [counts[key] for key in keys]
+
+    def trim(self, messages, budget=None):
+        """
+        Returns the newest messages, in their original order, whose tokens fit in the budget. The newest
+        message is always kept, even on its own over the budget, since it is the one being answered.
+        """
+        budget = self.budget if budget is None else budget
+        kept = []
+        total_tokens = 0
+        # Count from the newest message backwards in growing windows so that a long
+        # history only gets hashed as far back as the budget actually reaches
+        window = 16
+        end = len(messages)
+        while end > 0:
+            start = max(end - window, 0)
+            batch = messages[start:end]
+            counts = self.count_texts([message["content"] for message in batch])
+            for message, count in zip(reversed(batch), reversed(counts)):
+                total_tokens += count + TOKENS_PER_MESSAGE
+                if total_tokens > budget:
+                    if not kept:
+                        logging.warning(f"The newest message alone is over the history budget of {budget} tokens, sending it on its own.")
+                        return [message]
+                    logging.debug(f"Message list too long, truncating to {budget} tokens which is {len(kept)} messages.")
+                    kept.reverse()
+                    return kept
+                kept.append(message)
+            end = start
+            window *= 2
+
+        kept.reverse()
+        return kept
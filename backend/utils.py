@@ -1,9 +1,12 @@
 import os
+import base64
+import binascii
 import json
+import time
+import asyncio
 import logging
 import re
 import unicodedata
-import requests
 import dataclasses
 
 DEBUG = os.environ.get("DEBUG", "false")
@@ -11,7 +14,6 @@ print(f"DEBUG: {DEBUG}")
 if DEBUG.lower() == "true":
     logging.basicConfig(level=logging.DEBUG)
 
-AZURE_SEARCH_PERMITTED_GROUPS_COLUMN = os.environ.get("AZURE_SEARCH_PERMITTED_GROUPS_COLUMN")
 
 class JSONEncoder(json.JSONEncoder):
     def default(self, o):
@@ -19,6 +21,11 @@ class JSONEncoder(json.JSONEncoder):
             return dataclasses.asdict(o)
         return super().default(o)
 
+async def close_stream(r):
+    """Closes the stream a response was built from, so the request behind it ends when the client goes away."""
+    if hasattr(r, "aclose"):
+        await r.aclose()
+
 async def format_as_ndjson(r):
     try:
         async for event in r:
@@ -26,6 +33,8 @@ async def format_as_ndjson(r):
     except Exception as error:
         logging.exception("Exception while generating response stream: %s", error)
         yield json.dumps({"error": str(error)})
+    finally:
+        await close_stream(r)
 
 def parse_multi_columns(columns: str) -> list:
     if "|" in columns:
@@ -34,44 +43,6 @@ def parse_multi_columns(columns: str) -> list:
         return columns.split(",")
 
 
-def fetchUserGroups(userToken, nextLink=None):
-    # Recursively fetch group membership
-    if nextLink:
-        endpoint = nextLink
-    else:
-        endpoint = "https://graph.microsoft.com/v1.0/me/transitiveMemberOf?$select=id"
-    
-    headers = {
-        'Authorization': "bearer " + userToken
-    }
-    try :
-        r = requests.get(endpoint, headers=headers)
-        if r.status_code != 200:
-            logging.error(f"Error fetching user groups: {r.status_code} {r.text}")
-            return []
-        
-        r = r.json()
-        if "@odata.nextLink" in r:
-            nextLinkData = fetchUserGroups(userToken, r["@odata.nextLink"])
-            r['value'].extend(nextLinkData)
-        
-        return r['value']
-    except Exception as e:
-        logging.error(f"Exception in fetchUserGroups: {e}")
-        return []
-
-
-def generateFilterString(userToken):
-    # Get list of groups user is a member of
-    userGroups = fetchUserGroups(userToken)
-
-    # Construct filter string
-    if not userGroups:
-        logging.debug("No user groups found")
-
-    group_ids = ", ".join([obj['id'] for obj in userGroups])
-    return f"{AZURE_SEARCH_PERMITTED_GROUPS_COLUMN}/any(g:search.in(g, '{group_ids}'))"
-
 def generateSimpleFilterString(user_id, filenames):
         # Construct filter string
     user_filter = f"user_id eq '{user_id}'"
@@ -115,47 +86,153 @@ def format_non_streaming_response(chatCompletion, history_metadata, message_uuid
     
     return {}
 
+def get_stream_messages(chatCompletionChunk):
+    """Returns the messages carried by a streamed chunk, or 'retry' when the data source found no citations."""
+    if len(chatCompletionChunk.choices) > 0:
+        delta = chatCompletionChunk.choices[0].delta
+        if delta:
+            if hasattr(delta, "context"):
+                if delta.context['citations'] == []:
+                    return 'retry'
+                    # raise Exception("An unexpected error occurred, please resubmit your question.")
+                return [{
+                    "role": "tool",
+                    "content": json.dumps(delta.context)
+                }]
+            if delta.content:
+                return [{
+                    "role": "assistant",
+                    "content": delta.content,
+                }]
+    return []
+
 def format_stream_response(chatCompletionChunk, history_metadata, message_uuid=None):
-    response_obj = {
+    messages = get_stream_messages(chatCompletionChunk)
+    if messages == 'retry':
+        return 'retry'
+    if not messages:
+        return {}
+
+    return {
         "id": chatCompletionChunk.id,
         "model": chatCompletionChunk.model,
         "created": chatCompletionChunk.created,
         "object": chatCompletionChunk.object,
         "choices": [{
-            "messages": []
+            "messages": messages
         }],
         "history_metadata": history_metadata
     }
-    if len(chatCompletionChunk.choices) > 0:
-        delta = chatCompletionChunk.choices[0].delta
-        if delta:
-            if hasattr(delta, "context"):
-                if delta.context['citations'] == []:
-                    return 'retry'
-                    # raise Exception("An unexpected error occurred, please resubmit your question.")
+
+def dumps_compact(obj):
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False) + "\n"
+
+async def format_as_compact_ndjson(r, history_metadata, flush_interval=0.03, flush_size=1024):
+    """
+    Streams chat completion chunks in the compact NDJSON protocol.
+
+    The first line is the envelope ({"id", "model", "created", "object", "history_metadata"}),
+    followed by {"role": "tool", "content": ...} for the data source context and {"d": ...}
+    frames carrying the assistant text. Assistant deltas are buffered and flushed once
+    flush_interval seconds have passed or flush_size characters are waiting. If the
+    history_metadata changes while streaming (e.g. a generated title arrives), the last
+    line is {"history_metadata": ...} with its final value.
+    """
+    iterator = r.__aiter__()
+    next_chunk = None
+    buffer = []
+    buffer_size = 0
+    envelope_sent = False
+    sent_metadata = None
+    last_flush = time.monotonic()
+
+    def flush():
+        nonlocal buffer, buffer_size, last_flush
+        frame = dumps_compact({"d": "".join(buffer)})
+        buffer = []
+        buffer_size = 0
+        last_flush = time.monotonic()
+        return frame
+
+    try:
+        while True:
+            if next_chunk is None:
+                next_chunk = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                timeout = max(flush_interval - (time.monotonic() - last_flush), 0)
+                done, _ = await asyncio.wait({next_chunk}, timeout=timeout)
+                if not done:
+                    yield flush()
+                    continue
+
+            try:
+                chatCompletionChunk = await next_chunk
+            except StopAsyncIteration:
+                break
+            finally:
+                next_chunk = None
+
+            messages = get_stream_messages(chatCompletionChunk)
+            if messages == 'retry':
+                yield dumps_compact('retry')
+                continue
+            if not messages:
+                continue
+
+            if not envelope_sent:
+                yield dumps_compact({
+                    "id": chatCompletionChunk.id,
+                    "model": chatCompletionChunk.model,
+                    "created": chatCompletionChunk.created,
+                    "object": chatCompletionChunk.object,
+                    "history_metadata": history_metadata
+                })
+                envelope_sent = True
+                sent_metadata = dict(history_metadata)
+
+            for message in messages:
+                if message["role"] == "assistant":
+                    buffer.append(message["content"])
+                    buffer_size += len(message["content"])
                 else:
-                    messageObj = {
-                        "role": "tool",
-                        "content": json.dumps(delta.context)
-                    }
-                response_obj["choices"][0]["messages"].append(messageObj)
-                return response_obj
-            if delta.role == "assistant" and hasattr(delta, "context"):
-                messageObj = {
-                    "role": "assistant",
-                    "context": delta.context,
-                }
-                response_obj["choices"][0]["messages"].append(messageObj)
-                return response_obj
-            else:
-                if delta.content:
-                    messageObj = {
-                        "role": "assistant",
-                        "content": delta.content,
-                    }
-                    response_obj["choices"][0]["messages"].append(messageObj)
-                    return response_obj
-    return {}
+                    if buffer:
+                        yield flush()
+                    yield dumps_compact(message)
+
+            if buffer_size >= flush_size:
+                yield flush()
+
+        if buffer:
+            yield flush()
+        if envelope_sent and history_metadata != sent_metadata:
+            yield dumps_compact({"history_metadata": history_metadata})
+    except Exception as error:
+        logging.exception("Exception while generating response stream: %s", error)
+        ## the client keeps the text that arrived before the failure
+        if buffer:
+            yield flush()
+        yield dumps_compact({"error": str(error)})
+    finally:
+        if next_chunk is not None:
+            next_chunk.cancel()
+            await asyncio.gather(next_chunk, return_exceptions=True)
+        await close_stream(r)
+
+
+def encode_cursor(continuation_token):
+    """Wraps a continuation token in an opaque, URL-safe cursor; None stays None."""
+    if continuation_token is None:
+        return None
+    return base64.urlsafe_b64encode(continuation_token.encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor):
+    """Returns the continuation token in a cursor, None for an empty cursor. Raises ValueError if it is malformed."""
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+    except (binascii.Error, UnicodeError) as e:
+        raise ValueError("Invalid cursor") from e
 
 
 def secure_filename(filename: str) -> str:
@@ -0,0 +1,119 @@
+"""
+Load test of the /history/* endpoints against the SQLite history backend, without any network.
+
+Run from the repository root:
+    python -m benchmarks.history_endpoints [--users 20] [--conversations 50] [--requests 2000] [--concurrency 32]
+
+Each user is seeded with conversations of a few messages in a fresh database, then the requests are
+spread over list, read, update, feedback and rename calls of random users through the app's test client.
+The script prints the throughput and latency percentiles of every endpoint.
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+import uuid
+
+ENDPOINTS = ("list", "read", "update", "message_feedback", "rename")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def seed(history_clients, users, conversations):
+    """Writes the conversations to the conversations and logs containers, like /history/generate does."""
+    history_client = history_clients[0]
+    seeded = {}
+    for user_id in users:
+        seeded[user_id] = []
+        for i in range(conversations):
+            conversation = history_client.build_conversation(user_id, f"Benchmark conversation {i}")
+            messages = [
+                history_client.build_message(str(uuid.uuid4()), conversation['id'], user_id, {"role": role, "content": f"{role} message {j}"})
+                for j, role in enumerate(["user", "assistant"] * 3)
+            ]
+            for client in history_clients:
+                await client.create_messages(user_id, conversation['id'], messages, conversation=conversation)
+            seeded[user_id].append((conversation['id'], [message['id'] for message in messages]))
+    return seeded
+
+
+def make_request(endpoint, user_id, conversation_id, message_ids):
+    headers = {"X-Ms-Client-Principal-Id": user_id}
+    if endpoint == "list":
+        return "GET", "/history/list", headers, None
+    if endpoint == "read":
+        return "POST", "/history/read", headers, {"conversation_id": conversation_id}
+    if endpoint == "update":
+        messages = [
+            {"id": str(uuid.uuid4()), "role": "user", "content": "Another question"},
+            {"id": str(uuid.uuid4()), "role": "assistant", "content": "Another answer"}
+        ]
+        return "POST", "/history/update", headers, {"conversation_id": conversation_id, "messages": messages}
+    if endpoint == "message_feedback":
+        return "POST", "/history/message_feedback", headers, {"message_id": random.choice(message_ids), "message_feedback": "positive"}
+    return "POST", "/history/rename", headers, {"conversation_id": conversation_id, "title": "Renamed"}
+
+
+async def main(user_count, conversation_count, request_count, concurrency):
+    from app import app
+    from backend.setup import client_registry
+
+    latencies = {endpoint: [] for endpoint in ENDPOINTS}
+    failures = {endpoint: 0 for endpoint in ENDPOINTS}
+    # Without the serving lifecycle, so the OpenAI client is never needed
+    test_client = app.test_client()
+    try:
+        users = [f"benchmark-user-{i}" for i in range(user_count)]
+        history_clients = [client_registry.get_cosmos_conversation_client(), client_registry.get_cosmos_logs_client()]
+        seeded = await seed(history_clients, users, conversation_count)
+
+        queue = asyncio.Queue()
+        for _ in range(request_count):
+            queue.put_nowait(random.choice(ENDPOINTS))
+
+        async def worker():
+            while not queue.empty():
+                endpoint = queue.get_nowait()
+                user_id = random.choice(users)
+                conversation_id, message_ids = random.choice(seeded[user_id])
+                method, path, headers, body = make_request(endpoint, user_id, conversation_id, message_ids)
+                start = time.perf_counter()
+                response = await test_client.open(path, method=method, headers=headers, json=body)
+                latencies[endpoint].append(time.perf_counter() - start)
+                if response.status_code >= 400:
+                    failures[endpoint] += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    finally:
+        await client_registry.close()
+
+    print(f"{request_count} requests in {elapsed:.2f}s, {request_count / elapsed:.0f} requests/s")
+    print(f"{'endpoint':>18} {'count':>6} {'failed':>6} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for endpoint, values in latencies.items():
+        if values:
+            print(f"{endpoint:>18} {len(values):>6} {failures[endpoint]:>6} {statistics.mean(values) * 1000:>8.2f} {percentile(values, 0.5) * 1000:>8.2f} {percentile(values, 0.95) * 1000:>8.2f} {percentile(values, 0.99) * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--conversations", type=int, default=50, help="Conversations seeded per user")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--database", help="SQLite database file, a fresh temporary one by default")
+    args = parser.parse_args()
+
+    # The settings are read when the app is imported
+    os.environ["CHAT_HISTORY_BACKEND"] = "sqlite"
+    os.environ["CHAT_HISTORY_SQLITE_PATH"] = args.database or os.path.join(tempfile.mkdtemp(), "history.db")
+    os.environ["AZURE_COSMOSDB_ENABLE_FEEDBACK"] = "true"
+    os.environ["LOCAL_DEV"] = "False"
+    asyncio.run(main(args.users, args.conversations, args.requests, args.concurrency))
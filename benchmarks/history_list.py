@@ -0,0 +1,91 @@
+"""
+Benchmark of /history/list paging: OFFSET/LIMIT against continuation tokens, by page depth.
+
+Needs the CosmosDB chat history settings (AZURE_COSMOSDB_*) of a test account. Run from the
+repository root:
+    python -m benchmarks.history_list [--user-id benchmark-user] [--seed 2000] [--depths 1,10,40,80]
+
+--seed first creates that many conversations for the user; --cleanup deletes them afterwards.
+For every depth the script prints the request charge and latency of reading that page both ways.
+"""
+import argparse
+import asyncio
+import time
+
+from backend.setup import HISTORY_PAGE_SIZE, client_registry
+
+
+def last_request_charge(cosmos_conversation_client):
+    headers = cosmos_conversation_client.container_client.client_connection.last_response_headers
+    return float(headers.get("x-ms-request-charge", 0))
+
+
+async def seed(cosmos_conversation_client, user_id, count):
+    for start in range(0, count, 100):
+        await asyncio.gather(*[
+            cosmos_conversation_client.create_conversation(user_id=user_id, title=f"Benchmark conversation {i}")
+            for i in range(start, min(start + 100, count))
+        ])
+
+
+async def cleanup(cosmos_conversation_client, user_id):
+    conversations = await cosmos_conversation_client.get_conversations(user_id, limit=None)
+    for start in range(0, len(conversations), 100):
+        await asyncio.gather(*[
+            cosmos_conversation_client.delete_conversation(user_id, conversation["id"])
+            for conversation in conversations[start:start + 100]
+        ])
+
+
+async def offset_page(cosmos_conversation_client, user_id, depth):
+    start = time.perf_counter()
+    await cosmos_conversation_client.get_conversations(user_id, limit=HISTORY_PAGE_SIZE, offset=(depth - 1) * HISTORY_PAGE_SIZE)
+    return last_request_charge(cosmos_conversation_client), time.perf_counter() - start
+
+
+async def cursor_pages(cosmos_conversation_client, user_id, depths):
+    """Walks the pages in order, as a scrolling client would, timing the pages at the given depths."""
+    results = {}
+    continuation_token = None
+    for depth in range(1, max(depths) + 1):
+        start = time.perf_counter()
+        conversations, continuation_token = await cosmos_conversation_client.get_conversations_page(user_id, limit=HISTORY_PAGE_SIZE, continuation_token=continuation_token)
+        if depth in depths:
+            results[depth] = (last_request_charge(cosmos_conversation_client), time.perf_counter() - start)
+        if not continuation_token:
+            break
+    return results
+
+
+async def main(user_id, seed_count, depths, should_cleanup):
+    cosmos_conversation_client = client_registry.get_cosmos_conversation_client()
+    if not cosmos_conversation_client:
+        raise SystemExit("CosmosDB chat history is not configured")
+
+    try:
+        if seed_count:
+            await seed(cosmos_conversation_client, user_id, seed_count)
+
+        cursor_results = await cursor_pages(cosmos_conversation_client, user_id, depths)
+        print(f"{'page':>6} {'offset RU':>10} {'offset ms':>10} {'cursor RU':>10} {'cursor ms':>10}")
+        for depth in depths:
+            if depth not in cursor_results:
+                break
+            offset_charge, offset_seconds = await offset_page(cosmos_conversation_client, user_id, depth)
+            cursor_charge, cursor_seconds = cursor_results[depth]
+            print(f"{depth:>6} {offset_charge:>10.2f} {offset_seconds * 1000:>10.1f} {cursor_charge:>10.2f} {cursor_seconds * 1000:>10.1f}")
+
+        if should_cleanup:
+            await cleanup(cosmos_conversation_client, user_id)
+    finally:
+        await client_registry.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--user-id", default="benchmark-user")
+    parser.add_argument("--seed", type=int, default=0, help="Number of conversations to create for the user first")
+    parser.add_argument("--depths", default="1,10,40,80", help="Comma-separated page numbers to measure")
+    parser.add_argument("--cleanup", action="store_true", help="Delete the user's conversations afterwards")
+    args = parser.parse_args()
+    asyncio.run(main(args.user_id, args.seed, sorted(int(depth) for depth in args.depths.split(",")), args.cleanup))
@@ -0,0 +1,78 @@
+"""
+Microbenchmark of chat request preparation (prepare_model_args and get_configured_data_source).
+
+Run from the repository root:
+    python -m benchmarks.prepare_model_args [--iterations 2000] [--history 40]
+
+No Azure resources are called; the Azure AI Search settings below are only used to build
+the data source.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+os.environ["LOCAL_DEV"] = "False"
+os.environ.setdefault("AZURE_SEARCH_SERVICE", "benchmark-search")
+os.environ.setdefault("AZURE_SEARCH_INDEX", "benchmark-index")
+os.environ.setdefault("AZURE_SEARCH_CONTENT_COLUMNS", "content")
+os.environ.setdefault("AZURE_SEARCH_VECTOR_COLUMNS", "content_vector")
+os.environ.setdefault("AZURE_SEARCH_QUERY_TYPE", "vector")
+os.environ.setdefault("AZURE_OPENAI_EMBEDDING_NAME", "benchmark-embeddings")
+os.environ.setdefault("AZURE_OPENAI_MODEL", "benchmark-model")
+
+from app import app
+from backend import setup
+
+
+class WhitespaceEncoding():
+    def encode_batch(self, texts, disallowed_special=()):
+        return [text.split() for text in texts]
+
+
+def make_request_body(history, filenames):
+    messages = []
+    for i in range(history):
+        messages.append({"id": str(i), "role": "user", "content": f"Question {i} about the quarterly report and its figures?"})
+        messages.append({"id": str(i), "role": "assistant", "content": f"Answer {i}: the report [doc1] shows revenue growth across most regions. " * 5})
+    messages.append({"id": "last", "role": "user", "content": "Summarise the key risks."})
+    return {"messages": messages, "filenames": filenames}
+
+
+async def bench(name, func, iterations):
+    timings = []
+    for _ in range(5):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            await func()
+        timings.append(time.perf_counter() - start)
+    seconds = min(timings)
+    print(f"{name:<45} {seconds / iterations * 1e6:10.1f} us/call")
+
+
+async def main(iterations, history):
+    try:
+        setup.history_budget.encoding
+    except Exception:
+        print("tiktoken encoding could not be loaded, counting whitespace-separated words instead")
+        setup.history_budget._encoding = WhitespaceEncoding()
+
+    grounded = make_request_body(history, ["report.pdf", "appendix.docx"])
+    ungrounded = make_request_body(history, [])
+
+    async with app.test_request_context("/conversation", method="POST"):
+        await bench("get_configured_data_source", lambda: setup.get_configured_data_source("user", ["report.pdf"]), iterations)
+        await bench("prepare_model_args (no documents)", lambda: setup.prepare_model_args(ungrounded), iterations)
+        await bench("prepare_model_args (documents)", lambda: setup.prepare_model_args(grounded), iterations)
+        logging.getLogger().setLevel(logging.DEBUG)
+        logging.getLogger().handlers = [logging.NullHandler()]
+        await bench("prepare_model_args (documents, debug logging)", lambda: setup.prepare_model_args(grounded), iterations)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--history", type=int, default=40, help="Number of question and answer pairs in the conversation")
+    args = parser.parse_args()
+    asyncio.run(main(args.iterations, args.history))
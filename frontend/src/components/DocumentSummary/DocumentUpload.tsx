@@ -111,22 +111,34 @@ const DocumentUpload: React.FC<DocumentUploadProps> = ({
         setUploadWS(ws);
 
         ws.onmessage = (event) => {
-            setProgress(event.data);
-            if (event.data.startsWith('error:')) {
-                console.log('Error processing document:', event.data);
+            // Events: progress and file_error for each file, then done with every file's result, or error
+            const message = JSON.parse(event.data);
+            if (message.type === 'error') {
+                console.log('Error processing document:', message.error);
                 ws.close();
                 deleteDocuments(processing.map((doc) => doc[0]));
                 setUploading([]);
                 setErrorMsg({title: 'Error processing document', subtitle: 'Please refresh the page and try again.'});
                 toggleErrorDialog();
-            } else if (event.data.startsWith('done:')) {
+            } else if (message.type === 'done') {
                 ws.close();
-                const fileNames = processing.map((doc) => doc[0]);
+                const results: {filename: string, status: string}[] = message.results;
+                const fileNames = results.filter((result) => result.status === 'ingested').map((result) => result.filename);
+                const failed = results.filter((result) => result.status === 'failed').map((result) => result.filename);
                 setDocuments((prevDocs) => [...prevDocs, ...fileNames]);
                 setUploading([]);
                 setProgress(0);
+                if (failed.length > 0) {
+                    deleteDocuments(failed);
+                    setErrorMsg({title: 'Error processing document', subtitle: `These documents could not be processed: ${failed.join(', ')}. Please try again.`});
+                    toggleErrorDialog();
+                }
             } else {
-                setProgress(Number(event.data)/7)
+                if (message.type === 'file_error') {
+                    console.log(`Error processing ${message.filename}:`, message.error);
+                }
+                // The upload itself was the first ninth
+                setProgress(1/9 + message.progress * 8/9)
             }
             };
         ws.onopen = () => {
@@ -173,7 +185,13 @@ const DocumentUpload: React.FC<DocumentUploadProps> = ({
             const res = await uploadFiles(fileList.files);
             if (res.status === 200) {
                 const resJson = await res.json();
-                initiateWebSocket(resJson[0]['Documents']);                
+                const failed = resJson[0]['Results'].filter((result: {uploaded: boolean}) => !result.uploaded).map((result: {filename: string}) => result.filename);
+                if (failed.length > 0) {
+                    setUploading(resJson[0]['Documents'].map((doc: string[]) => doc[0]));
+                    setErrorMsg({title: 'Error uploading files', subtitle: `These files could not be uploaded: ${failed.join(', ')}. Please try again.`});
+                    toggleErrorDialog();
+                }
+                initiateWebSocket(resJson[0]['Documents']);
                 setProgress(1/9)
             } else {
                 throw new Error('Error uploading files');
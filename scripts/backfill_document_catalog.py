@@ -0,0 +1,55 @@
+"""
+Builds the document catalog of users who uploaded documents before it existed.
+
+Needs the storage (AZURE_STORAGE_*) and chat history settings. Run from the repository root:
+    python -m scripts.backfill_document_catalog [--user-id <user id>] [--concurrency 8]
+
+Each user's blob container is listed once, with the blobs' metadata, and the blobs missing from their
+catalog are added to it. Entries already in a catalog are left alone, so the backfill can be run again
+at any time. Users who open their documents before it has run get their catalog built then.
+"""
+import argparse
+import asyncio
+import logging
+
+from backend.document import backfill_document_catalog
+from backend.setup import client_registry
+
+
+async def main(user_id, concurrency):
+    history_client = client_registry.get_cosmos_conversation_client()
+    if not history_client:
+        raise SystemExit("Chat history is not configured")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = []
+
+    async def backfill(container_name):
+        async with semaphore:
+            try:
+                return await backfill_document_catalog(history_client, container_name)
+            except Exception:
+                logging.exception(f"Unable to backfill the document catalog of {container_name}")
+                failed.append(container_name)
+                return 0
+
+    try:
+        if user_id:
+            container_names = [user_id]
+        else:
+            ## every user has a container named after their id
+            container_names = [container.name async for container in client_registry.get_blob_service_client().list_containers()]
+        added = await asyncio.gather(*[backfill(container_name) for container_name in container_names])
+        print(f"{len(container_names)} users checked, {sum(1 for count in added if count)} catalogs backfilled, {sum(added)} documents added")
+        if failed:
+            print(f"{len(failed)} users failed, run again to retry: {', '.join(failed)}")
+    finally:
+        await client_registry.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--user-id", help="Only backfill this user's catalog")
+    parser.add_argument("--concurrency", type=int, default=8, help="Users backfilled at once")
+    args = parser.parse_args()
+    asyncio.run(main(args.user_id, args.concurrency))
@@ -0,0 +1,70 @@
+"""
+Moves chat history messages from one item per message to bucket items (AZURE_COSMOSDB_MESSAGE_LAYOUT=buckets).
+
+Needs the CosmosDB chat history settings (AZURE_COSMOSDB_*). Run from the repository root:
+    python -m scripts.migrate_history_buckets [--user-id <user id>] [--concurrency 8] [--dry-run]
+
+Conversations already in buckets are only checked for message items a stopped run left behind, so
+the migration can be run again until it reports nothing left to move. It is safe to run while the
+app is serving: a conversation that gets a new message while it is being moved is moved again.
+"""
+import argparse
+import asyncio
+import logging
+
+from backend.setup import client_registry
+
+
+async def find_conversations(cosmos_conversation_client, user_id):
+    query = "SELECT c.id, c.userId FROM c WHERE c.type='conversation'"
+    parameters = []
+    if user_id:
+        query += " AND c.userId = @userId"
+        parameters.append({'name': '@userId', 'value': user_id})
+    return [item async for item in cosmos_conversation_client.container_client.query_items(query=query, parameters=parameters)]
+
+
+async def count_message_items(cosmos_conversation_client, conversation):
+    parameters = [{'name': '@conversationId', 'value': conversation['id']}]
+    query = "SELECT VALUE COUNT(1) FROM c WHERE c.conversationId = @conversationId AND c.type='message'"
+    counts = [count async for count in cosmos_conversation_client.container_client.query_items(query=query, parameters=parameters, partition_key=conversation['userId'])]
+    return counts[0] if counts else 0
+
+
+async def main(user_id, concurrency, dry_run):
+    cosmos_conversation_client = client_registry.get_cosmos_conversation_client()
+    if not cosmos_conversation_client:
+        raise SystemExit("CosmosDB chat history is not configured")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    failed = []
+
+    async def migrate(conversation):
+        async with semaphore:
+            try:
+                if dry_run:
+                    return await count_message_items(cosmos_conversation_client, conversation)
+                return await cosmos_conversation_client.migrate_to_buckets(conversation['userId'], conversation['id'])
+            except Exception:
+                logging.exception(f"Unable to move conversation {conversation['id']}")
+                failed.append(conversation['id'])
+                return 0
+
+    try:
+        conversations = await find_conversations(cosmos_conversation_client, user_id)
+        moved = await asyncio.gather(*[migrate(conversation) for conversation in conversations])
+        action = "to move" if dry_run else "moved"
+        print(f"{len(conversations)} conversations checked, {sum(1 for count in moved if count)} with messages {action}, {sum(moved)} message items {action}")
+        if failed:
+            print(f"{len(failed)} conversations failed, run again to retry: {', '.join(failed)}")
+    finally:
+        await client_registry.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--user-id", help="Only move this user's conversations")
+    parser.add_argument("--concurrency", type=int, default=8, help="Conversations moved at once")
+    parser.add_argument("--dry-run", action="store_true", help="Only count the message items that would be moved")
+    args = parser.parse_args()
+    asyncio.run(main(args.user_id, args.concurrency, args.dry_run))
@@ -0,0 +1,53 @@
+import time
+
+import pytest
+
+from backend.completion_cache import CompletionCache
+
+
+MODEL_ARGS = {
+    "messages": [{"role": "user", "content": "Hello"}],
+    "temperature": 0.0,
+    "max_tokens": 1000,
+    "top_p": 1.0,
+    "stop": None,
+    "stream": True,
+    "model": "gpt-4o",
+}
+
+
+def test_make_key_ignores_stream_and_skips_grounded_requests():
+    cache = CompletionCache(ttl=60)
+
+    assert cache.make_key(MODEL_ARGS) == cache.make_key({**MODEL_ARGS, "stream": False})
+    assert cache.make_key(MODEL_ARGS) != cache.make_key({**MODEL_ARGS, "temperature": 1.0})
+    assert cache.make_key({**MODEL_ARGS, "extra_body": {"data_sources": []}}) is None
+    assert CompletionCache(ttl=0).make_key(MODEL_ARGS) is None
+
+
+@pytest.mark.asyncio
+async def test_memory_cache_expires_and_evicts():
+    cache = CompletionCache(ttl=60, max_entries=2)
+
+    await cache.set("a", {"content": "A"})
+    await cache.set("b", {"content": "B"})
+    await cache.get("a")
+    await cache.set("c", {"content": "C"})
+
+    assert await cache.get("a") == {"content": "A"}
+    assert await cache.get("b") is None
+
+    cache._entries["a"] = ({"content": "A"}, time.time() - 1)
+    assert await cache.get("a") is None
+
+
+@pytest.mark.asyncio
+async def test_sqlite_tier_survives_a_new_cache(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = CompletionCache(ttl=60, sqlite_path=path)
+    await cache.set("key", {"content": "answer", "model": "gpt-4o"})
+    cache.close()
+
+    reopened = CompletionCache(ttl=60, sqlite_path=path)
+    assert await reopened.get("key") == {"content": "answer", "model": "gpt-4o"}
+    reopened.close()
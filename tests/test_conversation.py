@@ -0,0 +1,170 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from quart import Quart
+
+import backend.conversation as conversation
+from backend.completion_cache import CompletionCache
+from backend.history.sqliteservice import SqliteConversationClient
+from backend.utils import encode_cursor
+
+
+def make_chunk(content=None, context=None):
+    delta = SimpleNamespace(role="assistant", content=content)
+    if context is not None:
+        delta.context = context
+    return SimpleNamespace(id="chatcmpl-1", model="gpt-4o", created=1, object="chat.completion.chunk", choices=[SimpleNamespace(delta=delta)])
+
+
+class FakeStream():
+    def __init__(self, chunks, delay=0):
+        self.chunks = iter(chunks)
+        self.delay = delay
+        self.closed = False
+
+    async def __anext__(self):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        try:
+            return next(self.chunks)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    def __aiter__(self):
+        return self
+
+    async def close(self):
+        self.closed = True
+
+
+class FakeOpenAIClient():
+    def __init__(self, streams):
+        self.streams = list(streams)
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **model_args):
+        stream = self.streams[self.calls]
+        self.calls += 1
+        return stream
+
+
+NO_CITATIONS = [make_chunk(context={"citations": []})]
+ANSWER = [make_chunk(context={"citations": [{"title": "doc"}]}), make_chunk(content="Hello")]
+
+
+@pytest.fixture
+def openai_client(monkeypatch):
+    def install(streams, hedge_after_ms=None, cache_ttl=0):
+        client = FakeOpenAIClient(streams)
+        async def prepare_model_args(request_body):
+            return {"stream": True, "messages": request_body.get("messages", [])}
+        monkeypatch.setattr(conversation, "get_openai_client", lambda: client)
+        monkeypatch.setattr(conversation, "prepare_model_args", prepare_model_args)
+        monkeypatch.setattr(conversation, "completion_cache", CompletionCache(ttl=cache_ttl))
+        monkeypatch.setattr(conversation, "AZURE_OPENAI_STREAM_RETRIES", 2)
+        monkeypatch.setattr(conversation, "AZURE_OPENAI_STREAM_RETRY_BACKOFF_MS", 1)
+        monkeypatch.setattr(conversation, "AZURE_OPENAI_STREAM_HEDGE_AFTER_MS", hedge_after_ms)
+        return client
+    return install
+
+
+@pytest.mark.asyncio
+async def test_stream_retries_when_no_citations(openai_client):
+    streams = [FakeStream(NO_CITATIONS), FakeStream(ANSWER)]
+    client = openai_client(streams)
+
+    chunks = [chunk async for chunk in await conversation.send_chat_stream_request({})]
+
+    assert client.calls == 2
+    assert streams[0].closed
+    assert chunks == ANSWER
+
+
+@pytest.mark.asyncio
+async def test_stream_returns_last_attempt_when_retries_run_out(openai_client):
+    client = openai_client([FakeStream(NO_CITATIONS) for _ in range(3)])
+
+    response = await conversation.stream_chat_request({})
+    formatted = [chunk async for chunk in response]
+
+    assert client.calls == 3
+    assert formatted == ['retry']
+
+
+@pytest.mark.asyncio
+async def test_stream_hedges_slow_request(openai_client):
+    streams = [FakeStream(ANSWER, delay=1), FakeStream(ANSWER)]
+    client = openai_client(streams, hedge_after_ms=10)
+
+    chunks = [chunk async for chunk in await conversation.send_chat_stream_request({})]
+
+    assert client.calls == 2
+    assert chunks == ANSWER
+    assert streams[0].closed
+
+
+@pytest.mark.asyncio
+async def test_stream_is_closed_when_the_client_goes_away(openai_client):
+    streams = [FakeStream(ANSWER + [make_chunk(content=" there")])]
+    openai_client(streams)
+
+    response = await conversation.stream_chat_request({})
+    await response.__anext__()
+    await response.aclose()
+
+    assert streams[0].closed
+
+
+@pytest.mark.asyncio
+async def test_stream_replays_cached_answer(openai_client):
+    client = openai_client([FakeStream(ANSWER), FakeStream(ANSWER)], cache_ttl=60)
+    request_body = {"messages": [{"role": "user", "content": "Hi"}]}
+
+    first = [chunk async for chunk in await conversation.stream_chat_request(request_body)]
+    second = [chunk async for chunk in await conversation.stream_chat_request(request_body)]
+
+    assert client.calls == 1
+    assert first[-1]["choices"][0]["messages"] == [{"role": "assistant", "content": "Hello"}]
+    assert second[0]["choices"][0]["messages"] == [{"role": "assistant", "content": "Hello"}]
+    assert second[0]["id"] != first[-1]["id"]
+
+
+class FakeHistoryClient():
+    def __init__(self):
+        self.titles = {}
+
+    async def update_conversation_title(self, user_id, conversation_id, title):
+        self.titles[conversation_id] = title
+
+
+@pytest.mark.asyncio
+async def test_generated_title_replaces_provisional_title(monkeypatch):
+    clients = [FakeHistoryClient(), FakeHistoryClient()]
+    async def generate_title(messages):
+        return "Greeting"
+    monkeypatch.setattr(conversation, "generate_title", generate_title)
+    monkeypatch.setattr(conversation, "get_cosmos_conversation_client", lambda: clients[0])
+    monkeypatch.setattr(conversation, "get_cosmos_logs_client", lambda: clients[1])
+    history_metadata = {"title": "Hi"}
+
+    await conversation.update_generated_title("user", "1", [{"role": "user", "content": "Hi"}], history_metadata)
+
+    assert history_metadata["title"] == "Greeting"
+    assert [client.titles for client in clients] == [{"1": "Greeting"}, {"1": "Greeting"}]
+
+
+@pytest.mark.asyncio
+async def test_a_malformed_cursor_is_a_bad_request(monkeypatch, tmp_path):
+    history_client = SqliteConversationClient(str(tmp_path / "history.db"), "conversations")
+    monkeypatch.setattr(conversation, "get_cosmos_conversation_client", lambda: history_client)
+    app = Quart(__name__)
+    app.add_url_rule("/history/list", view_func=conversation.list_conversations, methods=["GET"])
+
+    try:
+        response = await app.test_client().get("/history/list", query_string={"cursor": encode_cursor("not json")})
+    finally:
+        await history_client.close()
+
+    assert response.status_code == 400
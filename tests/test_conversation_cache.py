@@ -0,0 +1,130 @@
+import itertools
+
+import pytest
+from azure.cosmos import exceptions
+
+from backend.history.conversation_cache import ConversationCache
+from backend.history.cosmosdbservice import CosmosConversationClient
+
+
+class FakeCosmosContainer():
+    """Just enough of a container to follow ETags, point reads and queries."""
+
+    def __init__(self):
+        self.items = {}
+        self.etags = itertools.count()
+        self.reads = []
+        self.queries = 0
+
+    def store(self, item):
+        item = {**item, "_etag": f"etag-{next(self.etags)}"}
+        self.items[item["id"]] = item
+        return dict(item)
+
+    async def read_item(self, item, partition_key, etag=None, match_condition=None):
+        self.reads.append(etag)
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(message="Not found")
+        if etag and self.items[item]["_etag"] == etag:
+            return None
+        return dict(self.items[item])
+
+    def query_items(self, query, parameters, partition_key):
+        self.queries += 1
+        conversation_id = parameters[0]["value"]
+        messages = sorted((item for item in self.items.values() if item.get("conversationId") == conversation_id), key=lambda item: item["createdAt"])
+
+        async def items():
+            for message in messages:
+                yield message
+        return items()
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        results = []
+        for operation in batch_operations:
+            kind, args = operation[0], operation[1]
+            options = operation[2] if len(operation) > 2 else {}
+            if kind == "upsert":
+                results.append({"statusCode": 200, "resourceBody": self.store(args[0])})
+            elif kind == "patch":
+                current = self.items[args[0]]
+                if options.get("if_match_etag") and options["if_match_etag"] != current["_etag"]:
+                    raise exceptions.CosmosBatchOperationError(error_index=len(results), headers={}, status_code=412, message="Precondition failed", operation_responses=[])
+                patched = dict(current)
+                for patch in args[1]:
+                    patched[patch["path"].lstrip("/")] = patch["value"]
+                results.append({"statusCode": 200, "resourceBody": self.store(patched)})
+        return results
+
+
+def make_client(container):
+    client = CosmosConversationClient("https://example.documents.azure.com:443/", "a2V5", "db", "conversations", cache=ConversationCache())
+    client.container_client = container
+    return client
+
+
+async def start_conversation(client):
+    conversation = client.build_conversation("user", "Title")
+    message = client.build_message("m1", conversation["id"], "user", {"role": "user", "content": "Hi"})
+    await client.create_messages("user", conversation["id"], [message], conversation=conversation)
+    return conversation["id"]
+
+
+@pytest.mark.asyncio
+async def test_reopening_conversation_revalidates_without_querying():
+    container = FakeCosmosContainer()
+    client = make_client(container)
+    conversation_id = await start_conversation(client)
+
+    conversation = await client.get_conversation("user", conversation_id)
+    messages = await client.get_messages("user", conversation_id)
+
+    assert conversation["title"] == "Title"
+    assert [message["id"] for message in messages] == ["m1"]
+    assert container.reads == [container.items[conversation_id]["_etag"]]
+    assert container.queries == 0
+
+
+@pytest.mark.asyncio
+async def test_written_messages_extend_cached_list():
+    container = FakeCosmosContainer()
+    client = make_client(container)
+    conversation_id = await start_conversation(client)
+
+    reply = client.build_message("m2", conversation_id, "user", {"role": "assistant", "content": "Hello"})
+    await client.create_messages("user", conversation_id, [reply])
+    await client.get_conversation("user", conversation_id)
+
+    assert [message["id"] for message in await client.get_messages("user", conversation_id)] == ["m1", "m2"]
+    assert container.queries == 0
+
+
+@pytest.mark.asyncio
+async def test_change_from_another_worker_is_picked_up():
+    container = FakeCosmosContainer()
+    client = make_client(container)
+    other_worker = make_client(container)
+    conversation_id = await start_conversation(client)
+
+    reply = other_worker.build_message("m2", conversation_id, "user", {"role": "assistant", "content": "Hello"})
+    await other_worker.create_messages("user", conversation_id, [reply])
+    await client.get_conversation("user", conversation_id)
+
+    assert [message["id"] for message in await client.get_messages("user", conversation_id)] == ["m1", "m2"]
+    assert container.queries == 1
+
+
+@pytest.mark.asyncio
+async def test_conditional_write_retries_when_cache_is_stale():
+    container = FakeCosmosContainer()
+    client = make_client(container)
+    conversation_id = await start_conversation(client)
+    # Renamed by another worker, so this worker's cached ETag is out of date
+    container.store({**container.items[conversation_id], "title": "Renamed"})
+
+    reply = client.build_message("m2", conversation_id, "user", {"role": "assistant", "content": "Hello"})
+    await client.create_messages("user", conversation_id, [reply])
+
+    assert container.items["m2"]["content"] == "Hello"
+    assert (await client.get_conversation("user", conversation_id))["title"] == "Renamed"
+    assert [message["id"] for message in await client.get_messages("user", conversation_id)] == ["m1", "m2"]
@@ -0,0 +1,146 @@
+import pytest
+from azure.cosmos import exceptions
+
+from backend.history.cosmosdbservice import ITEMS_LAYOUT_PREDICATE, CosmosConversationClient
+
+
+class FakeContainer():
+    def __init__(self, missing_conversation=False, items=None):
+        self.batches = []
+        self.missing_conversation = missing_conversation
+        self.items = items or []
+        self.deleted = []
+
+    def query_items(self, query, parameters, partition_key):
+        async def items():
+            for item in self.items:
+                yield item
+        return items()
+
+    async def delete_item(self, item, partition_key):
+        self.deleted.append(item)
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        self.batches.append((batch_operations, partition_key))
+        if self.missing_conversation:
+            raise exceptions.CosmosBatchOperationError(error_index=len(batch_operations) - 1, headers={}, status_code=404, message="Not found", operation_responses=[])
+        return [{"statusCode": 200} for _ in batch_operations]
+
+
+def make_client(container):
+    client = CosmosConversationClient("https://example.documents.azure.com:443/", "a2V5", "db", "conversations")
+    client.container_client = container
+    return client
+
+
+@pytest.mark.asyncio
+async def test_create_messages_touches_conversation_in_same_batch():
+    container = FakeContainer()
+    client = make_client(container)
+    message = client.build_message("m1", "c1", "user", {"role": "user", "content": "Hi"})
+
+    assert await client.create_messages("user", "c1", [message]) == [message]
+
+    operations, partition_key = container.batches[0]
+    assert partition_key == "user"
+    assert operations == [
+        ("upsert", (message,)),
+        ("patch", ("c1", [{"op": "set", "path": "/updatedAt", "value": message["createdAt"]}]), {"filter_predicate": ITEMS_LAYOUT_PREDICATE}),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_create_messages_creates_new_conversation_in_same_batch():
+    container = FakeContainer()
+    client = make_client(container)
+    conversation = client.build_conversation("user", "Title")
+    message = client.build_message("m1", conversation["id"], "user", {"role": "user", "content": "Hi"})
+
+    await client.create_messages("user", conversation["id"], [message], conversation=conversation)
+
+    assert container.batches[0][0] == [("upsert", (conversation,)), ("upsert", (message,))]
+
+
+@pytest.mark.asyncio
+async def test_create_messages_reports_missing_conversation():
+    client = make_client(FakeContainer(missing_conversation=True))
+    message = client.build_message("m1", "c1", "user", {"role": "user", "content": "Hi"})
+
+    assert await client.create_messages("user", "c1", [message]) == "Conversation not found"
+
+
+@pytest.mark.asyncio
+async def test_delete_items_uses_batches_of_at_most_100():
+    container = FakeContainer()
+    client = make_client(container)
+    item_ids = [f"m{i}" for i in range(250)]
+
+    await client.delete_items("user", item_ids, concurrency=2)
+
+    assert [len(operations) for operations, _ in container.batches] == [100, 100, 50]
+    assert [item_id for operations, _ in container.batches for _, (item_id,) in operations] == item_ids
+    assert all(partition_key == "user" for _, partition_key in container.batches)
+
+
+@pytest.mark.asyncio
+async def test_delete_all_conversations_deletes_messages_first():
+    container = FakeContainer(items=[{"id": "c1", "type": "conversation"}, {"id": "m1", "type": "message"}, {"id": "m2", "type": "message"}])
+    client = make_client(container)
+
+    assert await client.delete_all_conversations("user") == 1
+
+    assert [[item_id for _, (item_id,) in operations] for operations, _ in container.batches] == [["m1", "m2"], ["c1"]]
+
+
+class FakePages():
+    def __init__(self, pages, continuation_token):
+        self.pages = iter(pages)
+        self.continuation_token = continuation_token
+
+    async def __anext__(self):
+        try:
+            page = next(self.pages)
+        except StopIteration:
+            raise StopAsyncIteration
+
+        async def items():
+            for item in page:
+                yield item
+        return items()
+
+
+class FakeQueryContainer():
+    def __init__(self, pages, continuation_token):
+        self.pages = pages
+        self.continuation_token = continuation_token
+        self.calls = []
+
+    def query_items(self, query, parameters, partition_key, max_item_count):
+        container = self
+
+        class Query():
+            def by_page(self, continuation_token):
+                container.calls.append((query, partition_key, max_item_count, continuation_token))
+                return FakePages(container.pages, container.continuation_token)
+        return Query()
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_page_returns_next_token():
+    container = FakeQueryContainer([[{"id": "c1"}, {"id": "c2"}]], "next")
+    client = make_client(container)
+
+    conversations, continuation_token = await client.get_conversations_page("user", limit=2, continuation_token="previous")
+
+    assert conversations == [{"id": "c1"}, {"id": "c2"}]
+    assert continuation_token == "next"
+    query, partition_key, max_item_count, sent_token = container.calls[0]
+    assert query.startswith("SELECT c.id, c.title, c.createdAt, c.updatedAt FROM c")
+    assert (partition_key, max_item_count, sent_token) == ("user", 2, "previous")
+
+
+@pytest.mark.asyncio
+async def test_get_conversations_page_past_the_end():
+    client = make_client(FakeQueryContainer([], None))
+
+    assert await client.get_conversations_page("user", limit=25) == ([], None)
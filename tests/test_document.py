@@ -0,0 +1,353 @@
+import asyncio
+import hashlib
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from langchain.schema import Document
+from quart import Quart
+
+from backend import document, setup
+from backend.history.sqliteservice import SqliteConversationClient
+
+
+class FakeBlobClient():
+    def __init__(self, container, name):
+        self.container = container
+        self.url = f"https://account.blob.core.windows.net/user/{name}"
+        self.name = name
+
+    async def upload_blob(self, data, overwrite, max_concurrency, content_settings):
+        self.container.running += 1
+        self.container.most_running = max(self.container.most_running, self.container.running)
+        await asyncio.sleep(0.01)
+        self.container.running -= 1
+        if self.name.startswith("broken"):
+            raise Exception("Upload failed")
+        self.container.blobs[self.name] = data.read()
+        self.container.hashes[self.name] = content_settings.content_md5
+
+    async def set_blob_metadata(self, metadata):
+        self.container.metadata[self.name] = metadata
+
+
+class FakeContainerClient():
+    def __init__(self):
+        self.blobs = {}
+        self.hashes = {}
+        self.metadata = {}
+        self.listings = 0
+        self.running = 0
+        self.most_running = 0
+        self.created = 0
+
+    async def create_container(self):
+        self.created += 1
+
+    def get_blob_client(self, name):
+        return FakeBlobClient(self, name)
+
+    async def delete_blob(self, name):
+        del self.blobs[name]
+
+    async def list_blobs(self, include):
+        self.listings += 1
+        for name, data in self.blobs.items():
+            yield SimpleNamespace(name=name, size=len(data), metadata=self.metadata.get(name, {}), content_settings=SimpleNamespace(content_md5=self.hashes.get(name)))
+
+
+class FakeBlobServiceClient():
+    def __init__(self):
+        self.container = FakeContainerClient()
+
+    def get_container_client(self, name):
+        return self.container
+
+    def get_blob_client(self, container_name, name):
+        return FakeBlobClient(self.container, name)
+
+
+class FakeSearchResults():
+    def __init__(self, results):
+        self.results = results
+
+    def __aiter__(self):
+        return self.iter()
+
+    async def iter(self):
+        for result in self.results:
+            yield result
+
+
+class FakeSearchClient():
+    """An index of chunks, filtered by the exact user_id and filename of the search's filter."""
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.searches = []
+        self.deletes = []
+
+    async def search(self, search_text, filter, select, order_by, top, skip):
+        self.searches.append(filter)
+        assert order_by == ["id"]
+        matching = sorted(chunk["id"] for chunk in self.chunks if filter == f"user_id eq '{chunk['user_id']}' and filename eq '{chunk['filename']}'")
+        return FakeSearchResults([{"id": id} for id in matching[skip:skip + top]])
+
+    async def delete_documents(self, documents):
+        self.deletes.append(len(documents))
+        ids = {document["id"] for document in documents}
+        if any(id.startswith("stuck") for id in ids):
+            return [SimpleNamespace(key=id, succeeded=not id.startswith("stuck")) for id in ids]
+        self.chunks = [chunk for chunk in self.chunks if chunk["id"] not in ids]
+        return [SimpleNamespace(key=id, succeeded=True) for id in ids]
+
+
+class FakeDocumentLoader():
+    def __init__(self):
+        self.running = 0
+        self.most_running = 0
+
+    async def load(self, blob_client, blob_name):
+        self.running += 1
+        self.most_running = max(self.most_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if blob_name.startswith("broken"):
+            raise Exception("Unreadable file")
+        return [Document(page_content=blob_client.container.blobs[blob_name].decode())]
+
+
+class FakeVectorStore():
+    """Adds chunks to a FakeSearchClient, if it has one, taking delay seconds per batch in its thread."""
+    def __init__(self, search_client=None, delay=0):
+        self.batches = []
+        self.search_client = search_client
+        self.delay = delay
+
+    def add_texts(self, texts, metadatas):
+        time.sleep(self.delay)
+        self.batches.append([(metadata["filename"], metadata["chunk_number"]) for metadata in metadatas])
+        if self.search_client:
+            self.search_client.chunks += [{"id": f"{metadata['filename']}-{metadata['chunk_number']}", **metadata} for metadata in metadatas]
+
+
+class FakeWebsocket():
+    """Sends an abort once a file reaches abort_at_stage; a closed one fails every send."""
+    def __init__(self, abort_at_stage=None, closed=False):
+        self.events = []
+        self.abort_at_stage = abort_at_stage
+        self.closed = closed
+        self.abort = asyncio.Event()
+
+    async def send(self, data):
+        if self.closed:
+            raise ConnectionError("Websocket closed")
+        event = json.loads(data)
+        self.events.append(event)
+        if self.abort_at_stage and event.get("stage") == self.abort_at_stage:
+            self.abort.set()
+
+    async def receive(self):
+        if not self.abort_at_stage:
+            await asyncio.Event().wait()
+        await self.abort.wait()
+        return json.dumps({"command": "abort"})
+
+
+def make_app():
+    app = Quart(__name__)
+    app.add_url_rule("/upload_documents", view_func=document.upload_documents, methods=["POST"])
+    app.add_url_rule("/get_documents", view_func=document.get_documents, methods=["GET"])
+    app.add_url_rule("/delete_documents", view_func=document.delete_documents, methods=["POST"])
+    return app
+
+
+@pytest.fixture
+def blob_service_client(monkeypatch):
+    blob_service_client = FakeBlobServiceClient()
+    monkeypatch.setattr(setup.client_registry, "blob_service_client", blob_service_client)
+    monkeypatch.setattr(setup.client_registry, "blob_containers", set())
+    monkeypatch.setattr(document, "get_cosmos_conversation_client", lambda: None)
+    return blob_service_client
+
+
+@pytest.fixture
+def history_client(monkeypatch, tmp_path):
+    history_client = SqliteConversationClient(str(tmp_path / "history.db"), "conversations")
+    monkeypatch.setattr(document, "get_cosmos_conversation_client", lambda: history_client)
+    yield history_client
+    asyncio.run(history_client.close())
+
+
+async def upload(client, names):
+    """Posts a file per name, its content being its name, as the browser does: several parts named "file"."""
+    body = b"".join(
+        f'--boundary\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\nContent-Type: text/plain\r\n\r\n{name}\r\n'.encode()
+        for name in names
+    ) + b"--boundary--\r\n"
+    return await client.post("/upload_documents", data=body, headers={"Content-Type": "multipart/form-data; boundary=boundary"})
+
+
+@pytest.mark.asyncio
+async def test_files_upload_concurrently_with_a_result_each(monkeypatch, blob_service_client):
+    monkeypatch.setattr(document, "AZURE_STORAGE_UPLOAD_CONCURRENCY", 2)
+    client = make_app().test_client()
+
+    response = await upload(client, ["a.txt", "broken.txt", "c.pdf", "d.csv"])
+    body = (await response.get_json())[0]
+    await upload(client, ["e.txt"])
+
+    container = blob_service_client.container
+    assert [name for name, _ in body["Documents"]] == ["a.txt", "c.pdf", "d.csv"]
+    assert [result["uploaded"] for result in body["Results"]] == [True, False, True, True]
+    assert container.blobs["a.txt"] == b"a.txt"
+    assert container.most_running == 2
+    assert container.created == 1
+
+
+@pytest.mark.asyncio
+async def test_an_upload_where_every_file_fails_is_an_error(blob_service_client):
+    response = await upload(make_app().test_client(), ["broken-1.txt", "broken-2.txt"])
+
+    body = await response.get_json()
+    assert response.status_code == 500
+    assert [result["uploaded"] for result in body["Results"]] == [False, False]
+
+
+@pytest.mark.asyncio
+async def test_nothing_is_uploaded_when_a_file_is_not_allowed(blob_service_client):
+    response = await upload(make_app().test_client(), ["a.txt", "b.exe"])
+
+    assert response.status_code == 400
+    assert blob_service_client.container.blobs == {}
+
+
+@pytest.mark.asyncio
+async def test_uploads_are_recorded_in_the_catalog_and_listed_from_it(blob_service_client, history_client):
+    client = make_app().test_client()
+
+    await upload(client, ["a.txt"])
+    await history_client.update_document_catalog("00000000-0000-0000-0000-000000000000", {"a.txt": {"numTokens": 12}})
+    response = await client.get("/get_documents")
+
+    catalog = await history_client.get_document_catalog("00000000-0000-0000-0000-000000000000")
+    assert catalog["a.txt"]["contentHash"] == hashlib.md5(b"a.txt").hexdigest()
+    assert catalog["a.txt"]["size"] == 5
+    assert await response.get_json() == {"a.txt": "12"}
+    # The catalog was built from the one listing made before the first upload was recorded
+    assert blob_service_client.container.listings == 1
+
+
+@pytest.mark.asyncio
+async def test_existing_blobs_are_listed_once_and_backfilled(blob_service_client, history_client):
+    container = blob_service_client.container
+    container.blobs = {"old.pdf": b"12345678", "new.txt": b"123"}
+    container.metadata = {"old.pdf": {"num_tokens": "40"}}
+    client = make_app().test_client()
+
+    first = await (await client.get("/get_documents")).get_json()
+    await asyncio.gather(*setup.client_registry.background_tasks)
+    second = await (await client.get("/get_documents")).get_json()
+
+    assert first == second == {"old.pdf": "40", "new.txt": "0"}
+    assert container.listings == 1
+    catalog = await history_client.get_document_catalog("00000000-0000-0000-0000-000000000000")
+    assert catalog["old.pdf"]["status"] == "ingested" and catalog["new.txt"]["status"] == "uploaded"
+
+
+@pytest.mark.asyncio
+# With the skip limit at one batch, each batch is deleted before searching again
+@pytest.mark.parametrize("max_search_skip", [100000, 100])
+async def test_deletes_only_the_files_chunks_in_batches(monkeypatch, blob_service_client, max_search_skip):
+    user_id = "00000000-0000-0000-0000-000000000000"
+    chunks = [{"id": f"report-{i}", "user_id": user_id, "filename": "report.pdf"} for i in range(250)]
+    chunks += [{"id": "other-report", "user_id": user_id, "filename": "other report.pdf"}, {"id": "someone-else", "user_id": "other", "filename": "report.pdf"}]
+    search_client = FakeSearchClient(chunks)
+    monkeypatch.setattr(setup.client_registry, "search_client", search_client)
+    monkeypatch.setattr(document, "AZURE_SEARCH_DELETE_BATCH_SIZE", 100)
+    monkeypatch.setattr(document, "MAX_SEARCH_SKIP", max_search_skip)
+    blob_service_client.container.blobs = {"report.pdf": b"report"}
+
+    response = await make_app().test_client().post("/delete_documents", json={"filenames": ["report.pdf"]})
+
+    assert (await response.get_json())["Results"] == [{"filename": "report.pdf", "blobDeleted": True, "chunksDeleted": 250}]
+    assert [chunk["id"] for chunk in search_client.chunks] == ["other-report", "someone-else"]
+    assert len(search_client.searches) == 3 and search_client.deletes == [100, 100, 50]
+    assert blob_service_client.container.blobs == {}
+
+
+@pytest.mark.asyncio
+async def test_files_are_ingested_concurrently_and_indexed_in_batches(monkeypatch, blob_service_client, history_client):
+    loader = FakeDocumentLoader()
+    vector_store = FakeVectorStore()
+    monkeypatch.setattr(setup.client_registry, "document_loader", loader)
+    monkeypatch.setattr(document, "init_vector_store", lambda: vector_store)
+    # tiktoken downloads its encoding on first use
+    monkeypatch.setattr(document, "count_tokens", lambda documents: sum(len(doc.page_content.split()) for doc in documents))
+    monkeypatch.setattr(document, "DOCUMENT_INGESTION_CONCURRENCY", 2)
+    monkeypatch.setattr(document, "DOCUMENT_INDEX_BATCH_SIZE", 2)
+    blob_service_client.container.blobs = {"a.txt": b"word " * 2000, "b.txt": b"short", "broken.txt": b""}
+    websocket = FakeWebsocket()
+
+    await document.handle_new_document(websocket, {"container": "user", "documents": [[name, f"https://blob/{name}"] for name in ["a.txt", "b.txt", "broken.txt"]]})
+
+    done = websocket.events[-1]
+    assert done["type"] == "done" and done["progress"] == 1
+    assert [(result["filename"], result["status"]) for result in done["results"]] == [("a.txt", "ingested"), ("b.txt", "ingested"), ("broken.txt", "failed")]
+    assert [event["stage"] for event in websocket.events if event.get("filename") == "a.txt"] == ["downloading", "parsed", "counted", "split", "indexing", "indexed"]
+    assert {"type": "file_error", "filename": "broken.txt", "error": "Unreadable file"}.items() <= next(event for event in websocket.events if event["type"] == "file_error").items()
+    # a.txt splits into three chunks, indexed two at a time
+    assert [batch for batch in vector_store.batches if batch[0][0] == "a.txt"] == [[("a.txt", "0"), ("a.txt", "1")], [("a.txt", "2")]]
+    assert loader.most_running == 2
+    assert blob_service_client.container.metadata["b.txt"] == {"num_tokens": "1"}
+    catalog = await history_client.get_document_catalog("user")
+    assert (catalog["a.txt"]["status"], catalog["a.txt"]["chunks"], catalog["broken.txt"]["status"]) == ("ingested", 3, "failed")
+
+
+@pytest.mark.asyncio
+async def test_files_whose_chunks_remain_stay_in_the_catalog(monkeypatch, blob_service_client, history_client):
+    user_id = "00000000-0000-0000-0000-000000000000"
+    search_client = FakeSearchClient([{"id": "stuck-0", "user_id": user_id, "filename": "b.txt"}])
+    monkeypatch.setattr(setup.client_registry, "search_client", search_client)
+    blob_service_client.container.blobs = {"a.txt": b"a", "b.txt": b"b"}
+    await history_client.update_document_catalog(user_id, {"a.txt": {"status": "ingested"}, "b.txt": {"status": "ingested"}})
+
+    response = await make_app().test_client().post("/delete_documents", json={"filenames": ["a.txt", "b.txt"]})
+
+    assert [result.get("error") for result in (await response.get_json())["Results"]] == [None, "1 of 1 chunks were not deleted"]
+    assert list(await history_client.get_document_catalog(user_id)) == ["b.txt"]
+
+
+@pytest.fixture
+def ingestion(monkeypatch, blob_service_client, history_client):
+    """Ingests with fakes: the search index is a FakeSearchClient that the vector store adds chunks to."""
+    search_client = FakeSearchClient([])
+    monkeypatch.setattr(setup.client_registry, "search_client", search_client)
+    monkeypatch.setattr(setup.client_registry, "document_loader", FakeDocumentLoader())
+    monkeypatch.setattr(document, "count_tokens", lambda documents: sum(len(doc.page_content.split()) for doc in documents))
+    monkeypatch.setattr(document, "DOCUMENT_INDEX_BATCH_SIZE", 1)
+    def install(vector_store):
+        monkeypatch.setattr(document, "init_vector_store", lambda: vector_store)
+    return SimpleNamespace(search_client=search_client, install=install, container=blob_service_client.container)
+
+
+@pytest.mark.asyncio
+async def test_aborted_files_are_recorded_and_their_chunks_deleted(ingestion, history_client):
+    ingestion.install(FakeVectorStore(ingestion.search_client, delay=0.05))
+    ingestion.container.blobs = {"a.txt": b"word " * 2000}
+
+    await document.handle_new_document(FakeWebsocket(abort_at_stage="indexing"), {"container": "user", "documents": [["a.txt", "https://blob/a.txt"]]})
+
+    assert ingestion.search_client.chunks == []
+    assert (await history_client.get_document_catalog("user"))["a.txt"]["status"] == "aborted"
+
+
+@pytest.mark.asyncio
+async def test_ingestion_carries_on_when_the_websocket_is_closed(ingestion, history_client):
+    ingestion.install(FakeVectorStore(ingestion.search_client))
+    ingestion.container.blobs = {"a.txt": b"short", "broken.txt": b""}
+
+    await document.handle_new_document(FakeWebsocket(closed=True), {"container": "user", "documents": [["a.txt", "https://blob/a.txt"], ["broken.txt", "https://blob/broken.txt"]]})
+
+    catalog = await history_client.get_document_catalog("user")
+    assert (catalog["a.txt"]["status"], catalog["broken.txt"]["status"]) == ("ingested", "failed")
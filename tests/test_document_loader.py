@@ -0,0 +1,45 @@
+import pytest
+
+from backend.document_loader import DocumentLoader, parse_document
+
+
+class FakeDownloader():
+    def __init__(self, data):
+        self.size = len(data)
+        self.data = data
+
+    async def chunks(self):
+        for i in range(0, len(self.data), 4):
+            yield self.data[i:i + 4]
+
+
+class FakeBlobClient():
+    def __init__(self, data):
+        self.data = data
+
+    async def download_blob(self, max_concurrency):
+        return FakeDownloader(self.data)
+
+
+def test_csv_rows_become_documents():
+    documents = parse_document("people.csv", b"name,role\nAda , engineer\nGrace,admiral\n")
+
+    assert [document.page_content for document in documents] == ["name: Ada\nrole: engineer", "name: Grace\nrole: admiral"]
+    assert documents[1].metadata == {"source": "people.csv", "row": 1}
+
+
+def test_unsupported_files_are_refused():
+    with pytest.raises(ValueError):
+        parse_document("tool.exe", b"")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("in_memory_limit", [1024, 0])
+async def test_blobs_are_parsed_in_the_pool_from_memory_or_a_temporary_file(in_memory_limit):
+    loader = DocumentLoader(processes=1, in_memory_limit=in_memory_limit, memory_limit=None)
+    try:
+        documents = await loader.load(FakeBlobClient("Notes from the meeting".encode()), "notes.txt")
+    finally:
+        await loader.close()
+
+    assert [(document.page_content, document.metadata) for document in documents] == [("Notes from the meeting", {"source": "notes.txt"})]
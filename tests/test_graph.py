@@ -0,0 +1,65 @@
+import asyncio
+
+import httpx
+import pytest
+
+from backend.graph import GRAPH_MEMBER_OF_URL, GraphGroupResolver
+
+
+def make_resolver(pages, **kwargs):
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        if request.headers["Authorization"] == "bearer bad":
+            return httpx.Response(401, text="unauthorized")
+        page = pages[str(request.url)]
+        return httpx.Response(200, json=page)
+
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return GraphGroupResolver("groups", http_client=client, **kwargs), requests
+
+
+PAGES = {
+    GRAPH_MEMBER_OF_URL: {"value": [{"id": "a"}, {"id": "b"}], "@odata.nextLink": "https://graph.microsoft.com/v1.0/next"},
+    "https://graph.microsoft.com/v1.0/next": {"value": [{"id": "c"}]},
+}
+
+
+@pytest.mark.asyncio
+async def test_follows_every_page_and_builds_filter():
+    resolver, requests = make_resolver(PAGES)
+
+    assert await resolver.get_group_ids("user", "token") == ["a", "b", "c"]
+    assert await resolver.get_filter_string("user", "token") == "groups/any(g:search.in(g, 'a, b, c'))"
+    assert len(requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_concurrent_lookups_share_one_fetch():
+    resolver, requests = make_resolver(PAGES)
+
+    results = await asyncio.gather(*[resolver.get_filter_string("user", "token") for _ in range(5)])
+
+    assert len(set(results)) == 1
+    assert len(requests) == 2
+
+
+@pytest.mark.asyncio
+async def test_stale_entry_is_served_while_refreshing():
+    resolver, requests = make_resolver(PAGES, ttl=60, refresh_after=0)
+    await resolver.get_group_ids("user", "token")
+    changed_pages = {GRAPH_MEMBER_OF_URL: {"value": [{"id": "d"}]}}
+    resolver.http_client = make_resolver(changed_pages)[0].http_client
+
+    assert await resolver.get_group_ids("user", "token") == ["a", "b", "c"]
+    await asyncio.sleep(0.01)
+    assert await resolver.get_group_ids("user", "token") == ["d"]
+
+
+@pytest.mark.asyncio
+async def test_failures_are_not_cached():
+    resolver, requests = make_resolver(PAGES)
+
+    assert await resolver.get_group_ids("user", "bad") == []
+    assert await resolver.get_group_ids("user", "token") == ["a", "b", "c"]
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from backend.jobs import JobTracker
+
+
+@pytest.mark.asyncio
+async def test_quick_job_finishes_within_wait():
+    tracker = JobTracker()
+    async def work():
+        return 3
+
+    job = tracker.start("user", "Delete", work())
+
+    assert await tracker.wait(job, timeout=1)
+    assert job.to_dict()["status"] == "succeeded"
+    assert job.result == 3
+
+
+@pytest.mark.asyncio
+async def test_slow_job_can_be_polled_by_its_user_only():
+    tracker = JobTracker()
+    finish = asyncio.Event()
+    async def work():
+        await finish.wait()
+
+    job = tracker.start("user", "Delete", work())
+
+    assert not await tracker.wait(job, timeout=0.01)
+    assert tracker.get("user", job.id).status == "running"
+    assert tracker.get("someone-else", job.id) is None
+    finish.set()
+    await job.task
+    assert tracker.get("user", job.id).status == "succeeded"
+
+
+@pytest.mark.asyncio
+async def test_failed_job_records_error():
+    tracker = JobTracker()
+    async def work():
+        raise ValueError("boom")
+
+    job = tracker.start("user", "Delete", work())
+    await tracker.wait(job, timeout=1)
+
+    assert (job.status, job.error) == ("failed", "boom")
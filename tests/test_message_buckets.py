@@ -0,0 +1,384 @@
+import copy
+import itertools
+
+import pytest
+from azure.cosmos import exceptions
+
+from backend.history.conversation_cache import ConversationCache
+from backend.history.cosmosdbservice import MESSAGE_PREDICATE, CosmosConversationClient
+from backend.history.historyservice import PreconditionFailedError
+
+
+class FakePager():
+    def __init__(self, results, page_size=None):
+        self.results = results
+        self.page_size = page_size or len(results) or 1
+
+    async def __aiter__(self):
+        for item in self.results:
+            yield copy.deepcopy(item)
+
+    async def by_page(self):
+        for start in range(0, len(self.results), self.page_size):
+            yield FakePager(self.results[start:start + self.page_size]).__aiter__()
+
+
+class FakeBucketContainer():
+    """A container following ETags, patches and transactional batches closely enough for both message layouts."""
+
+    def __init__(self):
+        self.items = {}
+        self.etags = itertools.count()
+        self.reads = []
+        self.queries = []
+        self.patches = []
+        # Called before every batch, to let a test write in between
+        self.before_batch = None
+
+    def store(self, items, item):
+        item = {key: value for key, value in item.items() if key != "_etag"}
+        item["_etag"] = f"etag-{next(self.etags)}"
+        items[item["id"]] = item
+        return copy.deepcopy(item)
+
+    def patch(self, items, item_id, patch_operations, etag=None, filter_predicate=None):
+        if item_id not in items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+        item = copy.deepcopy(items[item_id])
+        if filter_predicate == MESSAGE_PREDICATE:
+            holds = item["type"] == "message"
+        else:
+            holds = not filter_predicate or "latestBucket" not in item
+        if (etag and item["_etag"] != etag) or not holds:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+        for operation in patch_operations:
+            *parents, last = operation["path"].strip("/").split("/")
+            target = item
+            for key in parents:
+                target = target[int(key)] if isinstance(target, list) else target[key]
+            if last == "-":
+                target.append(operation["value"])
+            elif isinstance(target, list):
+                target[int(last)] = operation["value"]
+            else:
+                target[last] = operation["value"]
+        return self.store(items, item)
+
+    async def read_item(self, item, partition_key, etag=None, match_condition=None):
+        self.reads.append(item)
+        if item not in self.items:
+            raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+        if etag and self.items[item]["_etag"] == etag:
+            return None
+        return copy.deepcopy(self.items[item])
+
+    async def upsert_item(self, body):
+        return self.store(self.items, body)
+
+    async def create_item(self, body):
+        if body["id"] in self.items:
+            raise exceptions.CosmosResourceExistsError(status_code=409, message="Conflict")
+        return self.store(self.items, body)
+
+    async def replace_item(self, item, body, etag=None, match_condition=None):
+        if self.before_batch:
+            before_batch, self.before_batch = self.before_batch, None
+            await before_batch()
+        if etag and self.items[item]["_etag"] != etag:
+            raise exceptions.CosmosAccessConditionFailedError(status_code=412, message="Precondition failed")
+        return self.store(self.items, body)
+
+    async def patch_item(self, item, partition_key, patch_operations, filter_predicate=None, etag=None, match_condition=None):
+        self.patches.append(item)
+        return self.patch(self.items, item, patch_operations, etag=etag, filter_predicate=filter_predicate)
+
+    async def delete_item(self, item, partition_key):
+        del self.items[item]
+
+    async def delete_all_items_by_partition_key(self, partition_key):
+        self.items = {item_id: item for item_id, item in self.items.items() if item.get("userId") != partition_key}
+
+    def query_items(self, query, parameters, partition_key=None, max_item_count=None):
+        self.queries.append(query)
+        values = {parameter["name"]: parameter["value"] for parameter in parameters}
+        if "m.id = @messageId" in query:
+            results = [item for item in self.items.values() if item["type"] == "messageBucket" and any(message["id"] == values["@messageId"] for message in item["messages"])]
+        elif "SELECT VALUE c.id" in query:
+            types = ("message", "messageBucket") if "c.type='messageBucket'" in query else ("message",)
+            results = [item["id"] for item in self.items.values() if item["type"] in types and item["conversationId"] == values["@conversationId"]]
+        else:
+            results = sorted((item for item in self.items.values() if item["type"] == "message" and item["conversationId"] == values["@conversationId"]), key=lambda item: item["createdAt"])
+            results = [item for item in results if item["createdAt"] <= values.get("@until", item["createdAt"]) and item["createdAt"] > values.get("@cursor", "")]
+            if "SELECT VALUE c.createdAt" in query:
+                results = [item["createdAt"] for item in reversed(results)][values["@limit"]:values["@limit"] + 1]
+        return FakePager(results, max_item_count)
+
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        if self.before_batch:
+            before_batch, self.before_batch = self.before_batch, None
+            await before_batch()
+        items = copy.deepcopy(self.items)
+        results = []
+        for index, operation in enumerate(batch_operations):
+            kind, args = operation[0], operation[1]
+            options = operation[2] if len(operation) > 2 else {}
+            try:
+                if kind == "upsert":
+                    results.append({"statusCode": 200, "resourceBody": self.store(items, args[0])})
+                elif kind == "patch":
+                    results.append({"statusCode": 200, "resourceBody": self.patch(items, *args, etag=options.get("if_match_etag"), filter_predicate=options.get("filter_predicate"))})
+                elif kind == "delete":
+                    if args[0] not in items:
+                        raise exceptions.CosmosResourceNotFoundError(status_code=404, message="Not found")
+                    del items[args[0]]
+                    results.append({"statusCode": 204})
+            except exceptions.CosmosHttpResponseError as e:
+                raise exceptions.CosmosBatchOperationError(error_index=index, headers={}, status_code=e.status_code, message="Batch failed", operation_responses=[])
+        self.items = items
+        return results
+
+
+def make_client(container, message_layout="buckets", bucket_size=3):
+    client = CosmosConversationClient("https://example.documents.azure.com:443/", "a2V5", "db", "conversations", enable_message_feedback=True, message_layout=message_layout, bucket_size=bucket_size)
+    client.container_client = container
+    return client
+
+
+async def write_conversation(client, count, start=0):
+    conversation = client.build_conversation("user", "Title")
+    for i in range(start, start + count):
+        message = client.build_message(f"m{i}", conversation["id"], "user", {"role": "user", "content": f"Message {i}"})
+        await client.create_messages("user", conversation["id"], [message], conversation=conversation if i == start else None)
+    return conversation["id"]
+
+
+async def read_messages(client, conversation_id):
+    conversation = await client.get_conversation("user", conversation_id)
+    return [message["id"] for message in await client.get_messages("user", conversation_id, conversation=conversation)]
+
+
+@pytest.mark.asyncio
+async def test_messages_fill_buckets_and_are_read_with_point_reads():
+    container = FakeBucketContainer()
+    client = make_client(container)
+    conversation_id = await write_conversation(client, 7)
+
+    assert [container.items[f"{conversation_id}-bucket-{i}"]["messages"][0]["id"] for i in range(3)] == ["m0", "m3", "m6"]
+    assert container.items[conversation_id]["latestBucket"] == 2
+    assert not any(item["type"] == "message" for item in container.items.values())
+
+    container.reads, container.queries = [], []
+    assert await read_messages(client, conversation_id) == [f"m{i}" for i in range(7)]
+    assert len(container.reads) == 4
+    assert container.queries == []
+
+
+@pytest.mark.asyncio
+async def test_concurrent_write_is_placed_after_the_other():
+    container = FakeBucketContainer()
+    client = make_client(container)
+    other_worker = make_client(container)
+    conversation_id = await write_conversation(client, 2)
+    await client.get_conversation("user", conversation_id)
+
+    async def write_from_other_worker():
+        await other_worker.create_messages("user", conversation_id, [other_worker.build_message("other", conversation_id, "user", {"role": "user", "content": "Other"})])
+    container.before_batch = write_from_other_worker
+    await client.create_messages("user", conversation_id, [client.build_message("mine", conversation_id, "user", {"role": "user", "content": "Mine"})])
+
+    assert await read_messages(client, conversation_id) == ["m0", "m1", "other", "mine"]
+
+
+@pytest.mark.asyncio
+async def test_item_and_bucket_conversations_side_by_side():
+    container = FakeBucketContainer()
+    legacy_id = await write_conversation(make_client(container, message_layout="items"), 2)
+    client = make_client(container)
+    bucketed_id = await write_conversation(client, 2)
+
+    await client.create_messages("user", legacy_id, [client.build_message("m2", legacy_id, "user", {"role": "user", "content": "Hi"})])
+
+    assert container.items["m2"]["type"] == "message"
+    assert await read_messages(client, legacy_id) == ["m0", "m1", "m2"]
+    assert await read_messages(make_client(container, message_layout="items"), bucketed_id) == ["m0", "m1"]
+
+
+@pytest.mark.asyncio
+async def test_migration_moves_message_items_to_buckets():
+    container = FakeBucketContainer()
+    conversation_id = await write_conversation(make_client(container, message_layout="items"), 4)
+    client = make_client(container)
+
+    assert await client.migrate_to_buckets("user", conversation_id) == 4
+    assert await client.migrate_to_buckets("user", conversation_id) == 0
+
+    assert not any(item["type"] == "message" for item in container.items.values())
+    assert await read_messages(client, conversation_id) == ["m0", "m1", "m2", "m3"]
+    # Writers still on message items follow the conversation into its buckets
+    items_client = make_client(container, message_layout="items")
+    await items_client.create_messages("user", conversation_id, [items_client.build_message("m4", conversation_id, "user", {"role": "user", "content": "Hi"})])
+    assert await read_messages(client, conversation_id) == ["m0", "m1", "m2", "m3", "m4"]
+
+
+@pytest.mark.asyncio
+async def test_feedback_on_bucketed_message():
+    container = FakeBucketContainer()
+    client = make_client(container)
+    conversation_id = await write_conversation(client, 5)
+
+    updated = await client.update_message_feedback("user", "m4", "positive")
+
+    assert updated["feedback"] == "positive"
+    assert container.items[f"{conversation_id}-bucket-1"]["messages"][1]["feedback"] == "positive"
+    assert await client.update_message_feedback("user", "missing", "positive") is False
+
+
+@pytest.mark.asyncio
+async def test_feedback_and_title_are_patched_without_reads():
+    container = FakeBucketContainer()
+    client = make_client(container, message_layout="items")
+    conversation_id = await write_conversation(client, 2)
+    container.reads.clear()
+
+    updated = await client.update_message_feedback("user", "m1", "positive")
+    renamed = await client.update_conversation_title("user", conversation_id, "Renamed")
+
+    assert container.reads == []
+    assert updated["feedback"] == "positive"
+    assert renamed["title"] == "Renamed"
+    assert "messagesUpdatedAt" in container.items[conversation_id]
+    # Only message items take feedback
+    assert await client.update_message_feedback("user", conversation_id, "positive") is False
+    assert await client.update_conversation_title("user", "missing", "Renamed") is False
+
+
+@pytest.mark.asyncio
+async def test_etag_preconditions():
+    container = FakeBucketContainer()
+    client = make_client(container, message_layout="items")
+    conversation_id = await write_conversation(client, 1)
+    etag = container.items[conversation_id]["_etag"]
+
+    await client.update_conversation_title("user", conversation_id, "First", etag=etag)
+    with pytest.raises(PreconditionFailedError):
+        await client.update_conversation_title("user", conversation_id, "Second", etag=etag)
+    with pytest.raises(PreconditionFailedError):
+        await client.update_message_feedback("user", "m0", "positive", etag="stale")
+    assert container.items[conversation_id]["title"] == "First"
+    assert container.items["m0"]["feedback"] == ""
+
+
+@pytest.mark.asyncio
+async def test_batch_feedback_touches_each_conversation_once():
+    container = FakeBucketContainer()
+    items_client = make_client(container, message_layout="items")
+    first = await write_conversation(items_client, 3)
+    bucketed = await write_conversation(make_client(container), 2, start=3)
+    container.patches.clear()
+
+    results = await items_client.update_messages_feedback(
+        "user",
+        {"m0": "positive", "m1": "negative", "m2": "positive", "m3": "positive", "missing": "positive"},
+        etags={"m2": "stale"}
+    )
+
+    assert results["m0"]["feedback"] == "positive" and results["m1"]["feedback"] == "negative"
+    assert results["m2"] is None
+    assert results["missing"] is False
+    assert results["m3"]["feedback"] == "positive"
+    assert container.items[f"{bucketed}-bucket-0"]["messages"][0]["feedback"] == "positive"
+    assert container.patches.count(first) == 1
+
+
+async def write_timed_conversation(client, count):
+    conversation = client.build_conversation("user", "Title")
+    for i in range(count):
+        message = client.build_message(f"m{i}", conversation["id"], "user", {"role": "user", "content": f"Message {i}"})
+        message["createdAt"] = f"2024-01-01T00:00:{i:02d}"
+        await client.create_messages("user", conversation["id"], [message], conversation=conversation if i == 0 else None)
+    return conversation["id"]
+
+
+async def stream_ids(client, conversation_id, limit=None, until=None):
+    pages, cursor = await client.stream_messages("user", conversation_id, limit=limit, until=until, page_size=2)
+    pages = [[message["id"] for message in page] async for page in pages]
+    assert all(0 < len(page) <= 2 for page in pages)
+    return [message_id for page in pages for message_id in page], cursor
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("message_layout", ["items", "buckets"])
+async def test_stream_the_last_messages_then_older_ones(message_layout):
+    client = make_client(FakeBucketContainer(), message_layout=message_layout)
+    conversation_id = await write_timed_conversation(client, 7)
+
+    assert await stream_ids(client, conversation_id) == ([f"m{i}" for i in range(7)], None)
+    newest, cursor = await stream_ids(client, conversation_id, limit=3)
+    older, cursor = await stream_ids(client, conversation_id, limit=3, until=cursor)
+    oldest, cursor = await stream_ids(client, conversation_id, limit=3, until=cursor)
+
+    assert (newest, older, oldest) == (["m4", "m5", "m6"], ["m1", "m2", "m3"], ["m0"])
+    assert cursor is None
+
+
+@pytest.mark.asyncio
+async def test_document_catalog_updates_merge():
+    container = FakeBucketContainer()
+    client = make_client(container)
+    assert await client.get_document_catalog("user") is None
+
+    await client.update_document_catalog("user", {"a.txt": {"size": 5, "status": "uploaded"}, "b.txt": {"size": 3}})
+    # Another worker records the ingestion while this one is removing b.txt
+    async def ingest():
+        await client.update_document_catalog("user", {"a.txt": {"numTokens": 10, "status": "ingested"}})
+    container.before_batch = ingest
+    await client.update_document_catalog("user", removals=["b.txt"])
+
+    catalog = await client.get_document_catalog("user")
+    assert list(catalog) == ["a.txt"]
+    assert catalog["a.txt"]["size"] == 5 and catalog["a.txt"]["status"] == "ingested"
+
+
+@pytest.mark.asyncio
+async def test_clearing_history_by_partition_keeps_the_document_catalog():
+    container = FakeBucketContainer()
+    client = make_client(container)
+    conversation_id = await write_conversation(client, 2)
+    await client.update_document_catalog("user", {"a.txt": {"numTokens": 10, "status": "ingested"}})
+
+    await client.delete_all_conversations("user", by_partition_key=True)
+
+    assert await client.get_conversation("user", conversation_id) is None
+    assert (await client.get_document_catalog("user"))["a.txt"]["numTokens"] == 10
+
+
+@pytest.mark.asyncio
+async def test_a_cleared_bucketed_conversation_takes_new_messages():
+    container = FakeBucketContainer()
+    client = make_client(container)
+    conversation_id = await write_conversation(client, 4)
+
+    await client.delete_messages(conversation_id, "user")
+
+    assert not any(item["type"] == "messageBucket" for item in container.items.values())
+    assert container.items[conversation_id]["latestBucket"] == 0
+    assert await read_messages(client, conversation_id) == []
+
+    await client.create_messages("user", conversation_id, [client.build_message("m4", conversation_id, "user", {"role": "user", "content": "Again"})])
+    assert await read_messages(client, conversation_id) == ["m4"]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("message_layout", ["items", "buckets"])
+async def test_cleared_messages_are_dropped_from_other_workers_caches(message_layout):
+    container = FakeBucketContainer()
+    client = make_client(container, message_layout=message_layout)
+    other_worker = make_client(container, message_layout=message_layout)
+    other_worker.cache = ConversationCache()
+    conversation_id = await write_conversation(client, 2)
+    assert await read_messages(other_worker, conversation_id) == ["m0", "m1"]
+
+    await client.delete_messages(conversation_id, "user")
+
+    assert await read_messages(other_worker, conversation_id) == []
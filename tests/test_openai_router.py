@@ -0,0 +1,154 @@
+import asyncio
+import gc
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from backend.openai_router import OpenAIBackend, OpenAIRouter, get_retry_after
+
+
+def make_error(error_class, status_code, headers=None):
+    response = httpx.Response(status_code, headers=headers or {}, request=httpx.Request("POST", "https://example.openai.azure.com/"))
+    return error_class("error", response=response, body=None)
+
+
+class FakeRawResponse():
+    def __init__(self, result, headers=None):
+        self.result = result
+        self.headers = headers or {}
+
+    def parse(self):
+        return self.result
+
+
+class FakeClient():
+    def __init__(self, name, outcomes=None):
+        self.name = name
+        self.outcomes = list(outcomes or [])
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=self.create)))
+
+    async def create(self, **model_args):
+        self.calls.append(model_args)
+        outcome = self.outcomes.pop(0) if self.outcomes else FakeRawResponse(self.name)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+
+def test_get_retry_after():
+    assert get_retry_after({"retry-after-ms": "1500"}) == 1.5
+    assert get_retry_after({"retry-after": "3"}) == 3
+    assert get_retry_after({}) is None
+
+
+def test_pick_backend_uses_weighted_least_outstanding():
+    small = OpenAIBackend("small", FakeClient("small"), "gpt", weight=1)
+    large = OpenAIBackend("large", FakeClient("large"), "gpt", weight=3)
+    router = OpenAIRouter([small, large])
+
+    large.outstanding = 3
+    assert router.pick_backend() is small
+    small.outstanding = 1
+    assert router.pick_backend() is large
+
+    large.remaining_tokens = 0
+    assert router.pick_backend() is small
+
+
+@pytest.mark.asyncio
+async def test_throttled_backend_fails_over():
+    throttled_client = FakeClient("throttled", [make_error(openai.RateLimitError, 429, {"retry-after": "60"})])
+    throttled = OpenAIBackend("throttled", throttled_client, "deployment-a")
+    healthy = OpenAIBackend("healthy", FakeClient("healthy"), "deployment-b", weight=0.5)
+    router = OpenAIRouter([throttled, healthy])
+
+    response = await router.chat.completions.create(model="ignored", messages=[])
+
+    assert response == "healthy"
+    assert throttled_client.calls[0]["model"] == "deployment-a"
+    assert healthy.client.calls[0]["model"] == "deployment-b"
+    assert not throttled.is_available(throttled.unavailable_until - 1)
+    assert throttled.outstanding == 0 and healthy.outstanding == 0
+
+
+@pytest.mark.asyncio
+async def test_circuit_opens_after_repeated_failures():
+    failing_client = FakeClient("failing", [make_error(openai.InternalServerError, 500) for _ in range(3)])
+    failing = OpenAIBackend("failing", failing_client, "gpt", weight=100)
+    healthy = OpenAIBackend("healthy", FakeClient("healthy"), "gpt")
+    router = OpenAIRouter([failing, healthy], failure_threshold=2)
+
+    assert await router.chat.completions.create(messages=[]) == "healthy"
+    assert not failing.circuit_open
+    assert await router.chat.completions.create(messages=[]) == "healthy"
+    assert failing.circuit_open
+
+    assert await router.chat.completions.create(messages=[]) == "healthy"
+    assert len(failing_client.calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_half_open_circuit_takes_one_probe_at_a_time():
+    probe_started, release = asyncio.Event(), asyncio.Event()
+
+    class SlowClient(FakeClient):
+        async def create(self, **model_args):
+            probe_started.set()
+            await release.wait()
+            return await super().create(**model_args)
+
+    recovering = OpenAIBackend("recovering", SlowClient("recovering"), "gpt", weight=100)
+    healthy = OpenAIBackend("healthy", FakeClient("healthy"), "gpt")
+    router = OpenAIRouter([recovering, healthy])
+    # Its cooldown is over, so the circuit is half-open
+    recovering.circuit_open = True
+
+    probe = asyncio.create_task(router.chat.completions.create(messages=[]))
+    await probe_started.wait()
+    # Sent to the probing backend it would wait for the probe
+    assert await asyncio.wait_for(router.chat.completions.create(messages=[]), 1) == "healthy"
+
+    release.set()
+    assert await probe == "recovering"
+    assert not recovering.circuit_open and not recovering.probing
+
+
+@pytest.mark.asyncio
+async def test_stream_keeps_backend_outstanding_until_closed():
+    class FakeStream():
+        closed = False
+
+        async def close(self):
+            self.closed = True
+
+    stream = FakeStream()
+    backend = OpenAIBackend("only", FakeClient("only", [FakeRawResponse(stream)]), "gpt")
+    router = OpenAIRouter([backend])
+
+    response = await router.chat.completions.create(messages=[], stream=True)
+    assert backend.outstanding == 1
+    await response.close()
+    assert backend.outstanding == 0 and stream.closed
+
+
+@pytest.mark.asyncio
+async def test_abandoned_stream_releases_backend():
+    class FakeStream():
+        async def __anext__(self):
+            return "chunk"
+
+        async def close(self):
+            pass
+
+    backend = OpenAIBackend("only", FakeClient("only", [FakeRawResponse(FakeStream())]), "gpt")
+    router = OpenAIRouter([backend])
+
+    response = await router.chat.completions.create(messages=[], stream=True)
+    await response.__anext__()
+    assert backend.outstanding == 1
+    del response
+    gc.collect()
+    assert backend.outstanding == 0
@@ -0,0 +1,62 @@
+import pytest
+
+import backend.setup as setup
+
+
+def test_redact_secrets():
+    model_args = {
+        "messages": [{"role": "user", "content": "key"}],
+        "extra_body": {"data_sources": [{"parameters": {
+            "authentication": {"type": "api_key", "key": "secret"},
+            "embedding_dependency": {"authentication": {"type": "api_key", "key": "secret"}},
+            "connection_string": "secret",
+            "index_name": "index"
+        }}]}
+    }
+
+    redacted = setup.redact_secrets(model_args)
+
+    parameters = redacted["extra_body"]["data_sources"][0]["parameters"]
+    assert parameters["authentication"] == {"type": "api_key", "key": "*****"}
+    assert parameters["embedding_dependency"]["authentication"]["key"] == "*****"
+    assert parameters["connection_string"] == "*****"
+    assert parameters["index_name"] == "index"
+    assert model_args["extra_body"]["data_sources"][0]["parameters"]["connection_string"] == "secret"
+
+
+@pytest.mark.asyncio
+async def test_configured_data_source_overlays_filter_on_template(monkeypatch):
+    template = {"type": "azure_search", "parameters": {"index_name": "index", "filter": None}}
+    monkeypatch.setattr(setup, "DATASOURCE_TYPE", "AzureCognitiveSearch")
+    monkeypatch.setattr(setup, "AZURE_SEARCH_PERMITTED_GROUPS_COLUMN", None)
+    monkeypatch.setattr(setup, "_data_source_template", template)
+
+    data_source = await setup.get_configured_data_source("user", ["report.pdf"])
+
+    assert data_source["parameters"] == {"index_name": "index", "filter": "(user_id eq 'user') and (filename eq 'report.pdf')"}
+    assert template["parameters"]["filter"] is None
+
+
+def test_provisional_title_uses_first_words_of_question():
+    messages = [{"role": "user", "content": "What's the leave policy, for new starters?"}]
+
+    assert setup.get_provisional_title(messages) == "What's the leave policy"
+    assert setup.get_provisional_title([{"role": "user", "content": "?"}]) == "New chat"
+
+
+@pytest.mark.asyncio
+async def test_registry_shares_one_cosmos_client_between_containers(monkeypatch):
+    monkeypatch.setattr(setup, "CHAT_HISTORY_ENABLED", True)
+    monkeypatch.setattr(setup, "AZURE_COSMOSDB_ACCOUNT", "account")
+    monkeypatch.setattr(setup, "AZURE_COSMOSDB_ACCOUNT_KEY", "a2V5")
+    monkeypatch.setattr(setup, "AZURE_COSMOSDB_DATABASE", "db")
+    monkeypatch.setattr(setup, "AZURE_COSMOSDB_CONVERSATIONS_CONTAINER", "conversations")
+    registry = setup.ClientRegistry()
+
+    conversations = registry.get_cosmos_conversation_client()
+    logs = registry.get_cosmos_logs_client()
+
+    assert registry.get_cosmos_conversation_client() is conversations
+    assert conversations.cosmosdb_client is logs.cosmosdb_client
+    assert logs.container_name == "logs"
+    await registry.close()
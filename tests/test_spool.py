@@ -0,0 +1,137 @@
+import asyncio
+import json
+
+import pytest
+
+from backend.history.historyservice import HistoryClient
+from backend.history.spool import SpooledHistoryClient, read_pending
+
+
+class RecordingHistoryClient(HistoryClient):
+    container_name = "logs"
+
+    def __init__(self, failures=0, failing_conversation=None):
+        self.calls = []
+        self.failures = failures
+        self.failing_conversation = failing_conversation
+        self.closed = False
+
+    async def ensure(self):
+        return True, "ok"
+
+    async def create_messages(self, user_id, conversation_id, messages, conversation = None):
+        if self.failures and self.failing_conversation in (None, conversation_id):
+            self.failures -= 1
+            raise Exception("throttled")
+        self.calls.append(("create_messages", conversation_id, [message["id"] for message in messages], bool(conversation)))
+        return messages
+
+    async def update_conversation_title(self, user_id, conversation_id, title, etag = None):
+        self.calls.append(("update_conversation_title", conversation_id, title))
+        return True
+
+    async def close(self):
+        self.closed = True
+
+
+def message(message_id, conversation_id="c1"):
+    return {"id": message_id, "conversationId": conversation_id}
+
+
+@pytest.mark.asyncio
+async def test_writes_return_at_once_and_drain_merged_on_close(tmp_path):
+    inner = RecordingHistoryClient()
+    client = SpooledHistoryClient(inner, str(tmp_path), retry_delay=0)
+
+    await client.create_messages("user", "c1", [message("m1")], conversation={"id": "c1"})
+    await client.create_messages("user", "c1", [message("m2")])
+    await client.create_messages("user", "c1", [message("m3")])
+    await client.update_conversation_title("user", "c1", "Title")
+    await client.create_messages("user", "c2", [message("m4", "c2")])
+    assert inner.calls == []
+
+    await client.close()
+
+    assert inner.calls == [
+        ("create_messages", "c1", ["m1"], True),
+        ("create_messages", "c1", ["m2", "m3"], False),
+        ("update_conversation_title", "c1", "Title"),
+        ("create_messages", "c2", ["m4"], False),
+    ]
+    assert inner.closed
+    # Everything was written, so the spool starts over
+    assert (tmp_path / client.path.split("/")[-1]).read_text() == ""
+
+
+@pytest.mark.asyncio
+async def test_failed_writes_are_retried(tmp_path):
+    inner = RecordingHistoryClient(failures=2)
+    client = SpooledHistoryClient(inner, str(tmp_path), retry_delay=0)
+
+    await client.create_messages("user", "c1", [message("m1")])
+    await client.close()
+
+    assert inner.calls == [("create_messages", "c1", ["m1"], False)]
+
+
+@pytest.mark.asyncio
+async def test_writes_that_keep_failing_stay_in_the_spool(tmp_path):
+    inner = RecordingHistoryClient(failures=10)
+    client = SpooledHistoryClient(inner, str(tmp_path), max_attempts=2, retry_delay=0)
+
+    await client.create_messages("user", "c1", [message("m1")])
+    await client.create_messages("user", "c1", [message("m2")], conversation={"id": "c1"})
+    await client.close()
+
+    with open(client.path) as spool:
+        assert [record["arguments"]["messages"][0]["id"] for record in read_pending(spool)] == ["m1", "m2"]
+
+
+@pytest.mark.asyncio
+async def test_later_writes_wait_behind_a_failed_write_until_its_retry(tmp_path):
+    inner = RecordingHistoryClient(failures=2, failing_conversation="c1")
+    client = SpooledHistoryClient(inner, str(tmp_path), max_attempts=1, retry_delay=0, blocked_retry_delay=0.05)
+
+    await client.create_messages("user", "c1", [message("m1")])
+    await asyncio.sleep(0.01)
+    await client.create_messages("user", "c1", [message("m2")])
+    await client.create_messages("user", "c2", [message("m3", "c2")])
+    for _ in range(100):
+        if len(inner.calls) == 2:
+            break
+        await asyncio.sleep(0.01)
+    await client.close()
+
+    assert inner.calls == [("create_messages", "c2", ["m3"], False), ("create_messages", "c1", ["m1", "m2"], False)]
+    assert (tmp_path / client.path.split("/")[-1]).read_text() == ""
+
+
+@pytest.mark.asyncio
+async def test_spools_of_stopped_workers_are_replayed(tmp_path):
+    records = [
+        {"seq": 0, "method": "create_messages", "arguments": {"user_id": "user", "conversation_id": "c1", "messages": [message("m1")], "conversation": None}},
+        {"seq": 1, "method": "update_conversation_title", "arguments": {"user_id": "user", "conversation_id": "c1", "title": "Title"}},
+        {"ack": [0]},
+    ]
+    orphan = tmp_path / "logs-123-abcdef12.spool"
+    # The worker stopped in the middle of a line
+    orphan.write_text("".join(json.dumps(record) + "\n" for record in records) + '{"seq": 2, "meth')
+    inner = RecordingHistoryClient()
+    client = SpooledHistoryClient(inner, str(tmp_path), retry_delay=0)
+
+    await client.ensure()
+    await client.close()
+
+    assert inner.calls == [("update_conversation_title", "c1", "Title")]
+    assert not orphan.exists()
+
+
+@pytest.mark.asyncio
+async def test_full_spool_waits_for_room(tmp_path):
+    inner = RecordingHistoryClient()
+    client = SpooledHistoryClient(inner, str(tmp_path), batch_size=1, max_queue=1, retry_delay=0)
+
+    await asyncio.gather(*[client.create_messages("user", f"c{i}", [message(f"m{i}", f"c{i}")]) for i in range(5)])
+    await client.close()
+
+    assert [call[1] for call in inner.calls] == [f"c{i}" for i in range(5)]
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from backend.history.historyservice import InvalidContinuationTokenError
+from backend.history.sqliteservice import SqliteConversationClient
+
+
+@pytest.fixture
+def client(tmp_path):
+    client = SqliteConversationClient(str(tmp_path / "history.db"), "conversations", enable_message_feedback=True)
+    yield client
+    asyncio.run(client.close())
+
+
+async def start_conversation(client, user_id="user", title="Title", count=2):
+    conversation = client.build_conversation(user_id, title)
+    messages = [client.build_message(f"{conversation['id']}-m{i}", conversation["id"], user_id, {"role": "user", "content": f"Message {i}"}) for i in range(count)]
+    await client.create_messages(user_id, conversation["id"], messages[:1], conversation=conversation)
+    await client.create_messages(user_id, conversation["id"], messages[1:])
+    return conversation["id"]
+
+
+@pytest.mark.asyncio
+async def test_conversation_round_trip(client):
+    conversation_id = await start_conversation(client)
+
+    assert (await client.get_conversation("user", conversation_id))["title"] == "Title"
+    assert [message["content"] for message in await client.get_messages("user", conversation_id)] == ["Message 0", "Message 1"]
+    assert await client.get_conversation("someone else", conversation_id) is None
+    assert await client.create_message("m", "missing", "user", {"role": "user", "content": "Hi"}) == "Conversation not found"
+
+
+@pytest.mark.asyncio
+async def test_feedback_and_rename(client):
+    conversation_id = await start_conversation(client)
+
+    assert (await client.update_message_feedback("user", f"{conversation_id}-m1", "positive"))["feedback"] == "positive"
+    assert await client.update_message_feedback("someone else", f"{conversation_id}-m1", "negative") is False
+    await client.update_conversation_title("user", conversation_id, "Renamed")
+
+    assert (await client.get_messages("user", conversation_id))[1]["feedback"] == "positive"
+    assert (await client.get_conversations("user", limit=None))[0]["title"] == "Renamed"
+
+    results = await client.update_messages_feedback("user", {f"{conversation_id}-m0": "negative", "missing": "positive"})
+    assert results[f"{conversation_id}-m0"]["feedback"] == "negative"
+    assert results["missing"] is False
+
+
+@pytest.mark.asyncio
+async def test_pages_follow_updated_at(client):
+    conversation_ids = [await start_conversation(client, title=f"Conversation {i}") for i in range(5)]
+
+    first, token = await client.get_conversations_page("user", limit=2)
+    second, token = await client.get_conversations_page("user", limit=2, continuation_token=token)
+    third, token = await client.get_conversations_page("user", limit=2, continuation_token=token)
+
+    assert [conversation["id"] for conversation in first + second + third] == conversation_ids[::-1]
+    assert token is None
+    assert [conversation["id"] for conversation in await client.get_conversations("user", limit=2, offset=2)] == conversation_ids[2:0:-1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("continuation_token", ["not json", "{}", '["2024-01-01"]', "[1, 2]"])
+async def test_malformed_continuation_tokens_are_refused(client, continuation_token):
+    with pytest.raises(InvalidContinuationTokenError):
+        await client.get_conversations_page("user", limit=2, continuation_token=continuation_token)
+
+
+@pytest.mark.asyncio
+async def test_deletes_stay_within_user_and_container(client, tmp_path):
+    logs = SqliteConversationClient(str(tmp_path / "history.db"), "logs")
+    conversation_id = await start_conversation(client)
+    await start_conversation(client)
+    await start_conversation(client, user_id="other")
+    logged_id = await start_conversation(logs)
+
+    await client.delete_conversation_and_messages("user", conversation_id)
+    assert await client.get_conversation("user", conversation_id) is None
+    assert await client.get_messages("user", conversation_id) == []
+
+    await client.update_document_catalog("user", {"a.txt": {"numTokens": 10}})
+    assert await client.delete_all_conversations("user") == 1
+    assert (await client.get_document_catalog("user"))["a.txt"]["numTokens"] == 10
+    assert await client.get_conversations("user", limit=None) == []
+    assert len(await client.get_conversations("other", limit=None)) == 1
+    assert len(await logs.get_messages("user", logged_id)) == 2
+    await logs.close()
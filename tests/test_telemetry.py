@@ -0,0 +1,93 @@
+import logging
+
+import pytest
+
+from backend.history.cosmosdbservice import CosmosConversationClient
+from backend.history.telemetry import CosmosTelemetry
+from backend.metrics import MetricsRegistry
+
+
+class FakeResponse():
+    def __init__(self, status_code, headers):
+        self.http_response = self
+        self.status_code = status_code
+        self.headers = headers
+
+
+class FakeContainer():
+    """Answers like CosmosDB would through raw_response_hook, throttling the first request of a point read."""
+
+    async def read_item(self, item, partition_key, raw_response_hook):
+        raw_response_hook(FakeResponse(429, {"x-ms-request-charge": "0"}))
+        raw_response_hook(FakeResponse(200, {"x-ms-request-charge": "1"}))
+        if item.endswith("-bucket-0"):
+            return {"id": item, "type": "messageBucket", "messages": []}
+        return {"id": item, "type": "conversation", "latestBucket": 0, "_etag": "etag"}
+
+    def query_items(self, query, parameters, partition_key, raw_response_hook):
+        async def items():
+            raw_response_hook(FakeResponse(200, {"x-ms-request-charge": "2.5", "x-ms-item-count": "2"}))
+            yield "m1"
+            yield "m2"
+        return items()
+
+
+def make_client(telemetry):
+    client = CosmosConversationClient("https://example.documents.azure.com:443/", "a2V5", "db", "conversations", telemetry=telemetry)
+    client.container_client = telemetry.instrument(FakeContainer(), "conversations")
+    return client
+
+
+@pytest.mark.asyncio
+async def test_nested_calls_are_recorded_as_one_operation(caplog):
+    registry = MetricsRegistry()
+    telemetry = CosmosTelemetry(registry)
+    client = make_client(telemetry)
+
+    telemetry.start_request("POST /history/read")
+    # Without the conversation, get_messages reads it first, then its bucket
+    await client.get_messages("user", "c1")
+    assert await client.get_message_ids("user", "c1") == ["m1", "m2"]
+    with caplog.at_level(logging.INFO):
+        telemetry.end_request()
+
+    labels = ("get_messages", "conversations", "POST /history/read")
+    assert telemetry.request_charge.collect()[labels]["sum"] == 2
+    assert telemetry.request_charge.collect()[labels]["count"] == 1
+    assert telemetry.throttle_retries.collect()[labels]["sum"] == 2
+    assert telemetry.items.collect()[("get_message_ids", "conversations", "POST /history/read")]["sum"] == 2
+    assert "CosmosDB usage of POST /history/read: 2 operations, 4.50 RU" in caplog.text
+    assert 'cosmos_request_charge_bucket{operation="get_messages",container="conversations",route="POST /history/read",le="2"} 1' in registry.render()
+
+
+class FakePager():
+    def __init__(self, raw_response_hook):
+        self.raw_response_hook = raw_response_hook
+
+    async def by_page(self):
+        async def page():
+            yield {"id": "m1"}
+        self.raw_response_hook(FakeResponse(200, {"x-ms-request-charge": "3", "x-ms-item-count": "1"}))
+        yield page()
+
+
+class FakePagedContainer(FakeContainer):
+    def query_items(self, query, parameters, partition_key, raw_response_hook, max_item_count=None):
+        return FakePager(raw_response_hook)
+
+
+@pytest.mark.asyncio
+async def test_streamed_pages_are_recorded_once_read():
+    telemetry = CosmosTelemetry(MetricsRegistry())
+    client = make_client(telemetry)
+    client.container_client = telemetry.instrument(FakePagedContainer(), "conversations")
+
+    telemetry.start_request("POST /history/read")
+    pages, cursor = await client.stream_messages("user", "c1", conversation={"id": "c1", "type": "conversation"})
+    telemetry.end_request()
+    # The response body is streamed after the request has ended
+    assert [page async for page in pages] == [[{"id": "m1"}]]
+
+    labels = ("stream_message_pages", "conversations", "POST /history/read")
+    assert telemetry.request_charge.collect()[labels]["sum"] == 3
+    assert telemetry.items.collect()[labels]["sum"] == 1
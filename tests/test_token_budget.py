@@ -0,0 +1,84 @@
+from backend.token_budget import HistoryTokenBudget, get_context_window, get_encoding_name
+
+
+class WordEncoding():
+    def __init__(self):
+        self.encoded = []
+
+    def encode_batch(self, texts, disallowed_special=()):
+        self.encoded.extend(texts)
+        return [text.split() for text in texts]
+
+
+def make_messages(count, words=10):
+    return [{"role": "user", "content": f"message {i} " + "word " * (words - 2)} for i in range(count)]
+
+
+def test_get_context_window():
+    assert get_context_window("gpt-4o") == 128000
+    assert get_context_window("gpt-4-32k") == 32768
+    assert get_context_window("gpt-4") == 8192
+    assert get_context_window("unknown-model") == 8192
+
+
+def test_get_encoding_name():
+    assert get_encoding_name("gpt-4o") == "o200k_base"
+    assert get_encoding_name("gpt-35-turbo-16k") == "cl100k_base"
+    assert get_encoding_name("unknown-model") == "cl100k_base"
+
+
+def test_budget_uses_context_window_and_max_tokens():
+    budget = HistoryTokenBudget("gpt-4", max_tokens=1000, system_message="one two three", encoding=WordEncoding())
+    assert budget.budget == 8192 - 1000 - (3 + 4)
+
+    capped = HistoryTokenBudget("gpt-4o", max_tokens=1000, max_history_tokens=6000, encoding=WordEncoding())
+    assert capped.budget == 6000
+
+
+def test_trim_keeps_newest_messages_in_order():
+    budget = HistoryTokenBudget("gpt-4", max_tokens=1000, encoding=WordEncoding())
+    messages = make_messages(10)
+
+    kept = budget.trim(messages, budget=45)
+
+    assert kept == messages[-3:]
+    assert budget.trim(messages, budget=1000) == messages
+
+
+def test_trim_keeps_the_newest_message_even_over_budget():
+    budget = HistoryTokenBudget("gpt-4", max_tokens=1000, encoding=WordEncoding())
+    messages = make_messages(3, words=20)
+
+    assert budget.trim(messages, budget=10) == messages[-1:]
+
+
+def test_trim_only_encodes_new_messages():
+    encoding = WordEncoding()
+    budget = HistoryTokenBudget("gpt-4", max_tokens=1000, encoding=encoding)
+    messages = make_messages(5)
+
+    budget.trim(messages)
+    assert len(encoding.encoded) == 5
+
+    messages.append({"role": "assistant", "content": "a new answer"})
+    budget.trim(messages)
+    assert encoding.encoded[5:] == ["a new answer"]
+
+
+def test_cache_evicts_least_recently_used():
+    encoding = WordEncoding()
+    budget = HistoryTokenBudget("gpt-4", max_tokens=1000, cache_size=2, encoding=encoding)
+
+    budget.count_texts(["a", "b"])
+    budget.count_texts(["a"])
+    budget.count_texts(["c"])
+    budget.count_texts(["a", "b"])
+
+    assert encoding.encoded == ["a", "b", "c", "b"]
+
+
+def test_counts_survive_a_batch_larger_than_the_cache():
+    budget = HistoryTokenBudget("gpt-4", max_tokens=1000, cache_size=2, encoding=WordEncoding())
+
+    assert budget.count_texts(["a", "b c", "d e f"]) == [1, 2, 3]
+    assert budget.trim(make_messages(20), budget=1000) == make_messages(20)
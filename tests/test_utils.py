@@ -1,5 +1,23 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
 import pytest
-from backend.utils import format_as_ndjson, parse_multi_columns
+from backend.utils import decode_cursor, encode_cursor, format_as_compact_ndjson, format_as_ndjson, format_stream_response, parse_multi_columns
+
+
+def make_chunk(content=None, context=None, id="chatcmpl-1"):
+    delta = SimpleNamespace(role="assistant", content=content)
+    if context is not None:
+        delta.context = context
+    return SimpleNamespace(id=id, model="gpt-4o", created=1, object="chat.completion.chunk", choices=[SimpleNamespace(delta=delta)])
+
+
+async def chunk_generator(chunks, delay=0):
+    for chunk in chunks:
+        if delay:
+            await asyncio.sleep(delay)
+        yield chunk
 
 
 @pytest.mark.asyncio
@@ -27,3 +45,71 @@ def test_parse_multi_columns():
     assert parse_multi_columns(test_pipes) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_commas) == ["col1", "col2", "col3"]
     assert parse_multi_columns(test_single) == ["col1"]
+
+
+def test_format_stream_response():
+    history_metadata = {"conversation_id": "1"}
+    response = format_stream_response(make_chunk(content="Hello"), history_metadata)
+    assert response["choices"][0]["messages"] == [{"role": "assistant", "content": "Hello"}]
+    assert response["history_metadata"] == history_metadata
+
+    assert format_stream_response(make_chunk(context={"citations": []}), history_metadata) == 'retry'
+    assert format_stream_response(make_chunk(), history_metadata) == {}
+
+
+@pytest.mark.asyncio
+async def test_format_as_compact_ndjson_coalesces_deltas():
+    chunks = [make_chunk(context={"citations": [{"title": "doc"}]})] + [make_chunk(content=word) for word in ["Hello", " there", " world"]]
+
+    lines = [line async for line in format_as_compact_ndjson(chunk_generator(chunks), {"conversation_id": "1"}, flush_interval=10)]
+    frames = [json.loads(line) for line in lines]
+
+    assert frames[0] == {"id": "chatcmpl-1", "model": "gpt-4o", "created": 1, "object": "chat.completion.chunk", "history_metadata": {"conversation_id": "1"}}
+    assert frames[1]["role"] == "tool"
+    assert frames[2:] == [{"d": "Hello there world"}]
+
+
+@pytest.mark.asyncio
+async def test_format_as_compact_ndjson_sends_changed_metadata_last():
+    history_metadata = {"conversation_id": "1", "title": "Hello"}
+
+    async def generate():
+        yield make_chunk(content="Hi")
+        history_metadata["title"] = "Greeting"
+        yield make_chunk(content="!")
+
+    frames = [json.loads(line) async for line in format_as_compact_ndjson(generate(), history_metadata, flush_interval=10)]
+
+    assert frames[0]["history_metadata"]["title"] == "Hello"
+    assert frames[-1] == {"history_metadata": {"conversation_id": "1", "title": "Greeting"}}
+
+
+@pytest.mark.asyncio
+async def test_format_as_compact_ndjson_flushes_on_size_and_interval():
+    chunks = [make_chunk(content="abc") for _ in range(4)]
+
+    lines = [line async for line in format_as_compact_ndjson(chunk_generator(chunks), {}, flush_interval=10, flush_size=6)]
+    assert [json.loads(line) for line in lines[1:]] == [{"d": "abcabc"}, {"d": "abcabc"}]
+
+    lines = [line async for line in format_as_compact_ndjson(chunk_generator(chunks, delay=0.02), {}, flush_interval=0.001)]
+    assert [json.loads(line) for line in lines[1:]] == [{"d": "abc"}] * 4
+
+
+@pytest.mark.asyncio
+async def test_format_as_compact_ndjson_exception():
+    async def dummy_generator():
+        yield make_chunk(content="partial")
+        raise Exception("test exception")
+
+    lines = [line async for line in format_as_compact_ndjson(dummy_generator(), {}, flush_interval=10)]
+    assert lines[-2:] == ['{"d":"partial"}\n', '{"error":"test exception"}\n']
+
+
+def test_cursor_round_trip():
+    token = '[{"token":"+RID:~abc==#RT:1#TRC:25","range":{"min":"","max":"FF"}}]'
+
+    assert decode_cursor(encode_cursor(token)) == token
+    assert encode_cursor(None) is None
+    assert decode_cursor("") is None
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor!")